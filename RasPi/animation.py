@@ -0,0 +1,483 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from collections import deque, namedtuple
+from PIL import Image, ImageSequence
+
+from bitmap import fit_image, pack_bitmap
+
+
+# One frame as it goes over the SPI link, duration in milliseconds
+PackedFrame = namedtuple('PackedFrame', ['payload', 'duration'])
+
+# .fia files hold the packed frames of an animation, ready for the SPI link:
+#   header, the payloads back to back (all the same size), then the frame
+#   table with the durations (u32, ms) and optionally the payload digests.
+# All values little endian.
+FILE_EXTENSION = ".fia"
+FILE_MAGIC = b"FIAp"
+FILE_VERSION = 1
+FILE_FLAG_DIGESTS = 0x01
+# magic, version, flags, width, height, frame count, bytes per frame, frame table offset
+FILE_HEADER = struct.Struct('<4sBBHHIIQ')
+# Same digest as FIA uses for skipping duplicate frames
+DIGEST_SIZE = 16
+
+
+def frame_digest(payload):
+    return hashlib.blake2b(payload, digest_size=DIGEST_SIZE).digest()
+
+
+def iter_packed_frames(img, width = None, height = None, interval = None, crop = None, default_duration = None):
+    # Decode, fit and pack the frames of an image one at a time,
+    # see PackedAnimation.from_image() for the arguments
+    if not isinstance(img, Image.Image):
+        img = Image.open(img)
+    if width is None or height is None:
+        width, height = img.size
+    if default_duration is None:
+        default_duration = img.info.get('duration') or PackedAnimation.DEFAULT_DURATION
+
+    for frame in ImageSequence.Iterator(img):
+        if interval is not None:
+            duration = interval
+        else:
+            duration = frame.info.get('duration') or default_duration
+        yield PackedFrame(pack_frame(frame, width, height, crop), duration)
+
+
+def pack_frame(frame, width, height, crop = None):
+    if crop is not None:
+        frame = frame.crop((0, 0, crop[0], crop[1]))
+    return pack_bitmap(fit_image(frame, width, height))
+
+
+def _skip_sub_blocks(f):
+    while True:
+        size = f.read(1)
+        if not size or not size[0]:
+            return
+        f.seek(size[0], os.SEEK_CUR)
+
+
+def scan_gif_durations(filename):
+    # Durations in ms of all frames of a GIF (0 where there is none), read from
+    # the graphic control extensions without decoding a single pixel
+    durations = []
+    duration = 0
+    with open(filename, 'rb') as f:
+        header = f.read(13)
+        if len(header) < 13 or header[:3] != b"GIF":
+            raise ValueError("{} is not a GIF file".format(filename))
+        if header[10] & 0x80:
+            # Global colour table
+            f.seek(3 << ((header[10] & 0x07) + 1), os.SEEK_CUR)
+        while True:
+            block = f.read(1)
+            if block == b"!":
+                label = f.read(1)
+                size = f.read(1)
+                if not size or not size[0]:
+                    continue
+                data = f.read(size[0])
+                if label == b"\xF9" and len(data) >= 3:
+                    duration = (data[1] | (data[2] << 8)) * 10
+                _skip_sub_blocks(f)
+            elif block == b",":
+                descriptor = f.read(9)
+                if len(descriptor) < 9:
+                    break
+                if descriptor[8] & 0x80:
+                    # Local colour table
+                    f.seek(3 << ((descriptor[8] & 0x07) + 1), os.SEEK_CUR)
+                # LZW minimum code size, then the image data
+                f.read(1)
+                _skip_sub_blocks(f)
+                durations.append(duration)
+                duration = 0
+            else:
+                # Trailer, end of file or garbage
+                break
+    return durations
+
+
+def read_frame_durations(img, interval = None):
+    # Durations of all frames of an image without decoding them, if possible
+    count = getattr(img, 'n_frames', 1)
+    if interval is not None:
+        return [interval] * count
+    default_duration = img.info.get('duration') or PackedAnimation.DEFAULT_DURATION
+    if img.format == 'GIF' and getattr(img, 'filename', None):
+        durations = scan_gif_durations(img.filename)
+        if len(durations) == count:
+            return [duration or default_duration for duration in durations]
+    # Other formats have to be seeked through, which decodes the frames
+    durations = [frame.info.get('duration') or default_duration for frame in ImageSequence.Iterator(img)]
+    img.seek(0)
+    return durations
+
+
+class PackedAnimation:
+    # A sequence of frames that have already been decoded, fitted and packed,
+    # so playing them back only costs the SPI transfer.
+
+    DEFAULT_DURATION = 1000
+
+    def __init__(self, frames, width, height):
+        self.frames = list(frames)
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def from_image(cls, img, width = None, height = None, interval = None, crop = None):
+        # Load a static image or animation (filename or PIL image).
+        # If width and height are given, every frame is fitted to that size,
+        # otherwise the image's own size is used.
+        # crop (w, h) cuts each frame to that size before fitting it.
+        # interval overrides the per-frame durations (in ms).
+        if not isinstance(img, Image.Image):
+            img = Image.open(img)
+        if width is None or height is None:
+            width, height = img.size
+        return cls(iter_packed_frames(img, width, height, interval, crop), width, height)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    @property
+    def durations(self):
+        # Frame durations in ms, without touching the payloads
+        return [frame.duration for frame in self.frames]
+
+    @property
+    def total_duration(self):
+        return sum(frame.duration for frame in self.frames)
+
+    @property
+    def nbytes(self):
+        return sum(len(frame.payload) for frame in self.frames)
+
+    def save(self, filename, digests = True):
+        # Write the frames to a .fia file, see MappedAnimation
+        with AnimationWriter(filename, self.width, self.height, digests) as writer:
+            for frame in self:
+                writer.add(frame.payload, frame.duration)
+
+
+class AnimationWriter:
+    # Writes a .fia file frame by frame, so converting a long video
+    # never needs more than one frame in memory
+
+    def __init__(self, filename, width, height, digests = True):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.digests = digests
+        self.frame_size = None
+        self._durations = []
+        self._digests = []
+        self._file = open(filename, 'wb')
+        # Filled in by close() once the frame count is known
+        self._file.write(bytes(FILE_HEADER.size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self.filename)
+
+    @property
+    def frame_count(self):
+        return len(self._durations)
+
+    def add(self, payload, duration):
+        if self.frame_size is None:
+            self.frame_size = len(payload)
+        elif len(payload) != self.frame_size:
+            raise ValueError("Frame has {} bytes instead of {}".format(len(payload), self.frame_size))
+        self._file.write(payload)
+        self._durations.append(int(round(duration)))
+        if self.digests:
+            self._digests.append(frame_digest(payload))
+
+    def close(self):
+        if self._file.closed:
+            return
+        table_offset = self._file.tell()
+        self._file.write(struct.pack('<{}I'.format(len(self._durations)), *self._durations))
+        self._file.write(b"".join(self._digests))
+        flags = FILE_FLAG_DIGESTS if self.digests else 0
+        self._file.seek(0)
+        self._file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, flags, self.width, self.height, len(self._durations), self.frame_size or 0, table_offset))
+        self._file.close()
+
+
+class MappedAnimation(PackedAnimation):
+    # A .fia file mapped into memory. The frame payloads are memoryview slices
+    # of the mapping, so opening takes no time, playback doesn't copy anything
+    # on the way to spidev and the kernel pages frames in and out as needed,
+    # however long the animation is.
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError("{} is empty".format(filename))
+        try:
+            self._parse_header()
+        except Exception:
+            self._mmap.close()
+            raise
+        self._view = memoryview(self._mmap)
+
+    def _parse_header(self):
+        size = len(self._mmap)
+        if size < FILE_HEADER.size:
+            raise ValueError("{} is not a .fia file".format(self.filename))
+        magic, version, flags, self.width, self.height, count, self.frame_size, table_offset = FILE_HEADER.unpack_from(self._mmap)
+        if magic != FILE_MAGIC:
+            raise ValueError("{} is not a .fia file".format(self.filename))
+        if version != FILE_VERSION:
+            raise ValueError("{} has unsupported version {}".format(self.filename, version))
+        has_digests = flags & FILE_FLAG_DIGESTS
+        table_size = count * (4 + (DIGEST_SIZE if has_digests else 0))
+        if table_offset != FILE_HEADER.size + count * self.frame_size or table_offset + table_size > size:
+            raise ValueError("{} is truncated".format(self.filename))
+        self._durations = struct.unpack_from('<{}I'.format(count), self._mmap, table_offset)
+        self._digest_offset = table_offset + count * 4 if has_digests else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Frames are still in use somewhere, the mapping goes away with them
+            pass
+
+    @property
+    def frames(self):
+        return self
+
+    def __len__(self):
+        return len(self._durations)
+
+    def __iter__(self):
+        for index in range(len(self._durations)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._durations)
+        if not 0 <= index < len(self._durations):
+            raise IndexError("Frame index out of range")
+        offset = FILE_HEADER.size + index * self.frame_size
+        return PackedFrame(self._view[offset:offset + self.frame_size], self._durations[index])
+
+    def digest(self, index):
+        # Stored digest of a frame's payload, None if the file has none
+        if self._digest_offset is None:
+            return None
+        offset = self._digest_offset + index * DIGEST_SIZE
+        return self._mmap[offset:offset + DIGEST_SIZE]
+
+    def verify(self):
+        # Indices of the frames whose payload doesn't match the stored digest
+        if self._digest_offset is None:
+            return []
+        return [index for index, frame in enumerate(self) if frame_digest(frame.payload) != self.digest(index)]
+
+    @property
+    def durations(self):
+        return list(self._durations)
+
+    @property
+    def total_duration(self):
+        return sum(self._durations)
+
+    @property
+    def nbytes(self):
+        return len(self._durations) * self.frame_size
+
+
+class StreamingAnimation(PackedAnimation):
+    # Plays an image file without decoding all of it first. A producer thread
+    # decodes, fits and packs frames into a ring buffer of up to prefetch
+    # frames ahead of the one playing and waits while it's full.
+    # Only the durations are read up front (quickly for GIFs).
+    #
+    # If all packed frames fit into memory_budget bytes, they're kept once
+    # decoded, so later loops don't decode anything. Otherwise every loop
+    # decodes again and memory use stays at prefetch frames.
+    #
+    # Frames are expected to be requested in order, like the playback
+    # schedulers do. Jumping elsewhere restarts decoding at that frame.
+
+    DEFAULT_PREFETCH = 8
+    DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+    def __init__(self, img, width = None, height = None, interval = None, crop = None, prefetch = DEFAULT_PREFETCH, memory_budget = DEFAULT_MEMORY_BUDGET):
+        if not isinstance(img, Image.Image):
+            img = Image.open(img)
+        if width is None or height is None:
+            width, height = img.size
+        self.width = width
+        self.height = height
+        self.crop = crop
+        self.prefetch = max(prefetch, 1)
+        self._img = img
+        self._durations = read_frame_durations(img, interval)
+        count = len(self._durations)
+        self.frame_size = width * ((height + 7) // 8)
+        self._cache = [None] * count if count * self.frame_size <= memory_budget else None
+        self._cache_count = 0
+        self.frames_decoded = 0
+        self._cond = threading.Condition()
+        # (index, payload) in decoding order
+        self._ring = deque()
+        self._next_index = 0
+        self._restart_index = None
+        self._running = True
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="AnimationDecoder", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        self._ring.clear()
+
+    @property
+    def frames(self):
+        return self
+
+    @property
+    def cached(self):
+        # Whether every frame has been decoded and kept
+        return self._cache is not None and self._cache_count == len(self._cache)
+
+    def _run(self):
+        count = len(self._durations)
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: not self._running or self._restart_index is not None or (len(self._ring) < self.prefetch and not self.cached))
+                if not self._running:
+                    return
+                if self._restart_index is not None:
+                    self._ring.clear()
+                    self._next_index, self._restart_index = self._restart_index, None
+                index = self._next_index
+            try:
+                if self._cache is not None and self._cache[index] is not None:
+                    payload = self._cache[index]
+                else:
+                    self._img.seek(index)
+                    payload = bytes(pack_frame(self._img, self.width, self.height, self.crop))
+                    self.frames_decoded += 1
+            except Exception as e:
+                with self._cond:
+                    # Reported to the consumer by __getitem__()
+                    self._error = e
+                    self._running = False
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                if self._restart_index is not None:
+                    # Nobody wants this frame anymore
+                    continue
+                if self._cache is not None and self._cache[index] is None:
+                    self._cache[index] = payload
+                    self._cache_count += 1
+                self._ring.append((index, payload))
+                self._next_index = (index + 1) % count
+                self._cond.notify_all()
+
+    def _take(self, index):
+        # Payload of the frame from the ring buffer, or None if it isn't there (yet)
+        if not any(queued == index for queued, payload in self._ring):
+            return None
+        while True:
+            queued, payload = self._ring.popleft()
+            # Frames before it were skipped
+            if queued == index:
+                self._cond.notify_all()
+                return payload
+
+    def __len__(self):
+        return len(self._durations)
+
+    def __iter__(self):
+        for index in range(len(self._durations)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self._durations)
+        if not 0 <= index < len(self._durations):
+            raise IndexError("Frame index out of range")
+        with self._cond:
+            payload = self._take(index)
+            if payload is None and self._cache is not None:
+                payload = self._cache[index]
+            if payload is None:
+                # Whatever is queued comes before this frame and won't be played
+                self._ring.clear()
+                if self._next_index != index:
+                    self._restart_index = index
+                self._cond.notify_all()
+                self._cond.wait_for(lambda: self._error is not None or any(queued == index for queued, payload in self._ring))
+                if self._error is not None:
+                    raise ValueError("Could not decode frame {}".format(index)) from self._error
+                payload = self._take(index)
+        return PackedFrame(payload, self._durations[index])
+
+    @property
+    def durations(self):
+        return list(self._durations)
+
+    @property
+    def total_duration(self):
+        return sum(self._durations)
+
+    @property
+    def nbytes(self):
+        return len(self._durations) * self.frame_size
+
+
+def load_animation(filename, width = None, height = None, **kwargs):
+    # Map .fia files, decode anything else with PackedAnimation.from_image()
+    if isinstance(filename, str) and filename.lower().endswith(FILE_EXTENSION):
+        animation = MappedAnimation(filename)
+        if (width, height) != (None, None) and (animation.width, animation.height) != (width, height):
+            size = (animation.width, animation.height)
+            animation.close()
+            raise ValueError("{} was packed for {}x{}, not {}x{}".format(filename, size[0], size[1], width, height))
+        return animation
+    return PackedAnimation.from_image(filename, width, height, **kwargs)
@@ -0,0 +1,396 @@
+import asyncio
+import hashlib
+import os
+import struct
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from PIL import Image
+
+from animation import PackedAnimation, StreamingAnimation
+from bitmap import fit_image, pack_bitmap
+from fia_control import FIA, FIAError, FIAFramingError, FIAStatus, FIATimeoutError, UARTBatch
+from playback import FrameScheduler
+from uart_commands import COMMANDS
+
+
+class AsyncUARTBatch(UARTBatch):
+    # UARTBatch for AsyncFIA, use with "async with"
+
+    def __init__(self, afia, max_in_flight = UARTBatch.MAX_IN_FLIGHT):
+        super().__init__(afia.fia, max_in_flight)
+        self.afia = afia
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.execute()
+
+    async def execute(self):
+        if self.afia._emulated:
+            return super().execute()
+        if any(raw[2] in FIA.UART_CMDS_AFTER_SPI for raw, expect_response in self.commands):
+            async with self.afia._bitmap_locked():
+                async with self.afia.uart_lock:
+                    return await self._execute_async()
+        async with self.afia.uart_lock:
+            return await self._execute_async()
+
+    async def _execute_async(self):
+        # Same as UARTBatch._execute(), but waits for responses on the event loop
+        self.afia._attach()
+        self.fia.discard_uart_input()
+        pending = list(zip(self.commands, self.results))
+        in_flight = []
+        in_flight_bytes = 0
+        pos = 0
+        while pos < len(pending) or in_flight:
+            burst = bytearray()
+            sent = time.perf_counter()
+            while pos < len(pending):
+                (raw_command, expect_response), result = pending[pos]
+                if (burst or in_flight) and in_flight_bytes + len(raw_command) > self.max_in_flight:
+                    break
+                burst += raw_command
+                pos += 1
+                if expect_response:
+                    in_flight.append((result, len(raw_command), sent))
+                    in_flight_bytes += len(raw_command)
+                else:
+                    result.done = True
+            if burst:
+                self.fia.send_uart_command_raw(burst)
+            if in_flight:
+                result, length, sent = in_flight.pop(0)
+                in_flight_bytes -= length
+                try:
+                    result._set_response(await self.afia.read_uart_response())
+                    if self.fia.metrics is not None:
+                        self.fia.metrics.observe_uart_command(result.command, time.perf_counter() - sent)
+                except FIATimeoutError as e:
+                    # The responses would be out of step from here on
+                    result._set_error(e)
+                    for other, length, sent in in_flight:
+                        other._set_error(e)
+                    for command, other in pending[pos:]:
+                        other._set_error(e)
+                    break
+                except FIAError as e:
+                    result._set_error(e)
+        self.commands = []
+        return self.results
+
+
+class AsyncFIA:
+    # asyncio front end with the same commands as FIA, but awaitable.
+    # UART responses are received through the event loop's file descriptor
+    # reader instead of blocking reads, SPI transfers run in a worker thread.
+    # Wraps an existing FIA, which shouldn't be used directly at the same time.
+    # An FIAEmulator can be wrapped as well, its methods are just called directly.
+
+    def __init__(self, fia):
+        self.fia = fia
+        self.width = fia.width
+        self.height = fia.height
+        # Same roles as in FIA, see _bitmap_locked()
+        self.uart_lock = asyncio.Lock()
+        self.bitmap_lock = asyncio.Lock()
+        self._bitmap_owner = None
+        # A single worker keeps the SPI transfers in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="AsyncFIA-SPI")
+        self._rx_event = asyncio.Event()
+        self._loop = None
+        self._emulated = not hasattr(fia, 'uart')
+
+    def _attach(self):
+        # Start watching the UART once we're running inside an event loop
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop.add_reader(self.fia.uart.fileno(), self._on_uart_readable)
+
+    def _on_uart_readable(self):
+        try:
+            data = os.read(self.fia.uart.fileno(), 4096)
+        except BlockingIOError:
+            return
+        self.fia._rx_buf += data
+        self.fia.uart_bytes_in += len(data)
+        self._rx_event.set()
+
+    @asynccontextmanager
+    async def _bitmap_locked(self):
+        # asyncio locks aren't reentrant, so remember which task holds it
+        task = asyncio.current_task()
+        if self._bitmap_owner is task:
+            yield
+            return
+        async with self.bitmap_lock:
+            self._bitmap_owner = task
+            try:
+                yield
+            finally:
+                self._bitmap_owner = None
+
+    def close(self):
+        if self._loop is not None:
+            self._loop.remove_reader(self.fia.uart.fileno())
+            self._loop = None
+        self._executor.shutdown()
+
+    async def read_uart_response(self):
+        self._attach()
+        deadline = self._loop.time() + (self.fia.uart.timeout or 0)
+        while True:
+            result = self.fia._parse_uart_response()
+            if not isinstance(result, int):
+                return result
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                self.fia.uart_timeouts += 1
+                raise FIATimeoutError("No response from controller")
+            self._rx_event.clear()
+            try:
+                await asyncio.wait_for(self._rx_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def send_uart_command(self, command, data = [], expect_response = True):
+        # Send UART command and return response
+        if command in FIA.UART_CMDS_AFTER_SPI:
+            # Wait for running SPI transfers, see FIA.UART_CMDS_AFTER_SPI
+            async with self._bitmap_locked():
+                return await self._uart_transaction(command, self.fia.build_uart_command(command, data), expect_response)
+        return await self._uart_transaction(command, self.fia.build_uart_command(command, data), expect_response)
+
+    async def send_command(self, name, *args):
+        # Like FIA.send_command()
+        command = COMMANDS[name]
+        raw_command = command.pack_frame(*args)
+        if command.code in FIA.UART_CMDS_AFTER_SPI:
+            async with self._bitmap_locked():
+                resp = await self._uart_transaction(command.code, raw_command, command.expect_response)
+        else:
+            resp = await self._uart_transaction(command.code, raw_command, command.expect_response)
+        if resp is None:
+            return None
+        try:
+            return command.decode(resp)
+        except struct.error:
+            raise FIAFramingError("Short response to command 0x{:02X}".format(command.code))
+
+    async def _uart_transaction(self, command, raw_command, expect_response):
+        if self._emulated:
+            return self.fia._uart_transaction(command, raw_command, expect_response)
+        async with self.uart_lock:
+            self._attach()
+            start = time.perf_counter()
+            self.fia.discard_uart_input()
+            self.fia.send_uart_command_raw(raw_command)
+            if expect_response:
+                resp = await self.read_uart_response()
+            else:
+                resp = None
+            if self.fia.metrics is not None:
+                self.fia.metrics.observe_uart_command(command, time.perf_counter() - start)
+            return resp
+
+    async def _get(self, name):
+        if name in FIA.CACHED_STATES:
+            value = self.fia._cached_state(name)
+            if value is not None:
+                return value
+        value = await self.send_command(FIA.UART_GETTERS[name])
+        if name in FIA.CACHED_STATES:
+            self.fia._cache_state(name, value)
+        return value
+
+    def batch(self, max_in_flight = None):
+        return AsyncUARTBatch(self, self.fia._batch_max_in_flight(max_in_flight))
+
+    async def get_status(self, fields = None):
+        if fields is None:
+            fields = FIAStatus._fields[1:]
+        values = {}
+        for name in fields:
+            if name in FIA.CACHED_STATES:
+                values[name] = self.fia._cached_state(name)
+        async with self.batch() as batch:
+            results = {name: batch.get(name) for name in fields if values.get(name) is None}
+        for name, result in results.items():
+            values[name] = result.value
+            if name in FIA.CACHED_STATES:
+                self.fia._cache_state(name, values[name])
+        return FIAStatus(timestamp=time.time(), **{name: values.get(name) for name in FIAStatus._fields[1:]})
+
+    async def null_cmd(self):
+        await self.send_command('null')
+
+    async def mcu_reset(self):
+        async with self._bitmap_locked():
+            await self.send_command('mcu_reset')
+            self.fia._forget_controller_state()
+
+    async def set_backlight_state(self, state):
+        if self._emulated:
+            return self.fia.set_backlight_state(state)
+        await self.send_command('set_backlight_state', state)
+        self.fia._cache_state('backlight_state', int(bool(state)))
+
+    async def get_backlight_state(self):
+        return await self._get('backlight_state')
+
+    async def set_backlight_base_brightness(self, side_a, side_b):
+        await self.send_command('set_backlight_base_brightness', side_a, side_b)
+        self.fia._cache_state('backlight_base_brightness', (side_a, side_b))
+
+    async def get_backlight_base_brightness(self):
+        return await self._get('backlight_base_brightness')
+
+    async def get_backlight_brightness(self):
+        return await self._get('backlight_brightness')
+
+    async def get_env_brightness(self):
+        return await self._get('env_brightness')
+
+    async def set_heaters_state(self, state):
+        await self.send_command('set_heaters_state', state)
+
+    async def get_heaters_state(self):
+        return await self._get('heaters_state')
+
+    async def set_circulation_fans_state(self, state):
+        await self.send_command('set_circulation_fans_state', state)
+
+    async def get_circulation_fans_state(self):
+        return await self._get('circulation_fans_state')
+
+    async def set_heat_exchanger_fan_state(self, state):
+        await self.send_command('set_heat_exchanger_fan_state', state)
+
+    async def get_heat_exchanger_fan_state(self):
+        return await self._get('heat_exchanger_fan_state')
+
+    async def set_backlight_ballast_fans_state(self, state):
+        await self.send_command('set_backlight_ballast_fans_state', state)
+
+    async def get_backlight_ballast_fans_state(self):
+        return await self._get('backlight_ballast_fans_state')
+
+    async def get_door_states(self):
+        return await self._get('door_states')
+
+    async def get_temperatures(self):
+        return await self._get('temperatures')
+
+    async def get_humidity(self):
+        return await self._get('humidity')
+
+    async def set_lcd_contrast(self, side_a, side_b):
+        await self.send_command('set_lcd_contrast', side_a, side_b)
+        self.fia._cache_state('lcd_contrast', (side_a, side_b))
+
+    async def get_lcd_contrast(self):
+        return await self._get('lcd_contrast')
+
+    async def create_scroll_buffer(self, side, disp_x, disp_y, disp_w, disp_h, int_w, int_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y):
+        if self._emulated:
+            return self.fia.create_scroll_buffer(side, disp_x, disp_y, disp_w, disp_h, int_w, int_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y)
+        async with self._bitmap_locked():
+            buf_id = await self.send_command('create_scroll_buffer', side, disp_x, disp_y, disp_w, disp_h, int_w, int_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y)
+            return self.fia._scroll_buffer_created(buf_id)
+
+    async def delete_scroll_buffer(self, buf_id):
+        async with self._bitmap_locked():
+            ok = await self.send_command('delete_scroll_buffer', buf_id)
+            self.fia._scroll_buffer_deleted(buf_id, ok)
+        return ok
+
+    async def update_scroll_buffer(self, buf_id, side = 0xFF, disp_x = 0xFFFF, disp_y = 0xFFFF, disp_w = 0xFFFF, disp_h = 0xFFFF, sc_off_x = 0xFFFF, sc_off_y = 0xFFFF, sc_sp_x = 0xFFFF, sc_sp_y = 0xFFFF, sc_st_x = 0x7FFF, sc_st_y = 0x7FFF):
+        async with self._bitmap_locked():
+            ok = await self.send_command('update_scroll_buffer', buf_id, side, disp_x, disp_y, disp_w, disp_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y)
+            self.fia._forget_composited_digests()
+        return ok
+
+    async def set_destination_buffer(self, buf_id):
+        async with self._bitmap_locked():
+            ok = await self.send_command('set_destination_buffer', buf_id)
+            self.fia._destination_buffer_set(buf_id, ok)
+        return ok
+
+    async def get_destination_buffer(self):
+        return await self._get('destination_buffer')
+
+    @asynccontextmanager
+    async def destination(self, buf_id):
+        # Like FIA.destination(), bitmaps sent inside the block go to buf_id
+        async with self._bitmap_locked():
+            # Query the old destination and switch to the new one in one round trip
+            old_buf = self.fia._cached_state('destination_buffer')
+            async with self.batch() as batch:
+                old_result = batch.get('destination_buffer') if old_buf is None else None
+                batch.set_destination_buffer(buf_id)
+            if old_result is not None:
+                old_buf = old_result.value
+            try:
+                yield
+            finally:
+                await self.set_destination_buffer(old_buf)
+
+    async def set_mask_enabled(self, state):
+        await self.send_command('set_mask_enabled', state)
+        self.fia._cache_state('mask_enabled', int(bool(state)))
+
+    async def get_mask_enabled(self):
+        return await self._get('mask_enabled')
+
+    async def send_array(self, array, force = False):
+        if self._emulated:
+            return self.fia.send_array(array, force)
+        if not isinstance(array, bytes) and not (isinstance(array, memoryview) and array.readonly):
+            # The transfer runs in another thread, so the caller mustn't be able to change it
+            array = bytes(array)
+        digest = hashlib.blake2b(array, digest_size=16).digest()
+        async with self._bitmap_locked():
+            if self.fia._is_duplicate(array, digest, force):
+                return False
+            await asyncio.get_running_loop().run_in_executor(self._executor, self.fia.spi.writebytes2, array)
+            self.fia._frame_sent(array, digest)
+        return True
+
+    async def send_image(self, img, auto_fit = True, force = False):
+        if not isinstance(img, Image.Image):
+            img = Image.open(img)
+
+        if auto_fit:
+            img = fit_image(img, self.width, self.height)
+
+        return await self.send_array(pack_bitmap(img), force)
+
+    async def send_gif(self, img, auto_fit = True, num_loops = -1):
+        if isinstance(img, PackedAnimation):
+            animation = img
+        elif auto_fit:
+            # Decoded while playing, a few frames ahead
+            animation = StreamingAnimation(img, self.width, self.height)
+        else:
+            animation = StreamingAnimation(img)
+
+        # The frame timing is done by the regular scheduler in a worker thread,
+        # each frame is handed back to the event loop for sending
+        loop = asyncio.get_running_loop()
+        send = lambda payload: asyncio.run_coroutine_threadsafe(self.send_array(payload), loop).result()
+        scheduler = FrameScheduler(send)
+        playing = loop.run_in_executor(None, scheduler.play, animation, num_loops)
+        try:
+            # Shielded, so a cancelled task can still wait for the thread
+            return await asyncio.shield(playing)
+        finally:
+            if not playing.done():
+                # The thread mustn't keep playing or read from a closed animation
+                scheduler.stop()
+                await asyncio.wait([playing])
+            if animation is not img:
+                animation.close()
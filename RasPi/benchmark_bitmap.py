@@ -0,0 +1,96 @@
+import argparse
+import time
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+from bitmap import pack_bitmap
+
+
+def img_to_array_reference(img):
+    # The original per-pixel packing loop, kept as the reference implementation
+    pixels = img.load()
+    width, height = img.size
+
+    output = []
+
+    for x in range(width):
+        for y_byte in range(0, height, 8):
+            byte = 0x00
+            for y_bit in range(8):
+                y = y_byte + y_bit
+                state = pixels[x, y] > 64
+                if state:
+                    byte |= (1 << y_bit)
+            output.append(byte)
+
+    return output, width, height
+
+
+def generate_test_images(width, height, count):
+    rng = np.random.default_rng(0)
+    images = []
+    # Edge cases around the threshold
+    for value in (0, 64, 65, 255):
+        images.append(Image.new('L', (width, height), value))
+    # Gradient covering every grey level
+    gradient = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+    images.append(Image.fromarray(gradient))
+    # Random noise
+    for i in range(count):
+        images.append(Image.fromarray(rng.integers(0, 256, (height, width), dtype=np.uint8)))
+    return images
+
+
+def load_file_images(filename, width, height):
+    images = []
+    for frame in ImageSequence.Iterator(Image.open(filename)):
+        tmp = Image.new('L', (width, height), 'black')
+        tmp.paste(frame.convert('L'), (0, 0))
+        images.append(tmp)
+    return images
+
+
+def time_function(func, images, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        for img in images:
+            func(img)
+    return (time.perf_counter() - start) / (iterations * len(images))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify and benchmark the bitmap packer against the original per-pixel loop", add_help=False)
+    parser.add_argument('--width', '-w', required=False, type=int, default=480)
+    parser.add_argument('--height', '-h', required=False, type=int, default=128)
+    parser.add_argument('--count', '-c', required=False, type=int, default=10, help="Number of random test frames")
+    parser.add_argument('--iterations', '-i', required=False, type=int, default=3)
+    parser.add_argument('--file', '-f', required=False, type=str, help="Additional image or GIF to verify with")
+    parser.add_argument('--help', action='help', help="Display this help message")
+    args = parser.parse_args()
+
+    images = generate_test_images(args.width, args.height, args.count)
+    if args.file:
+        images += load_file_images(args.file, args.width, args.height)
+
+    print("Verifying {} frames of {}x{}...".format(len(images), args.width, args.height))
+    for i, img in enumerate(images):
+        expected = bytes(img_to_array_reference(img)[0])
+        if pack_bitmap(img) != expected:
+            print("Mismatch in frame {}".format(i))
+            return 1
+        # Alternative input types must produce the same payload
+        if pack_bitmap(np.asarray(img)) != expected or pack_bitmap(img.tobytes(), size=img.size) != expected:
+            print("Mismatch for array/buffer input in frame {}".format(i))
+            return 1
+    print("All frames match byte for byte")
+
+    t_ref = time_function(img_to_array_reference, images[:3], 1)
+    t_new = time_function(pack_bitmap, images, args.iterations)
+    print("Reference loop: {:8.3f} ms/frame".format(t_ref * 1000))
+    print("pack_bitmap:    {:8.3f} ms/frame ({:.0f}x faster)".format(t_new * 1000, t_ref / t_new))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
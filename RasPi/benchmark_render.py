@@ -0,0 +1,75 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from fia_control import FIAHeadless
+from layout_renderer import LayoutRenderer
+
+from local_settings import *
+
+
+def benchmark_layout(renderer, layout, data, count):
+    # Render and send the layout count times, returns the wall and CPU time of every run
+    wall_times = []
+    cpu_times = []
+    for i in range(count):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        renderer.display(layout, data)
+        wall_times.append(time.perf_counter() - wall_start)
+        cpu_times.append(time.process_time() - cpu_start)
+    return np.array(wall_times), np.array(cpu_times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure layout render and send throughput on a headless FIA", add_help=False)
+    parser.add_argument('--layout', '-l', required=True, type=str, nargs='+')
+    parser.add_argument('--font-dir', '-fd', required=True, type=str)
+    parser.add_argument('--data', '-d', action='append', nargs=2, metavar=("key", "value"))
+    parser.add_argument('--count', '-c', required=False, type=int, default=100, help="Renders per layout")
+    parser.add_argument('--record', required=False, type=str, help="Record the frames to a .fia file, animated image or directory")
+    parser.add_argument('--timing', required=False, type=str, help="Write the time of every frame to this CSV file")
+    parser.add_argument('--report', '-r', required=False, type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument('--help', action='help', help="Display this help message")
+    args = parser.parse_args()
+
+    data = {
+        'placeholders': dict(args.data) if args.data is not None else {}
+    }
+
+    fia = FIAHeadless(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, record=args.record, timing=args.timing)
+    renderer = LayoutRenderer(args.font_dir, fia)
+    results = []
+    try:
+        for filename in args.layout:
+            with open(filename, 'r', encoding='utf-8') as f:
+                layout = json.load(f)
+            frames_sent = fia.frames_sent
+            wall_times, cpu_times = benchmark_layout(renderer, layout, data, args.count)
+            renderer.free_scroll_buffers()
+            result = {
+                'layout': filename,
+                'renders': args.count,
+                'renders_per_s': args.count / wall_times.sum(),
+                'mean_ms': wall_times.mean() * 1000,
+                'p95_ms': np.percentile(wall_times, 95) * 1000,
+                'max_ms': wall_times.max() * 1000,
+                'cpu_mean_ms': cpu_times.mean() * 1000,
+                # Identical frames are skipped like on the hardware
+                'frames_sent': fia.frames_sent - frames_sent,
+            }
+            results.append(result)
+            print("{layout}: {renders_per_s:8.1f} renders/s, mean {mean_ms:6.2f} ms, p95 {p95_ms:6.2f} ms, max {max_ms:6.2f} ms, CPU {cpu_mean_ms:6.2f} ms, {frames_sent} frames sent".format(**result))
+    finally:
+        fia.exit()
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,145 @@
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+from animation import PackedAnimation, StreamingAnimation
+from playback import FrameScheduler, PlaybackEngine
+
+
+MODES = ('preload', 'stream')
+# FrameScheduler is used by FIA.send_gif(), PlaybackEngine by display_image.py
+PLAYERS = ('scheduler', 'engine')
+
+
+def generate_test_gif(filename, width, height, count, duration):
+    # Scrolling noise, so every frame differs and compresses about as badly as video
+    rng = np.random.default_rng(0)
+    base = rng.random((height, width * 2)) > 0.5
+    frames = [Image.fromarray(np.roll(base, -i, axis=1)[:, :width].astype(np.uint8) * 255).convert('P') for i in range(count)]
+    frames[0].save(filename, save_all=True, append_images=frames[1:], duration=duration, loop=0)
+
+
+def peak_rss_mib():
+    # ru_maxrss survives exec(), so a child would report the parent's peak,
+    # the high water mark in /proc starts over with the new program
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class SkippingClock:
+    # Monotonic clock that jumps over waits instead of sleeping,
+    # so frames go out as fast as they're available
+
+    def __init__(self):
+        self.offset = 0.0
+
+    def __call__(self):
+        return time.monotonic() + self.offset
+
+    def sleep(self, seconds):
+        if seconds:
+            self.offset += max(seconds, 0)
+
+
+class SkippingEngine(PlaybackEngine):
+    def _wait(self, timeout):
+        self.clock.sleep(timeout)
+
+
+def run_mode(mode, player, filename, width, height, prefetch, memory_budget, realtime):
+    # Play the file once in this process and measure it
+    start = time.perf_counter()
+    first_frame = []
+
+    def _send(payload):
+        if not first_frame:
+            first_frame.append(time.perf_counter() - start)
+
+    if mode == 'preload':
+        animation = PackedAnimation.from_image(filename, width, height)
+    else:
+        animation = StreamingAnimation(filename, width, height, prefetch=prefetch, memory_budget=memory_budget)
+    # Without realtime, frames go out as fast as they're available
+    if player == 'engine':
+        engine = PlaybackEngine(_send) if realtime else SkippingEngine(_send, clock=SkippingClock())
+    else:
+        clock = time.monotonic if realtime else SkippingClock()
+        engine = FrameScheduler(_send, drop_late_frames=False, clock=clock, sleep=None if realtime else clock.sleep)
+    stats = engine.play(animation)
+    frames_decoded = animation.frames_decoded if mode == 'stream' else len(animation)
+    if mode == 'stream':
+        animation.close()
+    return {
+        'mode': mode,
+        'player': player,
+        'frames_decoded': frames_decoded,
+        'frames': stats.frames_shown,
+        'time_to_first_frame_ms': first_frame[0] * 1000,
+        'total_s': time.perf_counter() - start,
+        # Only meaningful when frames are due at their real deadlines
+        'max_latency_ms': stats.max_latency * 1000 if realtime else None,
+        'peak_rss_mib': peak_rss_mib(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare time to first frame and peak memory of preloaded and streamed animation playback", add_help=False)
+    parser.add_argument('--file', '-f', required=False, type=str, default=None, help="GIF to play (defaults to a generated one)")
+    parser.add_argument('--width', '-w', required=False, type=int, default=480)
+    parser.add_argument('--height', '-h', required=False, type=int, default=128)
+    parser.add_argument('--count', '-c', required=False, type=int, default=1000, help="Frames of the generated GIF")
+    parser.add_argument('--prefetch', '-p', required=False, type=int, default=StreamingAnimation.DEFAULT_PREFETCH, help="Frames to decode ahead when streaming")
+    parser.add_argument('--memory-budget', '-m', required=False, type=int, default=StreamingAnimation.DEFAULT_MEMORY_BUDGET, help="Bytes of packed frames to keep for later loops when streaming")
+    parser.add_argument('--realtime', action='store_true', help="Play at the GIF's frame rate instead of as fast as possible")
+    parser.add_argument('--mode', required=False, choices=MODES, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--player', required=False, choices=PLAYERS, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--report', '-r', required=False, type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument('--help', action='help', help="Display this help message")
+    args = parser.parse_args()
+
+    if args.mode:
+        # Child process measuring a single mode, so the peak RSS is its own
+        print(json.dumps(run_mode(args.mode, args.player, args.file, args.width, args.height, args.prefetch, args.memory_budget, args.realtime)))
+        return 0
+
+    filename = args.file
+    if filename is None:
+        filename = "/tmp/benchmark_streaming.gif"
+        print("Generating {} frames...".format(args.count))
+        generate_test_gif(filename, args.width, args.height, args.count, 60)
+
+    results = []
+    for mode in MODES:
+        for player in PLAYERS:
+            cmd = [sys.executable, __file__, '--mode', mode, '--player', player, '--file', filename, '--width', str(args.width), '--height', str(args.height),
+                   '--prefetch', str(args.prefetch), '--memory-budget', str(args.memory_budget)]
+            if args.realtime:
+                cmd.append('--realtime')
+            result = json.loads(subprocess.run(cmd, check=True, stdout=subprocess.PIPE).stdout)
+            results.append(result)
+            line = "{mode:>8} {player:>9}: {frames} frames, {frames_decoded} decoded, first frame after {time_to_first_frame_ms:8.1f} ms, total {total_s:6.2f} s, peak RSS {peak_rss_mib:6.1f} MiB".format(**result)
+            if args.realtime:
+                line += ", max latency {:.1f} ms".format(result['max_latency_ms'])
+            print(line)
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({'file': filename, 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,62 @@
+import numpy as np
+from PIL import Image
+
+
+# Pixels brighter than this are considered "on"
+THRESHOLD = 64
+
+
+def to_pixel_array(img, size = None):
+    # Get a 2D (height, width) array of pixel values from a PIL image,
+    # a numpy array or a raw buffer of 8 bit grayscale pixels
+    if isinstance(img, Image.Image):
+        if img.mode not in ('L', '1'):
+            img = img.convert('L')
+        return np.asarray(img)
+    if isinstance(img, np.ndarray):
+        if img.ndim != 2:
+            raise ValueError("Pixel array must be two-dimensional, got shape {}".format(img.shape))
+        return img
+    if size is None:
+        raise ValueError("Raw pixel buffers need an explicit size")
+    width, height = size
+    data = np.frombuffer(img, dtype=np.uint8)
+    if data.size != width * height:
+        raise ValueError("Raw pixel buffer has {} bytes, expected {}".format(data.size, width * height))
+    return data.reshape((height, width))
+
+
+def threshold_pixels(pixels, threshold = THRESHOLD):
+    # Boolean on/off map of a pixel array
+    if pixels.dtype == np.bool_:
+        return pixels
+    return pixels > threshold
+
+
+def pack_bitmap(img, size = None, threshold = THRESHOLD):
+    # Convert an image into the bitmap format expected by the controller:
+    # Column by column, 8 vertical pixels per byte, topmost pixel in the LSB.
+    bits = threshold_pixels(to_pixel_array(img, size), threshold)
+    height, width = bits.shape
+    if height % 8:
+        # The controller rounds buffer heights up to full bytes as well
+        bits = np.pad(bits, ((0, 8 - height % 8), (0, 0)))
+    return np.packbits(bits.T, axis=1, bitorder='little').tobytes()
+
+
+def unpack_bitmap(data, width, height):
+    # Inverse of pack_bitmap, returns a (height, width) boolean array
+    h_bytes = (height + 7) // 8
+    packed = np.frombuffer(data, dtype=np.uint8, count=width * h_bytes).reshape((width, h_bytes))
+    return np.unpackbits(packed, axis=1, bitorder='little')[:, :height].T.astype(np.bool_)
+
+
+def fit_image(img, width, height):
+    # Place an image in the top left corner of a black canvas of the given size,
+    # cropping anything that doesn't fit
+    img = img.convert('L')
+    if img.size == (width, height):
+        return img
+    canvas = Image.new('L', (width, height), 'black')
+    canvas.paste(img, (0, 0))
+    return canvas
@@ -9,6 +9,7 @@ import traceback
 from deutschebahn import DBInfoscreen, DS100
 from layout_renderer import LayoutRenderer
 from fia_control import FIA, FIAEmulator
+from metrics import FIAMetrics
 from utils import TimeoutError, timeout
 
 from db_common import *
@@ -307,12 +308,14 @@ def main():
     parser.add_argument('--emulate', '-e', action='store_true', help="Run in emulation mode")
     parser.add_argument('--dbi-host', required=False, type=str, default="dbf.finalrewind.org")
     parser.add_argument('--mode', '-t', choices=('detail', 'list'), default='list', type=str)
+    parser.add_argument('--metrics-port', required=False, type=int, default=None, help="Serve Prometheus metrics on this HTTP port")
+    parser.add_argument('--metrics-file', required=False, type=str, default=None, help="Write Prometheus metrics to this file for the node_exporter textfile collector")
     args = parser.parse_args()
     
     if args.emulate:
         fia = FIAEmulator(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT)
     else:
-        fia = FIA("/dev/ttyAMA1", (3, 0), width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT)
+        fia = FIA("/dev/ttyAMA1", (3, 0), width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, state_cache=True)
 
     if BL_AUX_IN_1_ENABLED:
         time.sleep(3)
@@ -323,6 +326,15 @@ def main():
     
     renderer = LayoutRenderer(args.font_dir, fia=fia)
     
+    if args.metrics_port is not None or args.metrics_file:
+        metrics = FIAMetrics()
+        metrics.attach_fia(fia)
+        metrics.attach_renderer(renderer)
+        if args.metrics_port is not None:
+            metrics.registry.start_http_server(args.metrics_port)
+        if args.metrics_file:
+            metrics.registry.start_textfile_writer(args.metrics_file)
+    
     dbi = DBInfoscreen(args.dbi_host)
     ds100 = DS100()
 
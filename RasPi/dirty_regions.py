@@ -0,0 +1,220 @@
+import time
+
+import numpy as np
+from PIL import Image
+
+from bitmap import fit_image, pack_bitmap
+from fia_control import FIA, FIAError, DEFAULT_SPI_CLOCK
+
+
+class DirtyRegionUpdater:
+    # Sends only the parts of a frame that changed since the last one.
+    #
+    # Changed bytes are merged into a few rectangles (byte aligned vertically,
+    # since one byte holds 8 pixels of a column). Each rectangle is uploaded
+    # into one of a pool of scroll buffers with speed 0 ("windows"), which the
+    # controller then draws over the static buffer at the rectangle's position.
+    # After the controller has drawn a window at least once it's parked
+    # (side 0, not drawn anymore). The static buffer keeps its content, so
+    # the windows are free for the next update.
+    #
+    # A full frame is sent instead if nothing is known about the display yet,
+    # the change is too large for this to pay off, or there aren't enough
+    # windows (including when the controller has no memory or slots left).
+    #
+    # Windows are drawn into the dynamic buffer while the mask is enabled,
+    # so this only works with the mask disabled. All frames for the side
+    # have to go through the same DirtyRegionUpdater.
+
+    # Time the controller needs to draw an activated window at least once
+    SETTLE_TIME = 0.02
+
+    # Estimated UART time per rectangle for switching the destination
+    # and activating the window, compared against SPI transfer time
+    RECT_OVERHEAD = 0.005
+
+    # More separate changes than this aren't worth merging, send a full frame
+    MAX_CANDIDATES = 32
+
+    def __init__(self, fia, side = FIA.SIDE_BOTH, pool_size = 4, max_ratio = 0.5, merge_gap = 8, rect_overhead = RECT_OVERHEAD):
+        # max_ratio is the share of the full frame time above which a full
+        # frame is sent, merge_gap the largest gap in pixels between two
+        # changed areas in a row that's uploaded along with them.
+        self.fia = fia
+        self.side = side
+        self.pool_size = pool_size
+        self.max_ratio = max_ratio
+        self.merge_gap = merge_gap
+        self.rect_overhead = rect_overhead
+        self.width = fia.width
+        self.h_bytes = (fia.height + 7) // 8
+        self.frame_size = self.width * self.h_bytes
+        self.windows = []
+        self._pool_exhausted = False
+        self._active = []
+        self._activated_at = 0
+        self.last_frame = None
+        self.full_frames = 0
+        self.partial_frames = 0
+        self.rects_sent = 0
+        self.bytes_sent = 0
+
+    @property
+    def byte_time(self):
+        spi = getattr(self.fia, 'spi', None)
+        return 8 / (getattr(spi, 'max_speed_hz', None) or DEFAULT_SPI_CLOCK)
+
+    def invalidate(self):
+        # Call after the controller was reset, the windows are gone
+        # and the display content is unknown
+        self.windows = []
+        self._active = []
+        self._pool_exhausted = False
+        self.last_frame = None
+
+    def forget_frame(self):
+        # Call before sending anything to the display without this updater,
+        # the next frame is sent in full then
+        with self.fia.bitmap_lock:
+            self._park()
+            self.last_frame = None
+
+    def send_image(self, img, auto_fit = True, force = False):
+        if not isinstance(img, Image.Image):
+            img = Image.open(img)
+
+        if auto_fit:
+            img = fit_image(img, self.fia.width, self.fia.height)
+
+        return self.send_array(pack_bitmap(img), force)
+
+    def send_array(self, array, force = False):
+        # Update the display to show the packed bitmap array.
+        # Returns whether anything was sent.
+        frame = np.frombuffer(bytes(array), dtype=np.uint8)
+        if len(frame) != self.frame_size:
+            raise FIAError("Frame has {} bytes instead of {}".format(len(frame), self.frame_size))
+        with self.fia.bitmap_lock:
+            rects = None
+            if not force and self.last_frame is not None:
+                changed = (frame != self.last_frame).reshape((self.width, self.h_bytes))
+                if not changed.any():
+                    return False
+                rects = self._plan(self.find_rects(changed))
+            self._park()
+            if rects is None:
+                self._send_full(frame, force)
+            else:
+                self._send_rects(frame, rects)
+            self.last_frame = frame.copy()
+        return True
+
+    def _rect_time(self, rect):
+        # Transfer time of a rectangle (x0, x1, row0, row1), rows are bytes.
+        # Windows are full height, so every column but the last one is sent completely.
+        x0, x1, r0, r1 = rect
+        return ((x1 - x0 - 1) * self.h_bytes + r1 - r0) * self.byte_time + self.rect_overhead
+
+    def find_rects(self, changed):
+        # Cover the changed (columns, byte rows) cells with a few rectangles,
+        # returns None if there are too many separate changes
+        rects = []
+        for row in range(self.h_bytes):
+            cols = np.flatnonzero(changed[:, row])
+            if not len(cols):
+                continue
+            splits = np.flatnonzero(np.diff(cols) > self.merge_gap) + 1
+            for run in np.split(cols, splits):
+                rects.append((int(run[0]), int(run[-1]) + 1, row, row + 1))
+            if len(rects) > self.MAX_CANDIDATES:
+                return None
+        return self._merge(rects)
+
+    def _merge(self, rects):
+        # Greedily merge the pair that saves the most time, and keep merging
+        # past the break-even point while there are more rectangles than windows
+        while len(rects) > 1:
+            best = None
+            for i in range(len(rects)):
+                for j in range(i + 1, len(rects)):
+                    a, b = rects[i], rects[j]
+                    union = (min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3]))
+                    gain = self._rect_time(a) + self._rect_time(b) - self._rect_time(union)
+                    if best is None or gain > best[0]:
+                        best = (gain, i, j, union)
+            gain, i, j, union = best
+            if gain < 0 and len(rects) <= self.pool_size:
+                break
+            rects = [rect for k, rect in enumerate(rects) if k not in (i, j)] + [union]
+        return rects
+
+    def _plan(self, rects):
+        # The rectangles to send, or None for a full frame
+        if rects is None:
+            return None
+        full_time = self.frame_size * self.byte_time
+        if sum(self._rect_time(rect) for rect in rects) > full_time * self.max_ratio:
+            return None
+        if not self._allocate_windows(len(rects)):
+            return None
+        return rects
+
+    def _allocate_windows(self, count):
+        # Make sure there are at least count windows
+        while len(self.windows) < count and len(self.windows) < self.pool_size and not self._pool_exhausted:
+            try:
+                # Full frame sized and parked, it's moved and sized when used
+                self.windows.append(self.fia.create_scroll_buffer(0, 0, 0, self.fia.width, self.fia.height, self.fia.width, self.fia.height, 0, 0, 0, 0, 0, 0))
+            except FIAError:
+                # Out of slots or memory, the rest of the display needs them more
+                self._pool_exhausted = True
+        return len(self.windows) >= count
+
+    def _park(self):
+        # Stop drawing the windows of the last update, once they're in the static buffer
+        if not self._active:
+            return
+        remaining = self._activated_at + self.SETTLE_TIME - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        with self.fia.batch() as batch:
+            for buf_id in self._active:
+                batch.update_scroll_buffer(buf_id, side=0)
+        self._active = []
+
+    def _send_full(self, frame, force):
+        if self.fia.destination_buffer != self.side:
+            self.fia.set_destination_buffer(self.side)
+        self.fia.send_array(frame.tobytes(), force)
+        self.full_frames += 1
+        self.bytes_sent += len(frame)
+
+    def _send_rects(self, frame, rects):
+        columns = frame.reshape((self.width, self.h_bytes))
+        for buf_id, (x0, x1, r0, r1) in zip(self.windows, rects):
+            # The rectangle goes to the top left of the window, nothing
+            # after its last byte has to be sent
+            payload = np.zeros((x1 - x0, self.h_bytes), dtype=np.uint8)
+            payload[:, :r1 - r0] = columns[x0:x1, r0:r1]
+            data = payload.ravel()[:(x1 - x0 - 1) * self.h_bytes + r1 - r0].tobytes()
+            self.fia.set_destination_buffer(buf_id)
+            self.fia.send_array(data)
+            self.bytes_sent += len(data)
+        with self.fia.batch() as batch:
+            batch.set_destination_buffer(self.side)
+            for buf_id, (x0, x1, r0, r1) in zip(self.windows, rects):
+                batch.update_scroll_buffer(buf_id, self.side, x0, r0 * 8, x1 - x0, (r1 - r0) * 8, 0, 0, 0, 0, 0, 0)
+        self._active = self.windows[:len(rects)]
+        self._activated_at = time.monotonic()
+        self.partial_frames += 1
+        self.rects_sent += len(rects)
+
+    def close(self):
+        # Free the windows on the controller
+        with self.fia.bitmap_lock:
+            self._park()
+            if self.fia.destination_buffer in self.windows:
+                self.fia.set_destination_buffer(self.side)
+            for buf_id in self.windows:
+                self.fia.delete_scroll_buffer(buf_id)
+            self.windows = []
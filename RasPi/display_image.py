@@ -1,11 +1,13 @@
 import argparse
 import datetime
-import math
 import sys
 import time
-from PIL import Image, ImageSequence
+from PIL import Image
 
+from animation import FILE_EXTENSION, PackedAnimation, StreamingAnimation, load_animation
 from fia_control import FIA, FIAEmulator
+from fia_daemon import RemoteFIA
+from playback import PlaybackEngine
 
 from local_settings import *
 
@@ -29,33 +31,39 @@ def pos_nonzero_int_or_neg1(value):
     return ivalue
 
 
-def display_image(fia, filename, width = None, height = None, interval = None, countdown = False, loop_count = 1, output = False):
+def display_image(fia, filename, width = None, height = None, interval = None, countdown = False, loop_count = 1, output = False, start_frame = 0, report = None):
     def _print(*args, **kwargs):
         if output:
             print(*args, **kwargs)
 
-    _print("Loading image...")
-    img = Image.open(filename)
-    in_width, in_height = img.size
+    # Animations opened here are closed again at the end
+    opened = None
+    if isinstance(filename, PackedAnimation):
+        animation = filename
+        in_width, in_height = animation.width, animation.height
+    elif filename.lower().endswith(FILE_EXTENSION):
+        # Already packed, the frames are mapped instead of loaded
+        animation = opened = load_animation(filename, fia.width, fia.height)
+        in_width, in_height = animation.width, animation.height
+        # Its frames keep the durations they were packed with
+        interval = None
+    else:
+        _print("Loading image...")
+        img = Image.open(filename)
+        in_width, in_height = img.size
+        
+        # Frames are decoded in the background while playing
+        crop = (width, height) if width and height else None
+        animation = opened = StreamingAnimation(img, fia.width, fia.height, interval=interval, crop=crop)
+    frame_count = len(animation)
     if interval is not None:
         frame_interval = interval
     else:
-        frame_interval = img.info.get('duration', 1000)
+        frame_interval = animation.total_duration / frame_count
     frame_interval /= 1000
     
-    _print("Loading frames...")
-    frames = []
-    if width and height:
-        for frame in ImageSequence.Iterator(img):
-            temp = Image.new('L', (width, height))
-            temp.paste(frame, (0, 0))
-            frames.append(temp)
-    else:
-        for frame in ImageSequence.Iterator(img):
-            frames.append(frame.convert('L'))
-    frame_count = len(frames)
-    
-    duration = datetime.timedelta(seconds=math.ceil(frame_count * frame_interval))
+    duration = datetime.timedelta(milliseconds=animation.total_duration)
+    duration -= datetime.timedelta(microseconds=duration.microseconds)
     _print("Input: {width}x{height}, {fps:.2f} fps, {count} frames, duration {duration}".format(width=in_width, height=in_height, fps=1/frame_interval, count=frame_count, duration=duration))
     
     if countdown:
@@ -72,65 +80,49 @@ def display_image(fia, filename, width = None, height = None, interval = None, c
         sys.stdout.write("Starting!\n")
         sys.stdout.flush()
     
-    last_frame_time = time.time() - frame_interval
-    cur_frame = 0
-    loop_dropped = 0
-    total_dropped = 0
-    loop_desync = 0.0
-    total_desync = 0.0
-    next_frame_interval = frame_interval
-    repeat = True
-    i_loop = 0
-    while repeat:
-        now = time.time()
-        diff = now - last_frame_time
-        if diff >= next_frame_interval:
-            timestamp = datetime.timedelta(milliseconds=cur_frame * frame_interval * 1000)
-            timestamp -= datetime.timedelta(microseconds=timestamp.microseconds)
-            if output:
-                sys.stdout.write("\rFrame {frame:>6} of {count:>6} ({timestamp}), took {diff:>5.3f}s, target {interval:>5.3f}s, loop desync {loop_desync:>8.3f}s (dropped: {loop_dropped:>6}), total desync {total_desync:>8.3f}s (dropped: {total_dropped:>6})".format(frame=cur_frame+1, timestamp=timestamp, count=frame_count, diff=diff, interval=next_frame_interval, loop_desync=loop_desync, loop_dropped=loop_dropped, total_desync=total_desync, total_dropped=total_dropped))
-                sys.stdout.flush()
-            fia.send_image(frames[cur_frame])
-            last_frame_time = now
-            cur_frame += 1
-            loop_desync += diff - frame_interval
-            total_desync += diff - frame_interval
-            if loop_desync >= frame_interval:
-                # Drop a frame when we are desynced by more than one frame
-                cur_frame += 1
-                loop_desync -= frame_interval
-                total_desync -= frame_interval
-                loop_dropped += 1
-                total_dropped += 1
-            next_frame_interval = max(0, frame_interval - loop_desync)
-            if cur_frame >= len(frames):
-                i_loop += 1
-                cur_frame = 0
-                loop_desync = 0.0
-                loop_dropped = 0
-                if i_loop >= loop_count and loop_count != -1:
-                    repeat = False
+    def _on_frame(index, stats):
+        timestamp = datetime.timedelta(milliseconds=index * frame_interval * 1000)
+        timestamp -= datetime.timedelta(microseconds=timestamp.microseconds)
+        sys.stdout.write("\rFrame {frame:>6} of {count:>6} ({timestamp}), latency {latency:>7.1f} ms, jitter {jitter:>6.1f} ms, {fps:>6.2f} fps (dropped: {dropped:>6})".format(frame=index+1, timestamp=timestamp, count=frame_count, latency=stats.last_latency*1000, jitter=stats.jitter*1000, fps=stats.frames_shown/max(time.monotonic()-stats.start_time, 1e-9), dropped=stats.frames_dropped))
+        sys.stdout.flush()
+    
+    engine = PlaybackEngine(fia.send_array, on_frame=_on_frame if output else None)
+    try:
+        stats = engine.play(animation, num_loops=loop_count, start_index=start_frame)
+    finally:
+        if opened is not None:
+            opened.close()
+    _print("")
+    _print("Done: {}".format(stats))
+    if report:
+        stats.write_report(report, file=str(filename), frame_count=frame_count, loop_count=loop_count)
+    return stats
 
 
 def main():
     parser = argparse.ArgumentParser(description="This script can show an image or animation on the display.", add_help=False)
-    parser.add_argument('--file', '-f', required=True, type=str, help="Input file to display (static image or GIF)")
+    parser.add_argument('--file', '-f', required=True, type=str, help="Input file to display (static image, GIF or .fia file from pack_animation.py)")
     parser.add_argument('--width', '-w', required=False, default=None, type=pos_nonzero_int, help="Width to crop input to")
     parser.add_argument('--height', '-h', required=False, default=None, type=pos_nonzero_int, help="Height to crop input to")
-    parser.add_argument('--interval', '-i', required=False, default=None, type=pos_nonzero_int, help="Interval between frames in ms (defaults to GIF's setting or one second)")
+    parser.add_argument('--interval', '-i', required=False, default=None, type=pos_nonzero_int, help="Interval between frames in ms (defaults to GIF's setting or one second, not used for .fia files)")
     parser.add_argument('--countdown', '-c', action='store_true', help="If set, do an interactive countdown before starting to help with manually syncing video and audio")
     parser.add_argument('--loop-count', '-lc', required=False, default=1, type=pos_nonzero_int_or_neg1, help="Number of loops to run. Defaults to 1. Positive integer or -1 for infinite loop.")
+    parser.add_argument('--start-frame', '-sf', required=False, default=0, type=int, help="Frame index to start playback at")
+    parser.add_argument('--report', '-r', required=False, default=None, type=str, help="Write a JSON timing report to this file")
     parser.add_argument('--emulate', '-e', action='store_true', help="Run in emulation mode")
+    parser.add_argument('--remote', required=False, default=None, type=str, help="Use the display daemon at this address instead of the hardware")
     parser.add_argument('--help', action='help', help="Display this help message")
     args = parser.parse_args()
     
-    if args.emulate:
+    if args.remote:
+        fia = RemoteFIA(args.remote)
+    elif args.emulate:
         fia = FIAEmulator(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT)
     else:
         fia = FIA("/dev/ttyAMA1", (3, 0), width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT)
 
     try:
-        display_image(fia, args.file, width=args.width, height=args.height, interval=args.interval, countdown=args.countdown, loop_count=args.loop_count, output=True)
+        display_image(fia, args.file, width=args.width, height=args.height, interval=args.interval, countdown=args.countdown, loop_count=args.loop_count, output=True, start_frame=args.start_frame, report=args.report)
     except KeyboardInterrupt:
         print("")
         fia.exit()
@@ -3,6 +3,7 @@ import random
 import time
 import traceback
 
+from animation import PackedAnimation
 from layout_renderer import LayoutRenderer
 from fia_control import FIA
 
@@ -17,6 +18,8 @@ def main():
     with open("layouts/info_text_4x2_single_dm_moba.json", 'r') as f:
         layout_info = json.load(f)
     
+    animation = PackedAnimation.from_image("images/dm_moba_fia_anim.gif", fia.width, fia.height)
+    
     print("Starting")
     print("Deleting all scroll buffers")
     for i in range(20):
@@ -60,7 +63,8 @@ def main():
             
             print("Showing animation")
             renderer.free_scroll_buffers()
-            fia.send_gif("images/dm_moba_fia_anim.gif", num_loops=1) # ~5 seconds
+            stats = fia.send_gif(animation, num_loops=1) # ~5 seconds
+            print("Animation: {}".format(stats))
             
             print("Showing info text (German)")
             data = {
@@ -84,7 +88,8 @@ def main():
             
             print("Showing animation")
             renderer.free_scroll_buffers()
-            fia.send_gif("images/dm_moba_fia_anim.gif", num_loops=1) # ~5 seconds
+            stats = fia.send_gif(animation, num_loops=1) # ~5 seconds
+            print("Animation: {}".format(stats))
         except KeyboardInterrupt:
             return
         except:
@@ -14,8 +14,9 @@ from pyquery import PyQuery as pq
 from urllib.parse import urlparse
 from deutschebahn import DBInfoscreen, DS100
 
+from animation import pack_frame
 from layout_renderer import LayoutRenderer
-from fia_control import FIA, FIAEmulator
+from fia_control import FIA, FIAEmulator, FIAHeadless
 from display_image import display_image
 from utils import TimeoutError, timeout
 from db_live_departures import show_departures
@@ -23,6 +24,10 @@ from db_live_departures import show_departures
 from local_settings import *
 
 
+# Filename -> (modification time, packed first frame)
+IMAGE_CACHE = {}
+
+
 def static_app(fia, renderer, config):
     pages = config.get('pages', [])
     loop_count = config.get('loop_count', 1)
@@ -43,19 +48,22 @@ def static_app(fia, renderer, config):
             elif page_type == 'image':
                 filename = page.get('file')
                 if filename:
-                    img = Image.open(filename).convert('L')
-                    if img.size != (DISPLAY_WIDTH, DISPLAY_HEIGHT):
-                        dest_img = Image.new('L', (DISPLAY_WIDTH, DISPLAY_HEIGHT), 'black')
-                        img = img.crop((0, 0, DISPLAY_WIDTH, DISPLAY_HEIGHT))
-                        dest_img.paste(img, (0, 0))
-                        fia.send_image(dest_img)
-                    else:
-                        fia.send_image(img)
+                    # Pack each image only once and reuse it on every loop,
+                    # until the file changes
+                    mtime = os.path.getmtime(filename)
+                    cached = IMAGE_CACHE.get(filename)
+                    if cached is None or cached[0] != mtime:
+                        with Image.open(filename) as img:
+                            cached = (mtime, pack_frame(img, DISPLAY_WIDTH, DISPLAY_HEIGHT))
+                        IMAGE_CACHE[filename] = cached
+                    renderer.forget_frame()
+                    fia.send_array(cached[1])
             elif page_type == 'video':
                 filename = page.get('file')
                 loop_count = page.get('loop_count', 1)
                 interval = page.get('interval')
                 if filename:
+                    renderer.forget_frame()
                     display_image(fia, filename, width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, interval=interval, countdown=False, loop_count=loop_count, output=False)
 
             time.sleep(page.get('duration', 1))
@@ -388,14 +396,26 @@ def main():
     parser.add_argument('--config', '-c', required=True, type=str)
     parser.add_argument('--font-dir', '-fd', required=True, type=str)
     parser.add_argument('-e', '--emulate', action='store_true', help="Run in emulation mode")
+    parser.add_argument('--headless', action='store_true', help="Emulate without a window")
+    parser.add_argument('--record', required=False, type=str, help="Record the emulated display to a .fia file, animated image or directory")
+    parser.add_argument('--timing', required=False, type=str, help="Write the time of every emulated frame to this CSV file")
+    parser.add_argument('--web-port', required=False, type=int, help="Serve the web interface with a live view of the display on this port")
+    parser.add_argument('--dirty-regions', action='store_true', help="Only send the parts of layouts that changed (needs the mask disabled)")
     args = parser.parse_args()
     
-    if args.emulate:
-        fia = FIAEmulator(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT)
+    if args.headless:
+        fia = FIAHeadless(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, record=args.record, timing=args.timing)
+    elif args.emulate:
+        fia = FIAEmulator(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, record=args.record, timing=args.timing)
     else:
         fia = FIA("/dev/ttyAMA1", (3, 0), width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT)
     
-    renderer = LayoutRenderer(args.font_dir, fia=fia)
+    if args.web_port:
+        # The live view needs the web app in this process
+        from wsgi import serve_in_background
+        serve_in_background(fia, args.web_port)
+    
+    renderer = LayoutRenderer(args.font_dir, fia=fia, dirty_regions=args.dirty_regions)
     
     socket.setdefaulttimeout(10.0)
     
@@ -437,6 +457,8 @@ def main():
                 elif app_type == 'db_departures':
                     show_departures(dbi, ds100, fia, renderer, app_config, auto_clear_scroll_buf=True)
             except KeyboardInterrupt:
+                # Finishes recordings of the emulated display
+                fia.exit()
                 return
             except:
                 traceback.print_exc()
@@ -0,0 +1,84 @@
+import random
+import time
+
+
+class SpiDev:
+    # Stand-in for spidev.SpiDev on machines without the hardware.
+    # Transfers take about as long as they would on the wire. Above
+    # max_reliable_hz, bits get flipped to mimic a marginal link.
+    # Every transfer is passed to on_transfer(data) as it arrived.
+
+    def __init__(self, bus = None, device = None, max_reliable_hz = None, bit_error_rate = 1e-5, overhead = 0.0001, realtime = True, on_transfer = None, seed = 0):
+        self.max_reliable_hz = max_reliable_hz
+        self.bit_error_rate = bit_error_rate
+        self.overhead = overhead
+        self.realtime = realtime
+        self.on_transfer = on_transfer
+        self.max_speed_hz = 500000
+        self.mode = 0
+        self.bits_per_word = 8
+        self.is_open = False
+        self.transfers = 0
+        self.bytes_written = 0
+        self.last_transfer = None
+        self._random = random.Random(seed)
+        if bus is not None:
+            self.open(bus, device)
+
+    def open(self, bus, device):
+        self.bus = bus
+        self.device = device
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def transfer_time(self, length):
+        # Time the transfer of length bytes takes at the current clock
+        return self.overhead + length * 8 / self.max_speed_hz
+
+    def _corrupt(self, data):
+        if self.max_reliable_hz is None or self.max_speed_hz <= self.max_reliable_hz:
+            return data
+        # The further above the limit, the more errors
+        rate = min(self.bit_error_rate * self.max_speed_hz / self.max_reliable_hz, 1.0)
+        for i in range(self._count_errors(len(data) * 8, rate)):
+            bit = self._random.randrange(len(data) * 8)
+            data[bit // 8] ^= 1 << (bit % 8)
+        return data
+
+    def _count_errors(self, num_bits, rate):
+        # Number of flipped bits without drawing a random number per bit
+        count = 0
+        pos = 0
+        while True:
+            pos += int(self._random.expovariate(rate)) + 1
+            if pos > num_bits:
+                return count
+            count += 1
+
+    def writebytes2(self, data):
+        if not self.is_open:
+            raise OSError("SPI device not open")
+        start = time.perf_counter()
+        data = self._corrupt(bytearray(data))
+        self.transfers += 1
+        self.bytes_written += len(data)
+        self.last_transfer = bytes(data)
+        if self.on_transfer is not None:
+            self.on_transfer(self.last_transfer)
+        if self.realtime:
+            remaining = self.transfer_time(len(data)) - (time.perf_counter() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def writebytes(self, data):
+        self.writebytes2(data)
+
+    def xfer2(self, data):
+        # Nothing ever answers on MISO
+        self.writebytes2(data)
+        return [0] * len(data)
+
+    def xfer(self, data):
+        return self.xfer2(data)
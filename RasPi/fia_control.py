@@ -1,4 +1,10 @@
+import hashlib
+import json
+import struct
+from collections import namedtuple
+from contextlib import contextmanager
 import serial
+import threading
 import time
 
 # For real hardware, only available on RasPi
@@ -8,19 +14,301 @@ try:
 except ImportError:
     _HAS_SPIDEV = False
 
-from PIL import Image, ImageSequence
+from PIL import Image
 
-# For emulator
-import threading
+from animation import PackedAnimation, StreamingAnimation
+from bitmap import fit_image, pack_bitmap, unpack_bitmap
+from fia_firmware import SCROLL_TICK_RATE, FIAFirmware
+from frame_recorder import FrameRecorder
+from playback import FrameScheduler
+from uart_commands import COMMANDS, MAX_FRAME_LENGTH, checksum
+
+# For emulator, not available on headless machines
 import numpy as np
-import tkinter as tk
-from PIL import ImageTk
+try:
+    import tkinter as tk
+    from PIL import ImageTk
+    _HAS_TK = True
+except ImportError:
+    _HAS_TK = False
+
+
+# SPI settings chosen by spi_benchmark.py
+LINK_CONFIG_FILE = "dynamic_data/fia_link.json"
+DEFAULT_SPI_CLOCK = 5000000
+
+
+def load_link_config(filename = LINK_CONFIG_FILE):
+    # Only settings that were checked on the display itself are used
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if config.get('emulated') or not config.get('confirmed'):
+        return {}
+    return config
 
 
 class FIAError(Exception):
     pass
 
 
+class FIATimeoutError(FIAError):
+    pass
+
+
+class FIAChecksumError(FIAError):
+    pass
+
+
+class FIAFramingError(FIAError):
+    pass
+
+
+class SPIWriter:
+    # Pushes bitmap payloads to spidev from a dedicated thread.
+    # Each destination buffer has a mailbox of depth one: if frames come in
+    # faster than the link can take them, the stale ones are dropped.
+    
+    def __init__(self, spi):
+        self.spi = spi
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._busy = False
+        self._running = True
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="SPIWriter", daemon=True)
+        self._thread.start()
+    
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise FIAError("SPI transfer failed") from error
+    
+    def check(self):
+        # Raise the error of a failed transfer, if there was one since the last call
+        with self._cond:
+            self._raise_error()
+    
+    def submit(self, buf_id, payload):
+        with self._cond:
+            self._raise_error()
+            if not self._running:
+                raise FIAError("SPI writer is closed")
+            if buf_id in self._pending:
+                self.frames_dropped += 1
+            self._pending[buf_id] = payload
+            self._cond.notify_all()
+    
+    def flush(self, timeout = None):
+        # Wait until all pending frames are on the wire.
+        # Returns False if the timeout expired first.
+        with self._cond:
+            done = self._cond.wait_for(lambda: self._error is not None or not (self._pending or self._busy), timeout)
+            self._raise_error()
+            return done
+    
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self._cond:
+                self._running = False
+                self._cond.notify_all()
+            self._thread.join()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or not self._running)
+                if not self._pending:
+                    return
+                buf_id = next(iter(self._pending))
+                payload = self._pending.pop(buf_id)
+                self._busy = True
+            error = None
+            try:
+                self.spi.writebytes2(payload)
+            except Exception as e:
+                error = e
+            with self._cond:
+                self._busy = False
+                if error is None:
+                    self.frames_written += 1
+                else:
+                    # Reported to the caller on the next submit() or flush()
+                    self._error = error
+                    self._pending.clear()
+                self._cond.notify_all()
+
+
+# Telemetry snapshot as returned by FIA.get_status(), timestamp is time.time()
+FIAStatus = namedtuple('FIAStatus', [
+    'timestamp',
+    'temperatures',
+    'humidity',
+    'backlight_state',
+    'backlight_base_brightness',
+    'backlight_brightness',
+    'env_brightness',
+    'door_states',
+    'heaters_state',
+    'circulation_fans_state',
+    'heat_exchanger_fan_state',
+    'backlight_ballast_fans_state',
+    'lcd_contrast',
+])
+
+
+class UARTResult:
+    # Response to one command of a UARTBatch, filled in once the batch has run
+    
+    def __init__(self, command, decode = None, callback = None):
+        self.command = command
+        self.decode = decode
+        self.callback = callback
+        self.done = False
+        self.error = None
+        self._value = None
+    
+    def _set_error(self, error):
+        self.done = True
+        self.error = error
+    
+    def _set_response(self, resp):
+        self.done = True
+        try:
+            self._value = self.decode(resp) if self.decode is not None else resp
+            if self.callback is not None:
+                self.callback(self._value)
+        except (FIAError, IndexError, struct.error) as e:
+            self.error = e if isinstance(e, FIAError) else FIAFramingError("Short response to command 0x{:02X}".format(self.command))
+    
+    @property
+    def value(self):
+        if not self.done:
+            raise FIAError("UART batch has not been executed yet")
+        if self.error is not None:
+            raise self.error
+        return self._value
+
+
+class UARTBatch:
+    # Sends a series of UART commands back to back and reads the responses
+    # in order afterwards, instead of waiting for each response in turn.
+    # Usage:
+    #   with fia.batch() as b:
+    #       temps = b.get('temperatures')
+    #       b.command('set_heaters_state', 1)
+    #   print(temps.value)
+    
+    # The controller has a 256 byte receive ring buffer, don't have more
+    # than this many command bytes waiting for a response at any time.
+    # Only firmware with the back-to-back response fix in UART_TransmitResponse
+    # handles this, older firmware gets one command at a time (max_in_flight 1).
+    MAX_IN_FLIGHT = 192
+    
+    def __init__(self, fia, max_in_flight = MAX_IN_FLIGHT):
+        self.fia = fia
+        self.max_in_flight = max_in_flight
+        self.commands = []
+        self.results = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+    
+    def send(self, command, data = [], decode = None, callback = None, expect_response = True):
+        # Queue a command. decode converts the response payload into the result value,
+        # callback is called with that value once the response has arrived.
+        return self._queue(command, self.fia.build_uart_command(command, data), decode, callback, expect_response)
+    
+    def command(self, name, *args, callback = None):
+        # Queue one of the commands in uart_commands.COMMANDS,
+        # the result value is the decoded response
+        command = COMMANDS[name]
+        return self._queue(command.code, command.pack_frame(*args), command.decode, callback, command.expect_response)
+    
+    def _queue(self, command, raw_command, decode, callback, expect_response):
+        result = UARTResult(command, decode, callback)
+        self.commands.append((raw_command, expect_response))
+        self.results.append(result)
+        return result
+    
+    def get(self, name):
+        # Queue one of the getters in FIA.UART_GETTERS, e.g. get('temperatures')
+        return self.command(self.fia.UART_GETTERS[name])
+    
+    def set_destination_buffer(self, buf_id):
+        return self.command('set_destination_buffer', buf_id, callback=lambda ok: self.fia._destination_buffer_set(buf_id, ok))
+    
+    def update_scroll_buffer(self, buf_id, side = 0xFF, disp_x = 0xFFFF, disp_y = 0xFFFF, disp_w = 0xFFFF, disp_h = 0xFFFF, sc_off_x = 0xFFFF, sc_off_y = 0xFFFF, sc_sp_x = 0xFFFF, sc_sp_y = 0xFFFF, sc_st_x = 0x7FFF, sc_st_y = 0x7FFF):
+        return self.command('update_scroll_buffer', buf_id, side, disp_x, disp_y, disp_w, disp_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y, callback=lambda ok: self.fia._forget_composited_digests())
+    
+    def execute(self):
+        if any(raw[2] in self.fia.UART_CMDS_AFTER_SPI for raw, expect_response in self.commands):
+            with self.fia.bitmap_lock:
+                self.fia.flush()
+                with self.fia.uart_lock:
+                    return self._execute()
+        with self.fia.uart_lock:
+            return self._execute()
+    
+    def _execute(self):
+        self.fia.discard_uart_input()
+        pending = list(zip(self.commands, self.results))
+        in_flight = []
+        in_flight_bytes = 0
+        pos = 0
+        while pos < len(pending) or in_flight:
+            # Write as many commands as fit into the controller's buffer in one go
+            burst = bytearray()
+            sent = time.perf_counter()
+            while pos < len(pending):
+                (raw_command, expect_response), result = pending[pos]
+                # A command that doesn't fit on its own goes out alone
+                if (burst or in_flight) and in_flight_bytes + len(raw_command) > self.max_in_flight:
+                    break
+                burst += raw_command
+                pos += 1
+                if expect_response:
+                    in_flight.append((result, len(raw_command), sent))
+                    in_flight_bytes += len(raw_command)
+                else:
+                    result.done = True
+            if burst:
+                self.fia.send_uart_command_raw(burst)
+            if in_flight:
+                result, length, sent = in_flight.pop(0)
+                in_flight_bytes -= length
+                try:
+                    result._set_response(self.fia.read_uart_response())
+                    if self.fia.metrics is not None:
+                        self.fia.metrics.observe_uart_command(result.command, time.perf_counter() - sent)
+                except FIATimeoutError as e:
+                    # The responses would be out of step from here on
+                    result._set_error(e)
+                    for other, length, sent in in_flight:
+                        other._set_error(e)
+                    for command, other in pending[pos:]:
+                        other._set_error(e)
+                    break
+                except FIAError as e:
+                    result._set_error(e)
+        self.commands = []
+        return self.results
+    
+    @property
+    def errors(self):
+        return [result.error for result in self.results if result.error is not None]
+
+
 class FIA:
     SIDE_A = 0x01
     SIDE_B = 0x02
@@ -31,8 +319,8 @@ class FIA:
     BUF_DYN = 0x20
     
     SCROLL_BUF_ERR_MASK = 0x10
-    SCROLL_BUF_ERR_SIZE = 1
-    SCROLL_BUF_ERR_COUNT = 2
+    SCROLL_BUF_ERR_COUNT = 1
+    SCROLL_BUF_ERR_SIZE = 2
     
     UART_CMD_NULL = 0x00
     UART_CMD_MCU_RESET = 0x01
@@ -69,6 +357,44 @@ class FIA:
     UART_CMD_SET_MASK_ENABLED = 0x65
     UART_CMD_GET_MASK_ENABLED = 0x66
 
+    # Commands that change where or how bitmap data ends up.
+    # Frames queued for the SPI writer must be sent before these.
+    UART_CMDS_AFTER_SPI = (
+        UART_CMD_MCU_RESET,
+        UART_CMD_CREATE_SCROLL_BUFFER,
+        UART_CMD_DELETE_SCROLL_BUFFER,
+        UART_CMD_UPDATE_SCROLL_BUFFER,
+        UART_CMD_SET_DESTINATION_BUFFER,
+        UART_CMD_SET_MASK_ENABLED,
+    )
+    
+    # Values that only change when the host sets them and can be served by the
+    # state cache. The controller's climate control switches heaters and fans
+    # on its own, so those are always read from the device, like the sensors.
+    CACHED_STATES = ('backlight_state', 'backlight_base_brightness', 'lcd_contrast', 'destination_buffer', 'mask_enabled')
+    
+    # Longest response frame the controller sends, payload plus checksum
+    UART_MAX_RESPONSE_LENGTH = 27
+    
+    # Getters and their commands in uart_commands.COMMANDS,
+    # used by UARTBatch.get()
+    UART_GETTERS = {
+        'backlight_state': 'get_backlight_state',
+        'backlight_base_brightness': 'get_backlight_base_brightness',
+        'backlight_brightness': 'get_backlight_brightness',
+        'env_brightness': 'get_env_brightness',
+        'heaters_state': 'get_heaters_state',
+        'circulation_fans_state': 'get_circulation_fans_state',
+        'heat_exchanger_fan_state': 'get_heat_exchanger_fan_state',
+        'backlight_ballast_fans_state': 'get_backlight_ballast_fans_state',
+        'door_states': 'get_door_states',
+        'temperatures': 'get_temperatures',
+        'humidity': 'get_humidity',
+        'lcd_contrast': 'get_lcd_contrast',
+        'destination_buffer': 'get_destination_buffer',
+        'mask_enabled': 'get_mask_enabled',
+    }
+
     # Raspberry Pi BCM GPIO pin
     # Names as seen from the STM32
     PIN_CTRL_AUX1_OUT = 23
@@ -76,59 +402,254 @@ class FIA:
     PIN_CTRL_AUX1_IN = 17
     PIN_CTRL_AUX2_IN = 27
     
-    def __init__(self, uart_port, spi_port, uart_baud = 115200, uart_timeout = 1.0, spi_clock = 5000000, width = 480, height = 128, panel_width = 96, panel_height = 64):
-        if not _HAS_SPIDEV:
+    def __init__(self, uart_port, spi_port, uart_baud = 115200, uart_timeout = 1.0, spi_clock = None, width = 480, height = 128, panel_width = 96, panel_height = 64, async_spi = False, state_cache = False, state_cache_ttl = None, spi = None, uart_pipelining = False, frame_cache_ttl = 10.0):
+        # spi_clock None uses the clock from LINK_CONFIG_FILE if there is one.
+        # spi can be an already opened SPI device (e.g. fake_spidev.SpiDev),
+        # spi_port is ignored then.
+        # uart_pipelining lets batches have several commands in flight,
+        # this needs the controller to be flashed with the current firmware.
+        # frame_cache_ttl is how long in seconds a frame is skipped as a duplicate
+        # of the last one, so a reset we didn't cause (watchdog, brownout)
+        # doesn't leave the display blank for good. None skips them forever.
+        if spi is None and not _HAS_SPIDEV:
             raise RuntimeError("spidev module not installed. If you are running this on a PC, use FIAEmulator instead.")
         self.uart = serial.Serial(uart_port, baudrate=uart_baud, timeout=uart_timeout)
-        self.spi = spidev.SpiDev()
-        self.spi.open(*spi_port)
+        if spi is None:
+            spi = spidev.SpiDev()
+            spi.open(*spi_port)
+        self.spi = spi
+        if spi_clock is None:
+            spi_clock = load_link_config().get('spi_clock', DEFAULT_SPI_CLOCK)
         self.spi.max_speed_hz = spi_clock
         self.width = width
         self.height = height
         self.panel_width = panel_width
         self.panel_height = panel_height
+        self._init_transfer_state()
+        self.uart_pipelining = uart_pipelining
+        self.frame_cache_ttl = frame_cache_ttl
+        if async_spi:
+            self.start_spi_writer()
+        if state_cache:
+            self.enable_state_cache(state_cache_ttl)
+    
+    def _init_transfer_state(self):
+        # Held for a whole command/response transaction
+        self.uart_lock = threading.RLock()
+        # Held while the destination buffer or the bitmap data is changed,
+        # so a sequence like set destination + upload can't be interleaved.
+        # Take this one first if you need both.
+        self.bitmap_lock = threading.RLock()
+        # Destination buffer as last set by us, None if unknown
+        self.destination_buffer = None
+        # (digest, time sent) of the last payload sent to each destination buffer
+        self._sent_digests = {}
+        # Age after which an identical payload is sent again, None for never
+        self.frame_cache_ttl = None
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.bytes_sent = 0
+        self.bytes_skipped = 0
+        # Background SPI writer, None for synchronous transfers
+        self.spi_writer = None
+        # Mirror of host controlled device state, see enable_state_cache()
+        self.state_cache_enabled = False
+        self.state_cache_ttl = None
+        self._state_cache = {}
+        self.state_cache_hits = 0
+        # Received UART bytes that haven't been parsed yet
+        self._rx_buf = bytearray()
+        self.uart_bytes_in = 0
+        self.uart_bytes_out = 0
+        self.uart_crc_errors = 0
+        self.uart_timeouts = 0
+        self.uart_resyncs = 0
+        # Command frames are built in here, see send_command()
+        self._tx_frame = bytearray(MAX_FRAME_LENGTH)
+        self._tx_view = memoryview(self._tx_frame)
+        # Scroll buffers created by us and not deleted yet
+        self.scroll_buffer_ids = set()
+        # Several commands in flight per batch, see UARTBatch
+        self.uart_pipelining = False
+        # Instrumentation hooks, see metrics.FIAMetrics
+        self.metrics = None
+        # Live view of the display, see frame_broadcaster.FrameBroadcaster
+        self.broadcaster = None
+    
+    def enable_state_cache(self, ttl = None):
+        # Answer getters for values only the host changes (CACHED_STATES)
+        # from what was last set or read instead of asking the controller.
+        # ttl is the time in seconds after which a cached value is read again,
+        # None keeps values until mcu_reset() or invalidate_state_cache().
+        self.state_cache_enabled = True
+        self.state_cache_ttl = ttl
+    
+    def invalidate_state_cache(self):
+        self._state_cache.clear()
+    
+    def _cached_state(self, name):
+        # Cached value or None if there is none (or it's too old)
+        if not self.state_cache_enabled or name not in self._state_cache:
+            return None
+        value, timestamp = self._state_cache[name]
+        if self.state_cache_ttl is not None and time.monotonic() - timestamp > self.state_cache_ttl:
+            del self._state_cache[name]
+            return None
+        self.state_cache_hits += 1
+        return value
+    
+    def _cache_state(self, name, value):
+        if self.state_cache_enabled:
+            self._state_cache[name] = (value, time.monotonic())
+    
+    def _get_state(self, name):
+        # Getter for one of the CACHED_STATES
+        value = self._cached_state(name)
+        if value is None:
+            value = self.send_command(self.UART_GETTERS[name])
+            self._cache_state(name, value)
+        return value
+    
+    def start_spi_writer(self):
+        # Let send_array() return right away and transfer the frames
+        # from a separate thread, so rendering and SPI transfer overlap
+        if self.spi_writer is None:
+            self.spi_writer = SPIWriter(self.spi)
+    
+    def flush(self, timeout = None):
+        # Wait for all queued frames to be transferred
+        if self.spi_writer is None:
+            return True
+        with self._spi_writer_errors():
+            return self.spi_writer.flush(timeout)
+    
+    @contextmanager
+    def _spi_writer_errors(self):
+        # The writer drops its queue when a transfer fails, so we don't know
+        # which payloads made it to the controller anymore
+        try:
+            yield
+        except FIAError:
+            self._sent_digests.clear()
+            raise
     
     def exit(self):
-        pass
+        if self.spi_writer is not None:
+            self.spi_writer.close()
+            self.spi_writer = None
     
     def send_uart_command_raw(self, raw_command):
         # Just send a raw UART command
         self.uart.write(bytearray(raw_command))
+        self.uart_bytes_out += len(raw_command)
+    
+    def discard_uart_input(self):
+        # Drop anything left over from earlier commands, like a response
+        # that only arrived after its command had timed out
+        stale = len(self._rx_buf) + self.uart.in_waiting
+        if stale:
+            self.uart.reset_input_buffer()
+            self._rx_buf.clear()
+            self.uart_resyncs += 1
     
     def calculate_uart_checksum(self, data):
-        checksum = 0x7F
-        for byte in data:
-            checksum ^= byte
-        return checksum
+        return checksum(data)
+    
+    def _parse_uart_response(self):
+        # Try to take one response frame from the receive buffer.
+        # Returns the payload, or the number of bytes still missing.
+        buf = self._rx_buf
+        while buf:
+            if buf[0] == 0xFF:
+                if len(buf) < 2 or 0 < buf[1] <= self.UART_MAX_RESPONSE_LENGTH:
+                    break
+                # Impossible length, so this wasn't a real start byte
+                start = buf.find(0xFF, 1)
+            else:
+                start = buf.find(0xFF)
+            # Skip garbage up to the next start byte
+            del buf[:len(buf) if start < 0 else start]
+            self.uart_resyncs += 1
+        if len(buf) < 2:
+            return 2 - len(buf)
+        length = buf[1]
+        if len(buf) < length + 2:
+            return length + 2 - len(buf)
+        frame = memoryview(buf)[2:length + 2]
+        payload = bytearray(frame[:-1])
+        valid = frame[-1] == self.calculate_uart_checksum(payload)
+        frame.release()
+        del buf[:length + 2]
+        if not valid:
+            self.uart_crc_errors += 1
+            raise FIAChecksumError("Response checksum mismatch")
+        return payload
     
     def read_uart_response(self):
-        header = self.uart.read(2)
-        if header[0] != 0xFF:
-            return None
-        length = header[1]
-        payload = self.uart.read(length)
-        if len(payload) != length:
-            print("err len")
-            return None
-        checksum = payload[-1]
-        if checksum != self.calculate_uart_checksum(payload[:-1]):
-            print("err chk")
-            return None
-        #print(header + payload)
-        return bytearray(payload[:-1])
+        # Read the next response frame and return its payload
+        deadline = time.monotonic() + (self.uart.timeout or 0)
+        while True:
+            result = self._parse_uart_response()
+            if not isinstance(result, int):
+                return result
+            if time.monotonic() > deadline:
+                self.uart_timeouts += 1
+                raise FIATimeoutError("No response from controller")
+            data = self.uart.read(max(result, self.uart.in_waiting))
+            self._rx_buf += data
+            self.uart_bytes_in += len(data)
     
-    def send_uart_command(self, command, data = [], expect_response = True):
-        # Send UART command and return response
+    def build_uart_command(self, command, data = []):
         assert len(data) <= 254
         raw_command = [0xFF, len(data) + 2, command]
         raw_command += data
         checksum = self.calculate_uart_checksum([command] + data)
         raw_command.append(checksum)
-        self.send_uart_command_raw(raw_command)
-        if expect_response:
-            return self.read_uart_response()
-        else:
+        return bytearray(raw_command)
+    
+    def send_uart_command(self, command, data = [], expect_response = True):
+        # Send UART command and return response
+        if command in self.UART_CMDS_AFTER_SPI:
+            with self.bitmap_lock:
+                # Queued frames must reach the buffer they were meant for
+                self.flush()
+                return self._uart_transaction(command, self.build_uart_command(command, data), expect_response)
+        return self._uart_transaction(command, self.build_uart_command(command, data), expect_response)
+    
+    def send_command(self, name, *args):
+        # Send one of the commands in uart_commands.COMMANDS, e.g.
+        # send_command('set_lcd_contrast', 2000, 2000), and return the decoded response
+        command = COMMANDS[name]
+        if command.code in self.UART_CMDS_AFTER_SPI:
+            with self.bitmap_lock:
+                self.flush()
+                return self._command_transaction(command, args)
+        return self._command_transaction(command, args)
+    
+    def _command_transaction(self, command, args):
+        with self.uart_lock:
+            # The frame buffer is only used while holding the lock
+            length = command.pack_frame_into(self._tx_frame, 0, *args)
+            resp = self._uart_transaction(command.code, self._tx_view[:length], command.expect_response)
+        if resp is None:
             return None
+        try:
+            return command.decode(resp)
+        except struct.error:
+            raise FIAFramingError("Short response to command 0x{:02X}".format(command.code))
+    
+    def _uart_transaction(self, command, raw_command, expect_response):
+        with self.uart_lock:
+            start = time.perf_counter()
+            self.discard_uart_input()
+            self.send_uart_command_raw(raw_command)
+            if expect_response:
+                resp = self.read_uart_response()
+            else:
+                resp = None
+            if self.metrics is not None:
+                self.metrics.observe_uart_command(command, time.perf_counter() - start)
+            return resp
     
     def twos_comp(self, val, bits):
         if val < 0:
@@ -142,312 +663,546 @@ class FIA:
         else:
             return val
     
+    def batch(self, max_in_flight = None):
+        # Pipeline several commands, see UARTBatch.
+        # Without uart_pipelining they are still sent one at a time.
+        return UARTBatch(self, self._batch_max_in_flight(max_in_flight))
+    
+    def _batch_max_in_flight(self, max_in_flight):
+        if max_in_flight is not None:
+            return max_in_flight
+        return UARTBatch.MAX_IN_FLIGHT if self.uart_pipelining else 1
+    
+    def get_status(self, fields = None):
+        # Read all telemetry values (or only the given FIAStatus fields)
+        # in one pipelined batch. Fields that weren't requested are None.
+        if fields is None:
+            fields = FIAStatus._fields[1:]
+        values = {}
+        for name in fields:
+            if name in self.CACHED_STATES:
+                values[name] = self._cached_state(name)
+        with self.batch() as batch:
+            results = {name: batch.get(name) for name in fields if values.get(name) is None}
+        for name, result in results.items():
+            values[name] = result.value
+            if name in self.CACHED_STATES:
+                self._cache_state(name, values[name])
+        return FIAStatus(timestamp=time.time(), **{name: values.get(name) for name in FIAStatus._fields[1:]})
+    
     def null_cmd(self):
-        resp = self.send_uart_command(self.UART_CMD_NULL)
+        self.send_command('null')
     
     def mcu_reset(self):
-        resp = self.send_uart_command(self.UART_CMD_MCU_RESET, expect_response=False)
+        with self.bitmap_lock:
+            self.send_command('mcu_reset')
+            self._forget_controller_state()
+    
+    def _forget_controller_state(self):
+        # The controller starts over with its splash screen, default destination
+        # and no scroll buffers
+        self._sent_digests.clear()
+        self.destination_buffer = self.SIDE_BOTH
+        self.scroll_buffer_ids.clear()
+        self.invalidate_state_cache()
     
     def set_backlight_state(self, state):
-        resp = self.send_uart_command(self.UART_CMD_SET_BACKLIGHT_STATE, [state])
+        self.send_command('set_backlight_state', state)
+        self._cache_state('backlight_state', int(bool(state)))
     
     def get_backlight_state(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_BACKLIGHT_STATE)
-        return resp[0]
+        return self._get_state('backlight_state')
     
     def set_backlight_base_brightness(self, side_a, side_b):
-        side_a = self.twos_comp(side_a, 16)
-        side_b = self.twos_comp(side_b, 16)
-        params = [side_a >> 8, side_a & 0xFF, side_b >> 8, side_b & 0xFF]
-        resp = self.send_uart_command(self.UART_CMD_SET_BACKLIGHT_BASE_BRIGHTNESS, params)
+        self.send_command('set_backlight_base_brightness', side_a, side_b)
+        self._cache_state('backlight_base_brightness', (side_a, side_b))
     
     def get_backlight_base_brightness(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_BACKLIGHT_BASE_BRIGHTNESS)
-        side_a = self.inv_twos_comp((resp[0] << 8) | resp[1], 16)
-        side_b = self.inv_twos_comp((resp[2] << 8) | resp[3], 16)
-        return side_a, side_b
+        return self._get_state('backlight_base_brightness')
     
     def get_backlight_brightness(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_BACKLIGHT_BRIGHTNESS)
-        side_a = (resp[0] << 8) | resp[1]
-        side_b = (resp[2] << 8) | resp[3]
-        return side_a, side_b
+        return self.send_command('get_backlight_brightness')
     
     def get_env_brightness(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_ENV_BRIGHTNESS)
-        side_a = (resp[0] << 8) | resp[1]
-        side_b = (resp[2] << 8) | resp[3]
-        return side_a, side_b
+        return self.send_command('get_env_brightness')
     
     def set_heaters_state(self, state):
-        resp = self.send_uart_command(self.UART_CMD_SET_HEATERS_STATE, [state])
+        self.send_command('set_heaters_state', state)
     
     def get_heaters_state(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_HEATERS_STATE)
-        return resp[0]
+        return self.send_command('get_heaters_state')
     
     def set_circulation_fans_state(self, state):
-        resp = self.send_uart_command(self.UART_CMD_SET_CIRCULATION_FANS_STATE, [state])
+        self.send_command('set_circulation_fans_state', state)
     
     def get_circulation_fans_state(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_CIRCULATION_FANS_STATE)
-        return resp[0]
+        return self.send_command('get_circulation_fans_state')
     
     def set_heat_exchanger_fan_state(self, state):
-        resp = self.send_uart_command(self.UART_CMD_SET_HEAT_EXCHANGER_FAN_STATE, [state])
+        self.send_command('set_heat_exchanger_fan_state', state)
     
     def get_heat_exchanger_fan_state(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_HEAT_EXCHANGER_FAN_STATE)
-        return resp[0]
+        return self.send_command('get_heat_exchanger_fan_state')
     
     def set_backlight_ballast_fans_state(self, state):
-        resp = self.send_uart_command(self.UART_CMD_SET_BACKLIGHT_BALLAST_FANS_STATE, [state])
+        self.send_command('set_backlight_ballast_fans_state', state)
     
     def get_backlight_ballast_fans_state(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_BACKLIGHT_BALLAST_FANS_STATE)
-        return resp[0]
+        return self.send_command('get_backlight_ballast_fans_state')
     
     def get_door_states(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_DOOR_STATES)
-        return resp[0]
+        return self.send_command('get_door_states')
     
     def get_temperatures(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_TEMPERATURES)
-        t_ext1 = ((resp[0] << 8) | resp[1]) / 100
-        t_ext2 = ((resp[2] << 8) | resp[3]) / 100
-        t_board = ((resp[4] << 8) | resp[5]) / 100
-        t_mcu = ((resp[6] << 8) | resp[7]) / 100
-        return t_ext1, t_ext2, t_board, t_mcu
+        return self.send_command('get_temperatures')
 
     def get_humidity(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_HUMIDITY)
-        humidity = ((resp[0] << 8) | resp[1]) / 100
-        return humidity
+        return self.send_command('get_humidity')
     
     def set_lcd_contrast(self, side_a, side_b):
-        params = [side_a >> 8, side_a & 0xFF, side_b >> 8, side_b & 0xFF]
-        resp = self.send_uart_command(self.UART_CMD_SET_LCD_CONTRAST, params)
+        self.send_command('set_lcd_contrast', side_a, side_b)
+        self._cache_state('lcd_contrast', (side_a, side_b))
     
     def get_lcd_contrast(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_LCD_CONTRAST)
-        side_a = (resp[0] << 8) | resp[1]
-        side_b = (resp[2] << 8) | resp[3]
-        return side_a, side_b
+        return self._get_state('lcd_contrast')
     
     def create_scroll_buffer(self, side, disp_x, disp_y, disp_w, disp_h, int_w, int_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y):
-        sc_st_x = self.twos_comp(sc_st_x, 16)
-        sc_st_y = self.twos_comp(sc_st_y, 16)
-        params = [
-            side,
-            disp_x >> 8, disp_x & 0xFF,
-            disp_y >> 8, disp_y & 0xFF,
-            disp_w >> 8, disp_w & 0xFF,
-            disp_h >> 8, disp_h & 0xFF,
-            int_w >> 8, int_w & 0xFF,
-            int_h >> 8, int_h & 0xFF,
-            sc_off_x >> 8,sc_off_x & 0xFF,
-            sc_off_y >> 8,sc_off_y & 0xFF,
-            sc_sp_x >> 8,sc_sp_x & 0xFF,
-            sc_sp_y >> 8,sc_sp_y & 0xFF,
-            sc_st_x >> 8,sc_st_x & 0xFF,
-            sc_st_y >> 8,sc_st_y & 0xFF,
-        ]
-        resp = self.send_uart_command(self.UART_CMD_CREATE_SCROLL_BUFFER, params)
-        if resp[0] & self.SCROLL_BUF_ERR_MASK:
-            err = resp[0] & ~self.SCROLL_BUF_ERR_MASK
+        with self.bitmap_lock:
+            buf_id = self.send_command('create_scroll_buffer', side, disp_x, disp_y, disp_w, disp_h, int_w, int_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y)
+            return self._scroll_buffer_created(buf_id)
+    
+    def _scroll_buffer_created(self, buf_id):
+        self._forget_composited_digests()
+        # IDs of slots 16 and up have the error bit set too, errors never have the scroll bit
+        if not buf_id & self.BUF_SCROLL and buf_id & self.SCROLL_BUF_ERR_MASK:
+            err = buf_id & ~self.SCROLL_BUF_ERR_MASK
             if err == self.SCROLL_BUF_ERR_COUNT:
                 raise FIAError("No free scroll buffer slots left")
             elif err == self.SCROLL_BUF_ERR_SIZE:
                 raise FIAError("Not enough memory for requested scroll buffer")
             else:
                 raise FIAError("Scroll buffer error code {}".format(err))
-        return resp[0]
+        # A new scroll buffer starts out empty
+        self._sent_digests.pop(buf_id, None)
+        self.scroll_buffer_ids.add(buf_id)
+        return buf_id
     
     def delete_scroll_buffer(self, buf_id):
-        resp = self.send_uart_command(self.UART_CMD_DELETE_SCROLL_BUFFER, [buf_id])
-        return resp[0]
+        with self.bitmap_lock:
+            ok = self.send_command('delete_scroll_buffer', buf_id)
+            self._scroll_buffer_deleted(buf_id, ok)
+        return ok
+    
+    def _scroll_buffer_deleted(self, buf_id, ok):
+        if ok:
+            self.scroll_buffer_ids.discard(buf_id)
+        self._sent_digests.pop(buf_id, None)
+        self._forget_composited_digests()
     
     def update_scroll_buffer(self, buf_id, side = 0xFF, disp_x = 0xFFFF, disp_y = 0xFFFF, disp_w = 0xFFFF, disp_h = 0xFFFF, sc_off_x = 0xFFFF, sc_off_y = 0xFFFF, sc_sp_x = 0xFFFF, sc_sp_y = 0xFFFF, sc_st_x = 0x7FFF, sc_st_y = 0x7FFF):
-        sc_st_x = self.twos_comp(sc_st_x, 16)
-        sc_st_y = self.twos_comp(sc_st_y, 16)
-        params = [
-            buf_id,
-            side,
-            disp_x >> 8, disp_x & 0xFF,
-            disp_y >> 8, disp_y & 0xFF,
-            disp_w >> 8, disp_w & 0xFF,
-            disp_h >> 8, disp_h & 0xFF,
-            sc_off_x >> 8,sc_off_x & 0xFF,
-            sc_off_y >> 8,sc_off_y & 0xFF,
-            sc_sp_x >> 8,sc_sp_x & 0xFF,
-            sc_sp_y >> 8,sc_sp_y & 0xFF,
-            sc_st_x >> 8,sc_st_x & 0xFF,
-            sc_st_y >> 8,sc_st_y & 0xFF,
-        ]
-        resp = self.send_uart_command(self.UART_CMD_UPDATE_SCROLL_BUFFER, params)
-        return resp[0]
+        with self.bitmap_lock:
+            ok = self.send_command('update_scroll_buffer', buf_id, side, disp_x, disp_y, disp_w, disp_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y)
+            self._forget_composited_digests()
+        return ok
     
     def set_destination_buffer(self, buf_id):
-        resp = self.send_uart_command(self.UART_CMD_SET_DESTINATION_BUFFER, [buf_id])
-        return resp[0]
+        with self.bitmap_lock:
+            ok = self.send_command('set_destination_buffer', buf_id)
+            self._destination_buffer_set(buf_id, ok)
+        return ok
+    
+    @contextmanager
+    def destination(self, buf_id):
+        # Send bitmaps to the given buffer inside a with block and switch back
+        # to the previous destination afterwards. Other threads can keep using
+        # the UART meanwhile, but can't change the destination or upload bitmaps.
+        with self.bitmap_lock:
+            # Query the old destination and switch to the new one in one round trip
+            old_buf = self._cached_state('destination_buffer')
+            with self.batch() as batch:
+                old_result = batch.get('destination_buffer') if old_buf is None else None
+                batch.set_destination_buffer(buf_id)
+            if old_result is not None:
+                old_buf = old_result.value
+            try:
+                yield
+            finally:
+                self.set_destination_buffer(old_buf)
+    
+    def _destination_buffer_set(self, buf_id, ok):
+        if ok:
+            # The controller keeps the old destination if the ID is invalid
+            self.destination_buffer = buf_id
+            self._cache_state('destination_buffer', buf_id)
     
     def get_destination_buffer(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_DESTINATION_BUFFER)
-        return resp[0]
+        return self._get_state('destination_buffer')
     
     def set_mask_enabled(self, state):
-        resp = self.send_uart_command(self.UART_CMD_SET_MASK_ENABLED, [state])
+        self.send_command('set_mask_enabled', state)
+        self._cache_state('mask_enabled', int(bool(state)))
     
     def get_mask_enabled(self):
-        resp = self.send_uart_command(self.UART_CMD_GET_MASK_ENABLED)
-        return resp[0]
+        return self._get_state('mask_enabled')
     
     def img_to_array(self, img):
-        pixels = img.load()
         width, height = img.size
-
-        output = []
-
-        for x in range(width):
-            for y_byte in range(0, height, 8):
-                byte = 0x00
-                for y_bit in range(8):
-                    y = y_byte + y_bit
-                    state = pixels[x, y] > 64
-                    if state:
-                        byte |= (1 << y_bit)
-                output.append(byte)
-        
-        return output, width, height
+        return pack_bitmap(img), width, height
     
-    def send_array(self, array):
-        length = len(array)
-        self.spi.writebytes2(bytearray(array))
+    def _forget_composited_digests(self):
+        # Scroll buffers are drawn into the static or dynamic buffers,
+        # so those no longer match what we sent
+        for buf_id in list(self._sent_digests):
+            if buf_id is None or not buf_id & self.BUF_SCROLL:
+                del self._sent_digests[buf_id]
+    
+    def _remember_digest(self, buf_id, digest):
+        digest = (digest, time.monotonic())
+        if buf_id is None:
+            # Unknown destination, it could have been any buffer
+            self._sent_digests.clear()
+            self._sent_digests[None] = digest
+            return
+        self._sent_digests.pop(None, None)
+        if buf_id & self.BUF_SCROLL:
+            self._sent_digests[buf_id] = digest
+            return
+        layer = buf_id & (self.BUF_MASK | self.BUF_DYN)
+        side = buf_id & self.SIDE_BOTH
+        if side == self.SIDE_BOTH:
+            # Sending to both sides updates each side as well
+            for s in (self.SIDE_A, self.SIDE_B, self.SIDE_BOTH):
+                self._sent_digests[layer | s] = digest
+        else:
+            self._sent_digests[buf_id] = digest
+            self._sent_digests.pop(layer | self.SIDE_BOTH, None)
+    
+    def send_array(self, array, force = False):
+        # Send a packed bitmap to the current destination buffer.
+        # Identical consecutive payloads are skipped unless force is set
+        # or the last one is older than frame_cache_ttl.
+        # Returns whether the payload was actually transferred.
+        if not isinstance(array, (bytes, bytearray, memoryview)):
+            array = bytearray(array)
+        digest = hashlib.blake2b(array, digest_size=16).digest()
+        with self.bitmap_lock:
+            return self._send_array(array, digest, force)
+    
+    def _is_duplicate(self, array, digest, force):
+        if force or not self._is_cached_frame(self.destination_buffer, digest):
+            return False
+        self.frames_skipped += 1
+        self.bytes_skipped += len(array)
+        return True
+    
+    def _is_cached_frame(self, buf_id, digest):
+        # Whether the buffer got this payload recently enough that it should still be there
+        if buf_id not in self._sent_digests:
+            return False
+        sent_digest, timestamp = self._sent_digests[buf_id]
+        if self.frame_cache_ttl is not None and time.monotonic() - timestamp > self.frame_cache_ttl:
+            return False
+        return sent_digest == digest
+    
+    def _frame_sent(self, array, digest):
+        self._remember_digest(self.destination_buffer, digest)
+        self.frames_sent += 1
+        self.bytes_sent += len(array)
+        if self.broadcaster is not None:
+            self._broadcast_frame(array)
+    
+    def _broadcast_frame(self, array):
+        # Full frames for the static buffers are what the display shows, as far
+        # as we know. Anything drawn through scroll buffers isn't seen here.
+        buf_id = self.destination_buffer
+        if len(array) != self.width * ((self.height + 7) // 8):
+            return
+        if buf_id is None:
+            buf_id = self.SIDE_BOTH
+        elif buf_id & (self.BUF_SCROLL | self.BUF_MASK | self.BUF_DYN):
+            return
+        self.broadcaster.publish(array, self.width, self.height, buf_id & self.SIDE_BOTH)
+    
+    def _send_array(self, array, digest, force):
+        if self.spi_writer is not None:
+            # Report a failed transfer even if this frame would be skipped
+            with self._spi_writer_errors():
+                self.spi_writer.check()
+        if self._is_duplicate(array, digest, force):
+            return False
+        if self.spi_writer is not None:
+            if not isinstance(array, bytes) and not (isinstance(array, memoryview) and array.readonly):
+                # The caller may reuse its buffer while the frame is still queued
+                array = bytes(array)
+            with self._spi_writer_errors():
+                self.spi_writer.submit(self.destination_buffer, array)
+        else:
+            self.spi.writebytes2(array)
+        self._frame_sent(array, digest)
+        return True
 
-    def send_image(self, img, auto_fit = True):
+    def send_image(self, img, auto_fit = True, force = False):
         if not isinstance(img, Image.Image):
             img = Image.open(img)
         
-        img = img.convert('L')
-        
         if auto_fit:
-            width, height = img.size
-            if width > self.width and height > self.height:
-                img = img.crop((0, 0, self.width, self.height))
-            else:
-                img2 = Image.new('L', (self.width, self.height), 'black')
-                img2.paste(img, (0, 0))
-                img = img2
+            img = fit_image(img, self.width, self.height)
         
-        array, width, height = self.img_to_array(img)
-        self.send_array(array)
+        return self.send_array(pack_bitmap(img), force)
     
     def send_gif(self, img, auto_fit = True, num_loops = -1):
-        if not isinstance(img, Image.Image):
-            img = Image.open(img)
-        
-        width, height = img.size
-        duration = img.info.get('duration', 1000)
-        
-        frames = []
-        for frame in ImageSequence.Iterator(img):
-            if auto_fit:
-                if width > self.width and height > self.height:
-                    frame = frame.crop((0, 0, self.width, self.height)).convert('L')
-                    frames.append(frame)
-                else:
-                    tmp = Image.new('L', (self.width, self.height), 'black')
-                    tmp.paste(frame, (0, 0))
-                    frames.append(tmp)
-            else:
-                temp = Image.new('L', (width, height), 'black')
-                temp.paste(frame, (0, 0))
-                frames.append(temp)
+        if isinstance(img, PackedAnimation):
+            animation = img
+        elif auto_fit:
+            # Decoded while playing, a few frames ahead
+            animation = StreamingAnimation(img, self.width, self.height)
+        else:
+            animation = StreamingAnimation(img)
         
-        last_frame_time = 0
-        cur_frame = 0
-        cur_loop = 0
-        while cur_loop < num_loops or num_loops == -1:
-            now = time.time()
-            if now - last_frame_time >= duration / 1000:
-                self.send_image(frames[cur_frame], auto_fit)
-                last_frame_time = now
-                cur_frame += 1
-            if cur_frame >= len(frames):
-                cur_frame = 0
-                cur_loop += 1
-
-
-class FIAEmulator(FIA):
-    def __init__(self, width = 480, height = 128, panel_width = 96, panel_height = 64, h_sep_height = 15, v_sep_width = 1, off_colour = (0, 0, 200), on_colour = (255, 255, 255), frame_colour = (0, 0, 50)):
+        scheduler = FrameScheduler(self.send_array)
+        try:
+            return scheduler.play(animation, num_loops)
+        finally:
+            if animation is not img:
+                animation.close()
+
+
+class FIAHeadless(FIA):
+    # FIA without a controller or window, for build servers, SSH sessions
+    # and benchmarks. Commands and bitmaps go to a model of the firmware
+    # (fia_firmware.FIAFirmware), so the static, dynamic and mask buffers and
+    # scroll buffers with their limits behave like on the controller.
+    # What one side shows is kept in memory (frame, get_image()) and can be
+    # recorded with its timing, see start_recording().
+    #
+    # The scroll timer follows the clock: the model catches up on the ticks
+    # that passed whenever it's used, and a thread only runs while a visible
+    # scroll buffer is moving, waking up for the ticks that move it.
+    
+    def __init__(self, width = 480, height = 128, panel_width = 96, panel_height = 64, record = None, timing = None, side = FIA.SIDE_A):
         self.width = width
         self.height = height
         self.panel_width = panel_width
         self.panel_height = panel_height
+        self._init_transfer_state()
+        
+        self.side = side
+        self.firmware = FIAFirmware(width, height)
+        self.frame_size = self.firmware.buf_size
+        self.frame = self.firmware.display_bitmap(side)
+        self.frame_time = None
+        self.frames_shown = 0
+        self.recorder = None
+        self._clock_start = time.monotonic()
+        self._ticker = None
+        self._ticker_wake = threading.Event()
+        self._running = True
+        if record is not None or timing is not None:
+            self.start_recording(record, timing)
+    
+    @property
+    def backlight_on(self):
+        return bool(self.firmware.backlight_state)
+    
+    def exit(self):
+        with self.firmware.lock:
+            self._running = False
+            ticker = self._ticker
+        self._ticker_wake.set()
+        if ticker is not None:
+            ticker.join()
+        self.stop_recording()
+        super().exit()
+    
+    def start_recording(self, filename, timing = None):
+        # Record every frame shown from now on, see frame_recorder.FrameRecorder
+        with self.firmware.lock:
+            self.stop_recording()
+            self.recorder = FrameRecorder(filename, self.width, self.height, timing)
+        return self.recorder
+    
+    def stop_recording(self):
+        with self.firmware.lock:
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
+    
+    def get_pixels(self):
+        # The current frame as a (height, width) boolean array
+        return unpack_bitmap(self.frame, self.width, self.height)
+    
+    def get_image(self):
+        return Image.fromarray(self.get_pixels())
+    
+    def display_pixels(self, side = FIA.SIDE_A):
+        # Like get_pixels(), for either side
+        return self.firmware.display_pixels(side)
+    
+    def _run_firmware(self, func, *args):
+        # Call func on the firmware model after catching up with the scroll
+        # timer, then draw the display like the next tick would
+        with self.firmware.lock:
+            ticks = int((time.monotonic() - self._clock_start) * SCROLL_TICK_RATE) - self.firmware.ticks
+            if ticks > 0:
+                self.firmware.advance(ticks)
+            result = func(*args) if func is not None else None
+            self.firmware.update_display()
+            display = self.firmware.display_bitmap(self.side)
+            if display != self.frame:
+                self._show_frame(display)
+            self._schedule_ticks()
+        return result
+    
+    def _schedule_ticks(self):
+        if not self._running or self.firmware.ticks_until_scroll() is None:
+            return
+        if self._ticker is None:
+            self._ticker = threading.Thread(target=self._run_ticker, name="FIAHeadlessTicker", daemon=True)
+            self._ticker.start()
+        elif threading.current_thread() is not self._ticker:
+            # The scroll buffers may have changed, work out the next tick again
+            self._ticker_wake.set()
+    
+    def _run_ticker(self):
+        while True:
+            with self.firmware.lock:
+                ticks = self.firmware.ticks_until_scroll() if self._running else None
+                if ticks is None:
+                    self._ticker = None
+                    return
+                deadline = self._clock_start + (self.firmware.ticks + ticks) / SCROLL_TICK_RATE
+                self._ticker_wake.clear()
+            self._ticker_wake.wait(max(deadline - time.monotonic(), 0))
+            self._run_firmware(None)
+    
+    def send_uart_command_raw(self, raw_command):
+        self.uart_bytes_out += len(raw_command)
+        for response in self._run_firmware(self.firmware.receive, bytes(raw_command)):
+            self._rx_buf += response
+            self.uart_bytes_in += len(response)
+    
+    def discard_uart_input(self):
+        if self._rx_buf:
+            self._rx_buf.clear()
+            self.uart_resyncs += 1
+    
+    def read_uart_response(self):
+        # Responses arrive right along with their commands,
+        # anything missing now isn't coming anymore
+        result = self._parse_uart_response()
+        if isinstance(result, int):
+            self.uart_timeouts += 1
+            raise FIATimeoutError("No response from controller")
+        return result
+    
+    def _send_array(self, array, digest, force):
+        if self._is_duplicate(array, digest, force):
+            return False
+        self._run_firmware(self.firmware.spi_transfer, array)
+        self._frame_sent(array, digest)
+        return True
+    
+    def _broadcast_frame(self, array):
+        # The model knows what's actually shown, see _show_frame()
+        pass
+    
+    def _show_frame(self, array):
+        self.frame = bytes(array)
+        self.frame_time = time.monotonic()
+        self.frames_shown += 1
+        if self.recorder is not None:
+            self.recorder.add(self.frame, self.frame_time)
+        if self.broadcaster is not None:
+            self.broadcaster.publish(self.frame, self.width, self.height, self.side)
+
+
+class FIAEmulator(FIAHeadless):
+    def __init__(self, width = 480, height = 128, panel_width = 96, panel_height = 64, h_sep_height = 15, v_sep_width = 1, off_colour = (0, 0, 200), on_colour = (255, 255, 255), frame_colour = (0, 0, 50), max_fps = 60, record = None, timing = None):
+        if not _HAS_TK:
+            raise RuntimeError("tkinter module not installed. To run without a window, use FIAHeadless instead.")
+        super().__init__(width, height, panel_width, panel_height, record=record, timing=timing)
         self.h_sep_height = h_sep_height
         self.v_sep_width = v_sep_width
         self.off_colour = off_colour
         self.on_colour = on_colour
         self.frame_colour = frame_colour
         
-        self.backlight_on = True
         self.h_panels = width // panel_width
         self.v_panels = height // panel_height
         self.img_width = width + (self.h_panels - 1) * v_sep_width
         self.img_height = height + (self.v_panels - 1) * h_sep_height
         self.img = Image.new('L', (self.width, self.height), 'black')
         self.disp_img = Image.new('RGB', (self.img_width, self.img_height), self.frame_colour)
+        self._init_disp_map()
+        # Frames are handed to the Tk thread through this slot, it only ever
+        # draws the newest one and at most max_fps times per second
+        self.refresh_interval = max(1, round(1000 / max_fps))
+        self._tk_lock = threading.Lock()
+        self._tk_frame = self.img
+        self.frames_drawn = 0
+        self.frames_coalesced = 0
         self.tk_running = True
-        self.tk_img_updated = True
         self.tk_thread = threading.Thread(target=self.tk_loop)
         self.tk_thread.start()
     
     def exit(self):
         self.tk_running = False
         self.tk_thread.join()
+        super().exit()
+    
+    def _init_disp_map(self):
+        # The window shows the display with gaps between the panels. Every
+        # window pixel gets the index of its display pixel in a buffer with
+        # one extra row and column, which hold the frame colour for the gaps.
+        rows = np.arange(self.img_height)
+        y_panel, y = np.divmod(rows, self.panel_height + self.h_sep_height)
+        rows = np.where(y < self.panel_height, y_panel * self.panel_height + y, self.height)
+        cols = np.arange(self.img_width)
+        x_panel, x = np.divmod(cols, self.panel_width + self.v_sep_width)
+        cols = np.where(x < self.panel_width, x_panel * self.panel_width + x, self.width)
+        self._disp_src = np.full((self.height + 1, self.width + 1), 2, dtype=np.uint8)
+        self._disp_index = (rows[:, None] * (self.width + 1) + cols[None, :]).astype(np.intp)
+        self._disp_codes = np.empty((self.img_height, self.img_width), dtype=np.uint8)
+        self._disp_rgb = np.empty((self.img_height, self.img_width, 3), dtype=np.uint8)
+        # Off, on and frame colour, by backlight state
+        dimmed = lambda colour: tuple(int(0.2 * v) for v in colour)
+        self._disp_palettes = {
+            True: np.array([self.off_colour, self.on_colour, self.frame_colour], dtype=np.uint8),
+            False: np.array([dimmed(self.off_colour), dimmed(self.on_colour), self.frame_colour], dtype=np.uint8),
+        }
     
-    def _replace_colour(self, img, src, repl):
-        data = np.array(img)
-        r1, g1, b1 = src
-        r2, g2, b2 = repl
-        red, green, blue = data[:,:,0], data[:,:,1], data[:,:,2]
-        mask = (red == r1) & (green == g1) & (blue == b1)
-        data[:,:,:3][mask] = [r2, g2, b2]
-        return Image.fromarray(data)
-
     def _make_disp_img(self, img):
-        if self.backlight_on:
-            on_colour = self.on_colour
-            off_colour = self.off_colour
-        else:
-            on_colour = tuple([0.2 * v for v in self.on_colour])
-            off_colour = tuple([0.2 * v for v in self.off_colour])
-        
-        ret = Image.new('RGB', (self.img_width, self.img_height), self.frame_colour)
-        for y_panel in range(self.v_panels):
-            for x_panel in range(self.h_panels):
-                src_x1 = x_panel * self.panel_width
-                src_y1 = y_panel * self.panel_height
-                src_x2 = src_x1 + self.panel_width
-                src_y2 = src_y1 + self.panel_height
-                dest_x1 = x_panel * (self.panel_width + self.v_sep_width)
-                dest_y1 = y_panel * (self.panel_height + self.h_sep_height)
-                panel = img.crop((src_x1, src_y1, src_x2, src_y2)).convert("RGB")
-                if off_colour != (0, 0, 0):
-                    panel = self._replace_colour(panel, (0, 0, 0), off_colour)
-                if on_colour != (255, 255, 255):
-                    panel = self._replace_colour(panel, (255, 255, 255), on_colour)
-                ret.paste(panel, (dest_x1, dest_y1))
-        return ret
+        pixels = np.asarray(img)
+        if pixels.dtype != np.bool_:
+            pixels = pixels > 127
+        self._disp_src[:self.height, :self.width] = pixels
+        np.take(self._disp_src, self._disp_index, out=self._disp_codes)
+        np.take(self._disp_palettes[bool(self.backlight_on)], self._disp_codes, axis=0, out=self._disp_rgb)
+        return Image.fromarray(self._disp_rgb)
     
     def tk_update(self):
-        self.disp_img = self._make_disp_img(self.img)
-        self.tk_img_updated = True
+        # Called from the sending thread, which doesn't wait for Tk
+        with self._tk_lock:
+            if self._tk_frame is not None:
+                self.frames_coalesced += 1
+            self._tk_frame = self.img
     
     def tk_loop(self):
         def _on_close():
             self.tk_running = False
         
+        def _refresh():
+            if not self.tk_running:
+                window.quit()
+                return
+            with self._tk_lock:
+                img, self._tk_frame = self._tk_frame, None
+            if img is not None:
+                self.disp_img = self._make_disp_img(img)
+                tk_img.paste(self.disp_img)
+                self.frames_drawn += 1
+            window.after(self.refresh_interval, _refresh)
+        
         window = tk.Tk()
         window.protocol("WM_DELETE_WINDOW", _on_close)
         window.title("FIA Emulator")
@@ -456,47 +1211,21 @@ class FIAEmulator(FIA):
         canvas = tk.Canvas(window, width=self.img_width, height=self.img_height)
         canvas.pack()
         tk_img = ImageTk.PhotoImage(self.disp_img)
-        canvas_img = canvas.create_image(0, 0, anchor='nw', image=tk_img)
-        while self.tk_running:
-            if self.tk_img_updated:
-                tk_img = ImageTk.PhotoImage(self.disp_img)
-                canvas.itemconfig(canvas_img, image=tk_img)
-                self.tk_img_updated = False
-            window.update_idletasks()
-            window.update()
+        canvas.create_image(0, 0, anchor='nw', image=tk_img)
+        # Tk sleeps in its event loop between refreshes instead of being polled
+        window.after(0, _refresh)
+        window.mainloop()
         window.destroy()
     
     def send_uart_command_raw(self, raw_command):
-        print("TX: " + str(raw_command))
-    
-    def read_uart_response(self):
-        return bytearray([0xFF] * 100)
+        super().send_uart_command_raw(raw_command)
+        print("TX: " + str(list(raw_command)))
     
     def set_backlight_state(self, state):
         super().set_backlight_state(state)
-        self.backlight_on = state
+        self.tk_update()
     
-    def create_scroll_buffer(self, *args, **kwargs):
-        try:
-            super().create_scroll_buffer(*args, **kwargs)
-        except:
-            pass
-
-    def send_image(self, img, auto_fit = True):
-        if not isinstance(img, Image.Image):
-            img = Image.open(img)
-        
-        img = img.convert('L')
-        
-        if auto_fit:
-            width, height = img.size
-            if width > self.width and height > self.height:
-                img = img.crop((0, 0, self.width, self.height))
-            else:
-                img2 = Image.new('L', (self.width, self.height), 'black')
-                img2.paste(img, (0, 0))
-                img = img2
-        
-        fn = lambda x : 255 if x > 64 else 0
-        self.img = img.convert('L').point(fn, mode='1')
-        self.tk_update()
\ No newline at end of file
+    def _show_frame(self, array):
+        super()._show_frame(array)
+        self.img = Image.fromarray(unpack_bitmap(array, self.width, self.height))
+        self.tk_update()
@@ -0,0 +1,554 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import traceback
+
+from collections import deque
+from contextlib import contextmanager
+from PIL import Image
+
+import fia_control
+from animation import PackedAnimation, StreamingAnimation
+from bitmap import fit_image, pack_bitmap
+from fia_control import FIA, FIAEmulator, FIAError, FIAStatus, UARTResult
+from playback import FrameScheduler
+
+
+# Unix socket path, or host:port for TCP
+DEFAULT_ADDRESS = "/tmp/fia_daemon.sock"
+
+# Message header: length of the rest of the message, message kind
+HEADER = struct.Struct('>IB')
+# Frame message: request ID, flags, followed by the bitmap payload
+FRAME_HEADER = struct.Struct('>IB')
+
+MSG_CALL = 0x01
+MSG_FRAME = 0x02
+MSG_RESULT = 0x81
+
+FRAME_FLAG_FORCE = 0x01
+
+PRIO_CONTROL = 0
+PRIO_TELEMETRY = 1
+PRIO_BULK = 2
+
+CONTROL_METHODS = (
+    'null_cmd',
+    'mcu_reset',
+    'set_backlight_state',
+    'set_backlight_base_brightness',
+    'set_heaters_state',
+    'set_circulation_fans_state',
+    'set_heat_exchanger_fan_state',
+    'set_backlight_ballast_fans_state',
+    'set_lcd_contrast',
+    'create_scroll_buffer',
+    'delete_scroll_buffer',
+    'update_scroll_buffer',
+    'set_mask_enabled',
+    'send_uart_command',
+    'flush',
+)
+
+# Handled by the daemon for each client
+SESSION_METHODS = (
+    'set_destination_buffer',
+    'get_destination_buffer',
+    'push_destination',
+    'pop_destination',
+)
+
+TELEMETRY_METHODS = (
+    'get_backlight_state',
+    'get_backlight_base_brightness',
+    'get_backlight_brightness',
+    'get_env_brightness',
+    'get_heaters_state',
+    'get_circulation_fans_state',
+    'get_heat_exchanger_fan_state',
+    'get_backlight_ballast_fans_state',
+    'get_door_states',
+    'get_temperatures',
+    'get_humidity',
+    'get_lcd_contrast',
+    'get_mask_enabled',
+    'get_status',
+)
+
+
+def parse_address(address):
+    # "host:port" is TCP, anything else a Unix socket path
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return socket.AF_INET, (host or "localhost", int(port))
+    return socket.AF_UNIX, address
+
+
+def send_message(sock, kind, body):
+    sock.sendall(HEADER.pack(len(body), kind) + body)
+
+
+def _recv_exact(sock, length):
+    buf = bytearray(length)
+    view = memoryview(buf)
+    pos = 0
+    while pos < length:
+        count = sock.recv_into(view[pos:])
+        if not count:
+            raise ConnectionError("Connection closed")
+        pos += count
+    return buf
+
+
+def recv_message(sock):
+    length, kind = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    return kind, _recv_exact(sock, length)
+
+
+class Job:
+    # One request waiting for the thread that owns the FIA
+
+    def __init__(self, priority, func, destination = None):
+        self.priority = priority
+        self.func = func
+        self.destination = destination
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, result = None, error = None):
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class CommandScheduler:
+    # Runs all jobs on the FIA from one thread. Control commands go first,
+    # then telemetry, then frame uploads. A frame that is still waiting
+    # is replaced by a newer one for the same destination buffer.
+
+    def __init__(self, fia):
+        self.fia = fia
+        self.frames_coalesced = 0
+        self._cond = threading.Condition()
+        self._queues = {PRIO_CONTROL: deque(), PRIO_TELEMETRY: deque()}
+        self._frames = {}
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="CommandScheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, job):
+        with self._cond:
+            if job.priority == PRIO_BULK:
+                old = self._frames.pop(job.destination, None)
+                if old is not None:
+                    # Never shown, but not an error either
+                    old.finish(False)
+                    self.frames_coalesced += 1
+                self._frames[job.destination] = job
+            else:
+                self._queues[job.priority].append(job)
+            self._cond.notify()
+        return job
+
+    def run(self, priority, func, destination = None):
+        return self.submit(Job(priority, func, destination)).wait()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def _next_job(self):
+        for priority in (PRIO_CONTROL, PRIO_TELEMETRY):
+            if self._queues[priority]:
+                return self._queues[priority].popleft()
+        if self._frames:
+            return self._frames.pop(next(iter(self._frames)))
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: not self._running or self._frames or any(self._queues.values()))
+                if not self._running:
+                    return
+                job = self._next_job()
+            try:
+                job.finish(job.func())
+            except Exception as e:
+                job.finish(error=e)
+
+
+class Session:
+    # State of one client connection. Every client has its own bitmap
+    # destination, the daemon switches the real one as needed.
+
+    def __init__(self):
+        self.destination = FIA.SIDE_BOTH
+        # Previous destinations, see RemoteFIA.destination()
+        self.destination_stack = []
+        self.scroll_buffers = set()
+
+
+class DaemonRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        daemon = self.server.fia_daemon
+        session = Session()
+        try:
+            while True:
+                try:
+                    kind, body = recv_message(self.request)
+                except ConnectionError:
+                    break
+                if kind == MSG_CALL:
+                    request = json.loads(body)
+                    request_id = request.get('id')
+                    try:
+                        result = daemon.call(session, request['method'], request.get('args', []), request.get('kwargs', {}))
+                        response = {'id': request_id, 'result': result}
+                    except Exception as e:
+                        response = {'id': request_id, 'error': str(e), 'type': type(e).__name__}
+                elif kind == MSG_FRAME:
+                    request_id, flags = FRAME_HEADER.unpack_from(body)
+                    payload = bytes(memoryview(body)[FRAME_HEADER.size:])
+                    try:
+                        result = daemon.send_frame(session, payload, bool(flags & FRAME_FLAG_FORCE))
+                        response = {'id': request_id, 'result': result}
+                    except Exception as e:
+                        response = {'id': request_id, 'error': str(e), 'type': type(e).__name__}
+                else:
+                    break
+                send_message(self.request, MSG_RESULT, json.dumps(response).encode('utf-8'))
+        finally:
+            daemon.close_session(session)
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FIADaemon:
+    # Owns the UART and SPI connection and lets several processes use the
+    # controller at the same time through RemoteFIA
+
+    def __init__(self, fia, address = DEFAULT_ADDRESS):
+        self.fia = fia
+        self.address = address
+        self.scheduler = CommandScheduler(fia)
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(addr):
+                os.unlink(addr)
+            self.server = _UnixServer(addr, DaemonRequestHandler)
+        else:
+            self.server = _TCPServer(addr, DaemonRequestHandler)
+        self.server.fia_daemon = self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.scheduler.stop()
+        family, addr = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+
+    def call(self, session, method, args, kwargs):
+        if method == 'info':
+            return {'width': self.fia.width, 'height': self.fia.height, 'panel_width': self.fia.panel_width, 'panel_height': self.fia.panel_height}
+        if method == 'get_destination_buffer':
+            return session.destination
+        if method == 'batch':
+            # One job, so no other client's commands run in between
+            return self.scheduler.run(PRIO_CONTROL, lambda: [self._batch_call(session, *call) for call in args[0]])
+        priority = self._priority(method)
+        return self.scheduler.run(priority, lambda: self._call(session, method, args, kwargs))
+
+    def _priority(self, method):
+        if method in CONTROL_METHODS or method in SESSION_METHODS:
+            return PRIO_CONTROL
+        if method in TELEMETRY_METHODS:
+            return PRIO_TELEMETRY
+        raise FIAError("Unknown method {}".format(method))
+
+    def _call(self, session, method, args, kwargs):
+        # Runs in the scheduler's thread
+        if method == 'set_destination_buffer':
+            return self._set_destination(session, *args)
+        if method == 'get_destination_buffer':
+            return session.destination
+        if method == 'push_destination':
+            old_buf = session.destination
+            ok = self._set_destination(session, *args)
+            session.destination_stack.append(old_buf)
+            return ok
+        if method == 'pop_destination':
+            if session.destination_stack:
+                session.destination = session.destination_stack.pop()
+            return session.destination
+        result = getattr(self.fia, method)(*args, **kwargs)
+        if method == 'create_scroll_buffer':
+            session.scroll_buffers.add(result)
+        elif method == 'delete_scroll_buffer':
+            session.scroll_buffers.discard(args[0])
+        elif method == 'send_uart_command' and result is not None:
+            result = list(result)
+        return result
+
+    def _batch_call(self, session, method, args, kwargs):
+        # Errors are returned per call like the results of a UARTBatch
+        try:
+            self._priority(method)
+            return {'result': self._call(session, method, args, kwargs)}
+        except Exception as e:
+            return {'error': str(e), 'type': type(e).__name__}
+
+    def _set_destination(self, session, buf_id):
+        # Check that the buffer exists, the frames switch to it when they're sent
+        ok = self.fia.set_destination_buffer(buf_id)
+        if ok:
+            session.destination = buf_id
+        return ok
+
+    def send_frame(self, session, payload, force):
+        return self.scheduler.run(PRIO_BULK, lambda: self._send_frame(session.destination, payload, force), destination=session.destination)
+
+    def _send_frame(self, destination, payload, force):
+        if self.fia.destination_buffer != destination:
+            self.fia.set_destination_buffer(destination)
+        return self.fia.send_array(payload, force)
+
+    def close_session(self, session):
+        # Clean up the scroll buffers a client left behind
+        for buf_id in session.scroll_buffers:
+            try:
+                self.scheduler.run(PRIO_CONTROL, lambda: self._delete_scroll_buffer(buf_id))
+            except FIAError:
+                traceback.print_exc()
+
+    def _delete_scroll_buffer(self, buf_id):
+        if self.fia.destination_buffer == buf_id:
+            # The controller refuses to delete the active destination
+            self.fia.set_destination_buffer(FIA.SIDE_BOTH)
+        return self.fia.delete_scroll_buffer(buf_id)
+
+
+class RemoteBatch:
+    # UARTBatch for RemoteFIA. The queued calls are sent to the daemon
+    # together and run there one after another, without commands of other
+    # clients in between. They aren't pipelined on the UART though.
+    # Results are fia_control.UARTResult, filled in by execute().
+
+    def __init__(self, rfia):
+        self.rfia = rfia
+        self.calls = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def _queue(self, method, args, kwargs = None, decode = None, callback = None):
+        result = UARTResult(method, decode, callback)
+        self.calls.append((method, args, kwargs or {}))
+        self.results.append(result)
+        return result
+
+    def command(self, name, *args, callback = None):
+        # Queue a call of one of the FIA methods, e.g. command('set_heaters_state', 1)
+        return self._queue(name, args, callback=callback)
+
+    def get(self, name):
+        # Queue one of the getters in FIA.UART_GETTERS, e.g. get('temperatures')
+        return self._queue(FIA.UART_GETTERS[name], ())
+
+    def send(self, command, data = [], decode = None, callback = None, expect_response = True):
+        # Queue a raw UART command, decode gets the response payload
+        return self._queue('send_uart_command', (command, list(data), expect_response),
+                           decode=lambda resp: (decode or bytearray)(bytearray(resp)) if resp is not None else None, callback=callback)
+
+    def set_destination_buffer(self, buf_id):
+        return self._queue('set_destination_buffer', (buf_id,))
+
+    def update_scroll_buffer(self, buf_id, **kwargs):
+        return self._queue('update_scroll_buffer', (buf_id,), kwargs)
+
+    def execute(self):
+        responses = self.rfia._call('batch', self.calls)
+        for result, response in zip(self.results, responses):
+            if 'error' in response:
+                result._set_error(self.rfia._error(response))
+            else:
+                result._set_response(response['result'])
+        self.calls = []
+        return self.results
+
+
+class RemoteFIA:
+    # Drop-in replacement for FIA that talks to an FIADaemon.
+    # Frames are uploaded through the daemon's frame queue, so a frame
+    # may be dropped (send_array returns False) if another one for the
+    # same buffer came in before it was sent.
+    # Raw commands from send_uart_command() bypass the daemon's bookkeeping,
+    # use the regular methods for destination and scroll buffers.
+
+    def __init__(self, address = DEFAULT_ADDRESS):
+        family, addr = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(addr)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        info = self._call('info')
+        self.width = info['width']
+        self.height = info['height']
+        self.panel_width = info['panel_width']
+        self.panel_height = info['panel_height']
+
+    def __getattr__(self, name):
+        if name.isupper():
+            # Constants like SIDE_BOTH
+            return getattr(FIA, name)
+        if name in CONTROL_METHODS or name in TELEMETRY_METHODS or name in ('set_destination_buffer', 'get_destination_buffer'):
+            return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    def _request(self, kind, body):
+        with self._lock:
+            send_message(self.sock, kind, body)
+            kind, body = recv_message(self.sock)
+        response = json.loads(body)
+        if 'error' in response:
+            raise self._error(response)
+        return self._to_tuples(response['result'])
+
+    def _error(self, response):
+        error_class = getattr(fia_control, response.get('type', ''), FIAError)
+        if not (isinstance(error_class, type) and issubclass(error_class, FIAError)):
+            error_class = FIAError
+        return error_class(response['error'])
+
+    def _to_tuples(self, value):
+        # JSON turns the tuples FIA returns into lists
+        if isinstance(value, list):
+            return tuple(self._to_tuples(v) for v in value)
+        if isinstance(value, dict):
+            return {key: self._to_tuples(v) for key, v in value.items()}
+        return value
+
+    def _new_id(self):
+        self._next_id = (self._next_id + 1) & 0xFFFFFFFF
+        return self._next_id
+
+    def _call(self, method, *args, **kwargs):
+        body = json.dumps({'id': self._new_id(), 'method': method, 'args': args, 'kwargs': kwargs})
+        return self._request(MSG_CALL, body.encode('utf-8'))
+
+    def exit(self):
+        self.sock.close()
+
+    def get_status(self, fields = None):
+        return FIAStatus(*self._call('get_status', fields))
+
+    def batch(self):
+        return RemoteBatch(self)
+
+    def send_uart_command(self, command, data = [], expect_response = True):
+        resp = self._call('send_uart_command', command, list(data), expect_response)
+        return bytearray(resp) if resp is not None else None
+
+    @contextmanager
+    def destination(self, buf_id):
+        # The daemon keeps the previous destination of this client,
+        # so switching there and back is one call each
+        self._call('push_destination', buf_id)
+        try:
+            yield
+        finally:
+            self._call('pop_destination')
+
+    def send_array(self, array, force = False):
+        header = FRAME_HEADER.pack(self._new_id(), FRAME_FLAG_FORCE if force else 0)
+        return self._request(MSG_FRAME, header + bytes(array))
+
+    def send_image(self, img, auto_fit = True, force = False):
+        if not isinstance(img, Image.Image):
+            img = Image.open(img)
+
+        if auto_fit:
+            img = fit_image(img, self.width, self.height)
+
+        return self.send_array(pack_bitmap(img), force)
+
+    def send_gif(self, img, auto_fit = True, num_loops = -1):
+        if isinstance(img, PackedAnimation):
+            animation = img
+        elif auto_fit:
+            # Decoded while playing, a few frames ahead
+            animation = StreamingAnimation(img, self.width, self.height)
+        else:
+            animation = StreamingAnimation(img)
+
+        scheduler = FrameScheduler(self.send_array)
+        try:
+            return scheduler.play(animation, num_loops)
+        finally:
+            if animation is not img:
+                animation.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share the display controller between several processes", add_help=False)
+    parser.add_argument('--address', '-a', required=False, type=str, default=DEFAULT_ADDRESS, help="Unix socket path or host:port to listen on")
+    parser.add_argument('--emulate', '-e', action='store_true', help="Run in emulation mode")
+    parser.add_argument('--web-port', required=False, type=int, help="Serve the web interface with a live view of the display on this port")
+    parser.add_argument('--help', action='help', help="Display this help message")
+    args = parser.parse_args()
+
+    # Clients importing RemoteFIA don't need the display settings
+    from local_settings import DISPLAY_WIDTH, DISPLAY_HEIGHT
+
+    if args.emulate:
+        fia = FIAEmulator(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT)
+    else:
+        fia = FIA("/dev/ttyAMA1", (3, 0), width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT)
+
+    if args.web_port:
+        # The live view needs the web app in this process
+        from wsgi import serve_in_background
+        serve_in_background(fia, args.web_port)
+
+    daemon = FIADaemon(fia, args.address)
+    print("Listening on {}".format(args.address))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.shutdown()
+        fia.exit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,548 @@
+import os
+import re
+import threading
+
+import numpy as np
+
+from bitmap import unpack_bitmap
+from uart_commands import COMMANDS_BY_CODE, MAX_PAYLOAD_LENGTH, START_BYTE, checksum
+
+
+# Values from the FIAControl firmware (fia.h, heap.h, uart_protocol.h)
+UART_MIN_COMMAND_LENGTH = 4
+UART_RX_RING_BUFFER_SIZE = 256
+
+SIDE_A = 0x01
+SIDE_B = 0x02
+SIDE_BOTH = 0x03
+
+MAX_SCROLL_BUFFERS = 20
+SCROLL_BUFFER_ID_MASK = 0x80
+MASK_BUFFER_ID_MASK = 0x40
+DYN_BUFFER_ID_MASK = 0x20
+SCROLL_BUFFER_ERR_MASK = 0x10
+SCROLL_BUFFER_ERR_COUNT = 1
+SCROLL_BUFFER_ERR_SIZE = 2
+
+HEAP_SIZE = 200 * 1024
+# sizeof() of the heap header and block header on the 32 bit MCU
+HEAP_HEADER_SIZE = 8
+HEAP_ENTRY_SIZE = 16
+
+SCROLL_TICK_RATE = 100
+
+# Splash screens built into the firmware per display size (fia.h)
+SPLASH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "STM32", "FIAControl", "Src")
+SPLASH_FILES = {
+    (480, 128): "splash_5x2.c",
+    (384, 128): "splash_4x2.c",
+}
+
+
+def round_up(value, multiple):
+    return (value + multiple - 1) // multiple * multiple
+
+
+def load_splash(width, height):
+    # Contents of the static buffers after FIA_Init(), all pixels on
+    # if the firmware has no splash screen for this size
+    size = width * ((height + 7) // 8)
+    filename = SPLASH_FILES.get((width, height))
+    if filename is not None:
+        try:
+            with open(os.path.join(SPLASH_DIR, filename), 'r') as f:
+                source = f.read()
+        except OSError:
+            source = ""
+        data = re.findall(r"0x([0-9A-Fa-f]{2})", source.partition("{")[2])
+        if len(data) == size:
+            return bytes(int(value, 16) for value in data)
+    return b"\xFF" * size
+
+
+class Heap:
+    # Same first-fit allocator as heap.c, so fragmentation and
+    # exhaustion happen at the same point as on the controller.
+    # Blocks are [offset, size, used], offset is only used for display.
+
+    def __init__(self, size = HEAP_SIZE):
+        self.size = size
+        self.blocks = [[HEAP_HEADER_SIZE, size - HEAP_HEADER_SIZE - HEAP_ENTRY_SIZE, False]]
+
+    def malloc(self, size):
+        # Returns a handle for free() or None if no block is large enough
+        block_size = (size & ~0x3) + 4
+        for i, block in enumerate(self.blocks):
+            offset, free_size, used = block
+            if used or (free_size != block_size and free_size < block_size + HEAP_ENTRY_SIZE):
+                continue
+            if free_size != block_size:
+                # Split off the rest as a new free block
+                self.blocks.insert(i + 1, [offset + HEAP_ENTRY_SIZE + block_size, free_size - block_size - HEAP_ENTRY_SIZE, False])
+                block[1] = block_size
+            block[2] = True
+            return offset
+        return None
+
+    def free(self, handle):
+        for i, block in enumerate(self.blocks):
+            if block[0] == handle:
+                break
+        else:
+            return
+        block[2] = False
+        # Merge with free neighbours
+        while i > 0 and not self.blocks[i - 1][2]:
+            prev = self.blocks[i - 1]
+            prev[1] += block[1] + HEAP_ENTRY_SIZE
+            del self.blocks[i]
+            i -= 1
+            block = prev
+        while i + 1 < len(self.blocks) and not self.blocks[i + 1][2]:
+            block[1] += self.blocks[i + 1][1] + HEAP_ENTRY_SIZE
+            del self.blocks[i + 1]
+
+    @property
+    def free_bytes(self):
+        return sum(block[1] for block in self.blocks if not block[2])
+
+    @property
+    def largest_free_block(self):
+        return max([block[1] for block in self.blocks if not block[2]] or [0])
+
+
+class ScrollBuffer:
+    def __init__(self, side, disp_x, disp_y, disp_w, disp_h, int_w, int_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y, handle):
+        self.side = side
+        self.disp_x = disp_x
+        self.disp_y = disp_y
+        self.disp_w = disp_w
+        self.disp_h = disp_h
+        self.int_w = int_w
+        self.int_h = int_h
+        self.scroll_offset_x = sc_off_x
+        self.scroll_offset_y = sc_off_y
+        self.scroll_speed_x = sc_sp_x
+        self.scroll_speed_y = sc_sp_y
+        self.scroll_step_x = sc_st_x
+        self.scroll_step_y = sc_st_y
+        self.scroll_tick_cnt_x = 0
+        self.scroll_tick_cnt_y = 0
+        self.buf = np.zeros(int_w * round_up(int_h, 8) // 8, dtype=np.uint8)
+        self.handle = handle
+        # Unpacked copy of buf for rendering, None after buf was written
+        self.bits = None
+
+    def scroll(self, x_step, y_step):
+        if x_step != 0:
+            self.scroll_offset_x = (self.scroll_offset_x + x_step) % self.int_w
+        if y_step != 0:
+            self.scroll_offset_y = (self.scroll_offset_y + y_step) % self.int_h
+
+    def advance(self, ticks):
+        # Run the tick counters of the scroll timer interrupt for a number
+        # of ticks at once. Each counter moves the buffer by one step
+        # when it reaches the speed and starts over from zero.
+        steps = [0, 0]
+        for axis in (0, 1):
+            name = 'xy'[axis]
+            count = getattr(self, 'scroll_tick_cnt_' + name)
+            speed = getattr(self, 'scroll_speed_' + name)
+            if speed == 0:
+                count += ticks
+            else:
+                first = max(speed - count, 1)
+                if ticks < first:
+                    count += ticks
+                else:
+                    steps[axis] = 1 + (ticks - first) // speed
+                    count = (ticks - first) % speed
+            setattr(self, 'scroll_tick_cnt_' + name, count)
+        if self.int_w and self.int_h:
+            self.scroll(steps[0] * self.scroll_step_x, steps[1] * self.scroll_step_y)
+
+    def ticks_until_scroll(self):
+        # Ticks until the next step, None if the buffer doesn't move
+        remaining = [max(speed - count, 1) for speed, count in (
+            (self.scroll_speed_x, self.scroll_tick_cnt_x),
+            (self.scroll_speed_y, self.scroll_tick_cnt_y)) if speed != 0]
+        return min(remaining) if remaining else None
+
+    @property
+    def visible(self):
+        return self.side != 0 and self.int_w != 0
+
+    def get_bits(self):
+        # Flat array of the bits in buf, LSB first
+        if self.bits is None:
+            self.bits = np.unpackbits(self.buf, bitorder='little')
+        return self.bits
+
+    def window_pixels(self, xs, ys):
+        # (len(xs), len(ys)) array of what FIA_RenderScrollBuffer() draws at
+        # the given display columns and rows of the window. It works on bytes:
+        # int_h is cut down to whole bytes (intHBytes) for the column stride
+        # and the vertical wrap, so heights that aren't a multiple of 8 read
+        # shifted data like on the panel. Its uint16 index arithmetic is
+        # reproduced as well.
+        h_bytes = self.int_h // 8
+        src_x = (xs - self.disp_x + self.scroll_offset_x) % self.int_w
+        base_bit_offset = self.disp_y % 8
+        byte_offset, scroll_bit_offset = divmod(self.scroll_offset_y - base_bit_offset, 8)
+        # Byte of the window and bit within the two scroll buffer bytes it's made of
+        render_byte = ys // 8 - self.disp_y // 8
+        bit = scroll_bit_offset + ys % 8
+        sbuf_offset = (render_byte + byte_offset) & 0xFFFF
+        if h_bytes:
+            byte_in_col = (sbuf_offset + bit // 8) % h_bytes
+        else:
+            # Division by zero gives 0 on the Cortex-M
+            byte_in_col = np.zeros_like(sbuf_offset)
+        byte_index = ((src_x * h_bytes)[:, None] + byte_in_col[None, :]) & 0xFFFF
+        bits = self.get_bits()
+        bit_index = byte_index * 8 + (bit % 8)[None, :]
+        # Beyond the end of buf is some other heap block, shown as off here
+        return np.where(bit_index < len(bits), bits[np.minimum(bit_index, len(bits) - 1)], 0)
+
+
+class FIAFirmware:
+    # Software model of the FIAControl firmware: the static, dynamic and mask
+    # buffers of both sides, scroll buffers with the controller's slot and
+    # heap limits and the 100 Hz scroll timer. Used by fia_simulator.FIASimulator
+    # behind a serial port and by fia_control.FIAHeadless directly.
+    #
+    # Commands go in through receive() (raw UART bytes) or process_command(),
+    # bitmap data through spi_transfer(). Call tick() or advance() and
+    # update_display() for the scroll timer, display_bitmap() and
+    # display_pixels() return what the LCDs show.
+
+    def __init__(self, width = 480, height = 128, splash = None):
+        # splash is the static buffer contents after a reset,
+        # by default the firmware's splash screen, see load_splash()
+        self.width = width
+        self.height = height
+        self.h_bytes = (height + 7) // 8
+        self.buf_size = width * self.h_bytes
+        self.splash = splash if splash is not None else load_splash(width, height)
+
+        # Sensor values returned by the getters, can be changed at any time
+        self.temperatures = [25.0, 25.0, 30.0, 35.0]
+        self.humidity = 40.0
+        self.env_brightness = [2048, 2048]
+        self.door_states = 0
+
+        self.commands_processed = 0
+        self.checksum_errors = 0
+        self.uart_overruns = 0
+        self.spi_transfers = 0
+        self.spi_incomplete = 0
+        self.ticks = 0
+
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        # State after power-up or NVIC_SystemReset()
+        with self.lock:
+            # Like FIA_Init(): splash screen, empty dynamic layer, mask showing all of it
+            self.static = [np.frombuffer(self.splash, dtype=np.uint8).copy() for i in range(2)]
+            self.dynamic = [np.zeros(self.buf_size, dtype=np.uint8) for i in range(2)]
+            self.mask = [np.full(self.buf_size, 0xFF, dtype=np.uint8) for i in range(2)]
+            self.display = [np.zeros(self.buf_size, dtype=np.uint8) for i in range(2)]
+            self.scroll_buffers = [None] * MAX_SCROLL_BUFFERS
+            self.heap = Heap()
+            self.mask_enabled = 0
+            self.backlight_state = 1
+            self.backlight_base_brightness = [2048, 2048]
+            self.lcd_contrast = [2048, 2048]
+            self.heaters_state = 0
+            self.circulation_fans_state = 0
+            self.heat_exchanger_fan_state = 0
+            self.backlight_ballast_fans_state = 0
+            self._rx_ring = bytearray()
+            self.set_destination_buffer(SIDE_BOTH)
+            self.update_display()
+
+    # UART side
+
+    def receive(self, data):
+        # Feed received bytes to the ring buffer and return the responses
+        # to all complete commands, like UART_HandleProtocol()
+        responses = []
+        with self.lock:
+            ring = self._rx_ring
+            ring += data
+            if len(ring) > UART_RX_RING_BUFFER_SIZE:
+                # The DMA overwrote data that wasn't read yet
+                self.uart_overruns += 1
+                del ring[:len(ring) - UART_RX_RING_BUFFER_SIZE]
+            while len(ring) >= UART_MIN_COMMAND_LENGTH:
+                if ring[0] != START_BYTE:
+                    del ring[0]
+                    continue
+                length = ring[1]
+                if length > MAX_PAYLOAD_LENGTH:
+                    del ring[0]
+                    continue
+                if length + 2 > len(ring):
+                    break
+                payload = bytes(ring[2:length + 2])
+                del ring[:length + 2]
+                if length < 2 or checksum(payload[:-1]) != payload[-1]:
+                    self.checksum_errors += 1
+                    continue
+                response = self.process_command(payload[0], payload[1:-1])
+                if response is not None:
+                    responses.append(bytes([START_BYTE, len(response) + 1]) + response + bytes([checksum(response)]))
+        return responses
+
+    def process_command(self, code, params):
+        # Returns the response payload, or None if nothing is sent
+        self.commands_processed += 1
+        command = COMMANDS_BY_CODE.get(code)
+        if command is None:
+            # Unknown commands get an empty response
+            return b""
+        args = command.unpack_request(params)
+        name = command.name
+
+        if name == 'null':
+            return command.pack_response(0xFF)
+        elif name == 'mcu_reset':
+            self.reset()
+            return None
+        elif name == 'set_backlight_state':
+            self.backlight_state = int(bool(args[0]))
+        elif name == 'get_backlight_state':
+            return command.pack_response(self.backlight_state)
+        elif name == 'set_backlight_base_brightness':
+            self.backlight_base_brightness = list(args)
+        elif name == 'get_backlight_base_brightness':
+            return command.pack_response(*self.backlight_base_brightness)
+        elif name == 'get_backlight_brightness':
+            return command.pack_response(*self.backlight_brightness)
+        elif name == 'set_heaters_state':
+            self.heaters_state = min(args[0], 2)
+        elif name == 'get_heaters_state':
+            return command.pack_response(self.heaters_state)
+        elif name == 'set_circulation_fans_state':
+            self.circulation_fans_state = min(args[0], 2)
+        elif name == 'get_circulation_fans_state':
+            return command.pack_response(self.circulation_fans_state)
+        elif name == 'set_heat_exchanger_fan_state':
+            self.heat_exchanger_fan_state = int(bool(args[0]))
+        elif name == 'get_heat_exchanger_fan_state':
+            return command.pack_response(self.heat_exchanger_fan_state)
+        elif name == 'set_backlight_ballast_fans_state':
+            self.backlight_ballast_fans_state = int(bool(args[0]))
+        elif name == 'get_backlight_ballast_fans_state':
+            return command.pack_response(self.backlight_ballast_fans_state)
+        elif name == 'get_door_states':
+            return command.pack_response(self.door_states)
+        elif name == 'get_temperatures':
+            return command.pack_response(*self.temperatures)
+        elif name == 'get_humidity':
+            return command.pack_response(self.humidity)
+        elif name == 'get_env_brightness':
+            return command.pack_response(*self.env_brightness)
+        elif name == 'set_lcd_contrast':
+            self.lcd_contrast = list(args)
+        elif name == 'get_lcd_contrast':
+            return command.pack_response(*self.lcd_contrast)
+        elif name == 'create_scroll_buffer':
+            return command.pack_response(self.create_scroll_buffer(*args))
+        elif name == 'delete_scroll_buffer':
+            return command.pack_response(self.delete_scroll_buffer(*args))
+        elif name == 'update_scroll_buffer':
+            return command.pack_response(self.update_scroll_buffer(*args))
+        elif name == 'set_destination_buffer':
+            return command.pack_response(self.set_destination_buffer(*args))
+        elif name == 'get_destination_buffer':
+            return command.pack_response(self.destination_buffer)
+        elif name == 'set_mask_enabled':
+            self.mask_enabled = int(bool(args[0]))
+        elif name == 'get_mask_enabled':
+            return command.pack_response(self.mask_enabled)
+        # Set commands get an empty response
+        return b""
+
+    @property
+    def backlight_brightness(self):
+        # Automatic brightness from the environment sensors, zero if the door is open
+        result = []
+        for i, side in enumerate((SIDE_A, SIDE_B)):
+            if self.door_states & side:
+                result.append(0)
+            else:
+                result.append(min(max(self.env_brightness[i] + self.backlight_base_brightness[i] - 2048, 0), 4095))
+        return result
+
+    # Scroll buffers
+
+    def _get_scroll_buffer(self, buf_id):
+        if not buf_id & SCROLL_BUFFER_ID_MASK:
+            return None
+        index = buf_id - SCROLL_BUFFER_ID_MASK
+        if index >= MAX_SCROLL_BUFFERS:
+            return None
+        return self.scroll_buffers[index]
+
+    def create_scroll_buffer(self, side, disp_x, disp_y, disp_w, disp_h, int_w, int_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y):
+        if None not in self.scroll_buffers:
+            return SCROLL_BUFFER_ERR_MASK | SCROLL_BUFFER_ERR_COUNT
+        handle = self.heap.malloc(int_w * round_up(int_h, 8) // 8)
+        if handle is None:
+            return SCROLL_BUFFER_ERR_MASK | SCROLL_BUFFER_ERR_SIZE
+        index = self.scroll_buffers.index(None)
+        self.scroll_buffers[index] = ScrollBuffer(side, disp_x, disp_y, disp_w, disp_h, int_w, int_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y, handle)
+        return index | SCROLL_BUFFER_ID_MASK
+
+    def update_scroll_buffer(self, buf_id, side, disp_x, disp_y, disp_w, disp_h, sc_off_x, sc_off_y, sc_sp_x, sc_sp_y, sc_st_x, sc_st_y):
+        buf = self._get_scroll_buffer(buf_id)
+        if buf is None:
+            return 0
+        # 0xFF, 0xFFFF and 0x7FFF leave a value unchanged
+        for name, value, keep in (
+            ('side', side, 0xFF),
+            ('disp_x', disp_x, 0xFFFF),
+            ('disp_y', disp_y, 0xFFFF),
+            ('disp_w', disp_w, 0xFFFF),
+            ('disp_h', disp_h, 0xFFFF),
+            ('scroll_offset_x', sc_off_x, 0xFFFF),
+            ('scroll_offset_y', sc_off_y, 0xFFFF),
+            ('scroll_speed_x', sc_sp_x, 0xFFFF),
+            ('scroll_speed_y', sc_sp_y, 0xFFFF),
+            ('scroll_step_x', sc_st_x, 0x7FFF),
+            ('scroll_step_y', sc_st_y, 0x7FFF)):
+            if value != keep:
+                setattr(buf, name, value)
+        # The firmware always clears the dynamic buffers here
+        self._clear_dynamic()
+        return 1
+
+    def delete_scroll_buffer(self, buf_id):
+        buf = self._get_scroll_buffer(buf_id)
+        if buf is None:
+            return 0
+        if self._rx_buf is buf.buf:
+            # The active destination can't be deleted
+            return 0
+        self.heap.free(buf.handle)
+        self.scroll_buffers[buf_id - SCROLL_BUFFER_ID_MASK] = None
+        self._clear_dynamic()
+        return 1
+
+    def _clear_dynamic(self):
+        for buf in self.dynamic:
+            buf[:] = 0
+
+    def set_destination_buffer(self, buf_id):
+        # Returns 1 on success like FIA_SetBitmapDestinationBuffer(),
+        # including its quirk of storing the ID without the mask/dyn flag
+        sides = {SIDE_A: (0, False), SIDE_B: (1, False), SIDE_BOTH: (0, True)}
+        layer = self.static
+        stored_id = buf_id
+        if buf_id not in sides and buf_id & MASK_BUFFER_ID_MASK:
+            layer = self.mask
+            stored_id = buf_id & ~MASK_BUFFER_ID_MASK
+        elif buf_id not in sides and buf_id & DYN_BUFFER_ID_MASK:
+            layer = self.dynamic
+            stored_id = buf_id & ~DYN_BUFFER_ID_MASK
+        elif buf_id & SCROLL_BUFFER_ID_MASK:
+            index = buf_id & ~SCROLL_BUFFER_ID_MASK
+            if index >= MAX_SCROLL_BUFFERS or self.scroll_buffers[index] is None:
+                return 0
+            self._rx_scroll_buffer = self.scroll_buffers[index]
+            self._rx_buf = self._rx_scroll_buffer.buf
+            self._rx_layer = None
+            self.destination_buffer = buf_id
+            return 1
+        elif buf_id not in sides:
+            return 0
+        if stored_id in sides:
+            index, both = sides[stored_id]
+            self._rx_scroll_buffer = None
+            self._rx_buf = layer[index]
+            self._rx_layer = layer if both else None
+        self.destination_buffer = stored_id
+        return 1
+
+    # SPI side
+
+    def spi_transfer(self, data):
+        # One chip select cycle: the DMA fills the destination buffer and only
+        # completes if at least its whole length arrived. Shorter transfers
+        # leave partially written data, longer ones are cut off.
+        with self.lock:
+            self.spi_transfers += 1
+            rx_buf = self._rx_buf
+            count = min(len(data), len(rx_buf))
+            rx_buf[:count] = np.frombuffer(data, dtype=np.uint8, count=count)
+            if self._rx_scroll_buffer is not None:
+                self._rx_scroll_buffer.bits = None
+            if count < len(rx_buf):
+                self.spi_incomplete += 1
+            elif self._rx_layer is not None:
+                # SIDE_BOTH writes side A, side B gets a copy on completion
+                self._rx_layer[1][:] = rx_buf
+
+    # Scroll timer
+
+    def tick(self):
+        # One step of the 100 Hz scroll timer
+        with self.lock:
+            self.advance(1)
+            self.update_display()
+
+    def advance(self, ticks):
+        # Move the scroll buffers as far as the timer would in the given
+        # number of ticks. Drawing them is up to update_display(), since
+        # only the last of the ticks' drawings stays visible anyway.
+        with self.lock:
+            self.ticks += ticks
+            for buf in self.scroll_buffers:
+                if buf is not None:
+                    buf.advance(ticks)
+
+    def ticks_until_scroll(self):
+        # Ticks until a visible scroll buffer moves, None if none will
+        with self.lock:
+            remaining = [buf.ticks_until_scroll() for buf in self.scroll_buffers if buf is not None and buf.visible]
+            remaining = [ticks for ticks in remaining if ticks is not None]
+            return min(remaining) if remaining else None
+
+    def _render_scroll_buffers(self, target, side):
+        # Copy the visible windows of the scroll buffers into a bitmap buffer,
+        # unpacking and packing it only once for all of them
+        buffers = [buf for buf in self.scroll_buffers if buf is not None and buf.visible and buf.side & side]
+        if not buffers:
+            return
+        pixels = np.unpackbits(target.reshape((self.width, self.h_bytes)), axis=1, bitorder='little')
+        for buf in buffers:
+            xs = np.arange(buf.disp_x, min(buf.disp_x + buf.disp_w, self.width))
+            ys = np.arange(buf.disp_y, min(buf.disp_y + buf.disp_h, self.height))
+            if not len(xs) or not len(ys):
+                continue
+            pixels[np.ix_(xs, ys)] = buf.window_pixels(xs, ys)
+        target[:] = np.packbits(pixels, axis=1, bitorder='little').ravel()
+
+    def update_display(self):
+        # Draw the scroll buffers and combine the layers, like every timer tick
+        with self.lock:
+            layer = self.dynamic if self.mask_enabled else self.static
+            for i, side in enumerate((SIDE_A, SIDE_B)):
+                self._render_scroll_buffers(layer[i], side)
+            for i in range(2):
+                if self.mask_enabled:
+                    self.display[i][:] = (self.static[i] & ~self.mask[i]) | (self.dynamic[i] & self.mask[i])
+                else:
+                    self.display[i][:] = self.static[i]
+
+    def display_bitmap(self, side = SIDE_A):
+        # What the LCDs of one side show, in the format of pack_bitmap()
+        with self.lock:
+            return self.display[0 if side == SIDE_A else 1].tobytes()
+
+    def display_pixels(self, side = SIDE_A):
+        # (height, width) boolean array of the display contents
+        return unpack_bitmap(self.display_bitmap(side), self.width, self.height)
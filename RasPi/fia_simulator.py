@@ -0,0 +1,168 @@
+import argparse
+import heapq
+import os
+import select
+import threading
+import time
+import tty
+
+import numpy as np
+
+import fake_spidev
+from fia_control import FIA
+from fia_firmware import SCROLL_TICK_RATE, FIAFirmware
+
+
+# Bits per byte on the UART, 8N1
+UART_BITS_PER_BYTE = 10
+
+
+class FIASimulator(FIAFirmware):
+    # The firmware model (fia_firmware.FIAFirmware) behind a serial port, for
+    # testing and benchmarking without the hardware. The UART side is a pseudo-terminal that FIA opens
+    # like the real serial port, bitmap data arrives through a fake_spidev
+    # device whose transfers are fed into the simulated SPI receiver.
+    #
+    #   sim = FIASimulator()
+    #   sim.start()
+    #   fia = sim.connect()
+    #
+    # latency is added to every response, uart_baud limits how fast command
+    # and response bytes travel (None for no limit). realtime = False skips
+    # the 100 Hz scroll timer thread, call tick() to advance it manually.
+
+    def __init__(self, width = 480, height = 128, latency = 0.0, uart_baud = 115200, realtime = True):
+        super().__init__(width, height)
+        self.latency = latency
+        self.uart_baud = uart_baud
+        self.realtime = realtime
+
+        self._master = None
+        self._slave = None
+        self.port = None
+        self._thread = None
+        self._running = False
+
+    # UART side
+
+    def start(self):
+        # Opens the pseudo-terminal and starts the controller thread,
+        # returns the port name to pass to FIA
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="FIASimulator", daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def make_spi(self, max_reliable_hz = None, realtime = True):
+        # SPI device for FIA(..., spi=...). With realtime, transfers take
+        # as long as at the configured clock.
+        return fake_spidev.SpiDev(0, 0, max_reliable_hz=max_reliable_hz, realtime=realtime, on_transfer=self.spi_transfer)
+
+    def connect(self, spi_clock = None, spi_realtime = True, **kwargs):
+        # FIA connected to this simulator
+        if self.port is None:
+            self.start()
+        spi = self.make_spi(realtime=spi_realtime)
+        return FIA(self.port, None, spi_clock=spi_clock, width=self.width, height=self.height, spi=spi, **kwargs)
+
+    def _byte_time(self, count):
+        if not self.uart_baud:
+            return 0.0
+        return count * UART_BITS_PER_BYTE / self.uart_baud
+
+    def _run(self):
+        # Responses waiting for their send time as (time, sequence, data)
+        pending = []
+        sequence = 0
+        rx_time = time.monotonic()
+        tx_time = rx_time
+        next_tick = rx_time + 1 / SCROLL_TICK_RATE
+        while self._running:
+            now = time.monotonic()
+            timeout = 0.05
+            if pending:
+                timeout = min(timeout, pending[0][0] - now)
+            if self.realtime:
+                timeout = min(timeout, next_tick - now)
+            readable, _, _ = select.select([self._master], [], [], max(timeout, 0))
+            now = time.monotonic()
+            if readable:
+                try:
+                    data = os.read(self._master, 4096)
+                except OSError:
+                    data = b""
+                # Bytes arrive one after another at the configured baud rate
+                rx_time = max(rx_time, now) + self._byte_time(len(data))
+                for response in self.receive(data):
+                    tx_time = max(tx_time, rx_time + self.latency) + self._byte_time(len(response))
+                    heapq.heappush(pending, (tx_time, sequence, response))
+                    sequence += 1
+            while pending and pending[0][0] <= now:
+                os.write(self._master, heapq.heappop(pending)[2])
+            if self.realtime and now >= next_tick:
+                self.tick()
+                next_tick += 1 / SCROLL_TICK_RATE
+                if next_tick < now:
+                    # Don't try to catch up after a stall
+                    next_tick = now + 1 / SCROLL_TICK_RATE
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the throughput of the Python stack against a simulated controller", add_help=False)
+    parser.add_argument('--latency', '-l', required=False, type=float, default=0.0, help="Response latency in ms")
+    parser.add_argument('--baud', '-b', required=False, type=int, default=115200, help="Simulated UART baud rate (0 for no limit)")
+    parser.add_argument('--spi-clock', '-s', required=False, type=int, default=None, help="SPI clock in Hz")
+    parser.add_argument('--duration', '-d', required=False, type=float, default=3.0, help="Seconds to run each test")
+    parser.add_argument('--help', action='help', help="Display this help message")
+    args = parser.parse_args()
+
+    # Only here, so the simulator can be imported on a checkout without local settings
+    from local_settings import DISPLAY_WIDTH, DISPLAY_HEIGHT
+
+    sim = FIASimulator(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, latency=args.latency / 1000, uart_baud=args.baud)
+    sim.start()
+    fia = sim.connect(spi_clock=args.spi_clock)
+    print("Simulated controller on {}".format(sim.port))
+    try:
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            fia.get_status()
+            count += 1
+        elapsed = time.perf_counter() - start
+        print("get_status(): {:8.1f} calls/s, {:6.2f} ms/call".format(count / elapsed, elapsed / count * 1000))
+
+        frames = [np.random.default_rng(i).integers(0, 256, sim.buf_size, dtype=np.uint8).tobytes() for i in range(2)]
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            fia.send_array(frames[count % 2])
+            count += 1
+        elapsed = time.perf_counter() - start
+        print("send_array(): {:8.1f} frames/s, {:6.2f} ms/frame".format(count / elapsed, elapsed / count * 1000))
+
+        print("Commands processed: {}, checksum errors: {}, UART overruns: {}, incomplete SPI transfers: {}".format(
+            sim.commands_processed, sim.checksum_errors, sim.uart_overruns, sim.spi_incomplete))
+    except KeyboardInterrupt:
+        print("")
+    finally:
+        fia.exit()
+        sim.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,120 @@
+import io
+import threading
+import time
+
+from PIL import Image
+
+from bitmap import unpack_bitmap
+from fia_firmware import SIDE_A, SIDE_BOTH
+
+
+# Formats frames can be encoded to and their MIME types
+FORMATS = {
+    'png': "image/png",
+    'jpeg': "image/jpeg",
+}
+
+MAX_SCALE = 4
+
+
+class FrameBroadcaster:
+    # Hands the frames a FIA shows to any number of viewers, like the live
+    # view in wsgi.py.
+    #
+    #   broadcaster = FrameBroadcaster()
+    #   broadcaster.attach_fia(fia)
+    #   for seq, data in broadcaster.stream('png'):
+    #       ...
+    #
+    # publish() only swaps in the newest frame and wakes up the viewers, so
+    # the display path never waits for mirroring. Encoding happens in the
+    # viewers' threads, once per frame, format and scale no matter how many
+    # viewers there are, and not at all while nobody is watching.
+    # Viewers get at most max_fps frames per second, skipping to the newest.
+
+    def __init__(self, side = SIDE_A, max_fps = 10):
+        # side is the side of the display to mirror
+        self.side = side
+        self.max_fps = max_fps
+        self.viewers = 0
+        self.frames_published = 0
+        self.frames_encoded = 0
+        self._cond = threading.Condition()
+        # (sequence number, payload, width, height)
+        self._frame = None
+        self._encode_lock = threading.Lock()
+        # (format, scale) -> (sequence number, encoded frame)
+        self._encoded = {}
+
+    def attach_fia(self, fia):
+        fia.broadcaster = self
+
+    def publish(self, payload, width, height, side = SIDE_BOTH):
+        # Called by FIA with every packed frame for the display
+        if not side & self.side:
+            return
+        # The caller may reuse its buffer
+        payload = bytes(payload)
+        with self._cond:
+            self.frames_published += 1
+            self._frame = (self.frames_published, payload, width, height)
+            self._cond.notify_all()
+
+    def encode(self, frame, fmt = 'png', scale = 1):
+        seq, payload, width, height = frame
+        key = (fmt, scale)
+        with self._encode_lock:
+            cached = self._encoded.get(key)
+            if cached is not None and cached[0] == seq:
+                return cached[1]
+            img = Image.fromarray(unpack_bitmap(payload, width, height))
+            if fmt == 'jpeg':
+                img = img.convert('L')
+            if scale != 1:
+                img = img.resize((width * scale, height * scale), Image.NEAREST)
+            buf = io.BytesIO()
+            img.save(buf, format=fmt.upper())
+            data = buf.getvalue()
+            self._encoded[key] = (seq, data)
+            self.frames_encoded += 1
+            return data
+
+    def latest(self, fmt = 'png', scale = 1):
+        # The current frame encoded, None if there is none yet
+        with self._cond:
+            frame = self._frame
+        if frame is None:
+            return None
+        return self.encode(frame, fmt, scale)
+
+    def stream(self, fmt = 'png', scale = 1, max_fps = None, keepalive = 5.0):
+        # Generator of (sequence number, encoded frame) for one viewer: the
+        # current frame right away, then new ones as they come in. Yields
+        # (sequence number, None) after keepalive seconds without a new frame,
+        # so the connection is written to and closed viewers are noticed.
+        if fmt not in FORMATS:
+            raise ValueError("Unknown format {}".format(fmt))
+        scale = min(max(int(scale), 1), MAX_SCALE)
+        interval = 1 / min(max_fps or self.max_fps, self.max_fps)
+        with self._cond:
+            self.viewers += 1
+        try:
+            seq = 0
+            next_time = 0
+            while True:
+                # Frames arriving meanwhile replace each other
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                with self._cond:
+                    new_frame = self._cond.wait_for(lambda: self._frame is not None and self._frame[0] != seq, keepalive)
+                    frame = self._frame
+                if not new_frame:
+                    yield seq, None
+                    continue
+                seq = frame[0]
+                next_time = time.monotonic() + interval
+                yield seq, self.encode(frame, fmt, scale)
+        finally:
+            with self._cond:
+                self.viewers -= 1
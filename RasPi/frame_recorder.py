@@ -0,0 +1,110 @@
+import csv
+import os
+import time
+
+from PIL import Image
+
+from animation import FILE_EXTENSION, AnimationWriter
+from bitmap import unpack_bitmap
+
+
+# Written by Pillow in one go when the recording is closed
+ANIMATED_EXTENSIONS = ('.gif', '.webp', '.apng')
+
+
+class FrameRecorder:
+    # Records packed frames along with the time they were shown.
+    #
+    # The format follows the file name: .fia writes the packed frame format
+    # as frames come in (see animation.AnimationWriter), .gif, .webp and
+    # .apng an animated image when the recording is closed, anything else
+    # is a directory that gets one PNG per frame. filename can be None to
+    # only write the timing.
+    #
+    # timing is an optional CSV file with one row per frame: the frame number,
+    # seconds since the first frame and milliseconds since the previous one.
+    #
+    # A frame's duration is only known once the next one arrives,
+    # the last one lasts until close().
+
+    def __init__(self, filename, width, height, timing = None):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.frame_count = 0
+        self.start_time = None
+        self._last = None
+        self._writer = None
+        self._animated = []
+        self._timing_file = None
+        self._timing = None
+
+        ext = os.path.splitext(filename)[1].lower() if filename is not None else None
+        if filename is None:
+            self.format = None
+        elif ext == FILE_EXTENSION:
+            self.format = 'fia'
+            self._writer = AnimationWriter(filename, width, height)
+        elif ext in ANIMATED_EXTENSIONS:
+            self.format = 'animated'
+        else:
+            self.format = 'sequence'
+            os.makedirs(filename, exist_ok=True)
+
+        if timing is not None:
+            self._timing_file = open(timing, 'w', newline='', encoding='utf-8')
+            self._timing = csv.writer(self._timing_file)
+            self._timing.writerow(['frame', 'time', 'interval_ms'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _image(self, payload):
+        return Image.fromarray(unpack_bitmap(payload, self.width, self.height)).convert('L')
+
+    def add(self, payload, timestamp = None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        payload = bytes(payload)
+        if self.start_time is None:
+            self.start_time = timestamp
+        interval = 0.0
+        if self._last is not None:
+            interval = (timestamp - self._last[1]) * 1000
+            self._finish(self._last[0], interval)
+        if self._timing is not None:
+            self._timing.writerow([self.frame_count, "{:.6f}".format(timestamp - self.start_time), "{:.3f}".format(interval)])
+        if self.format == 'sequence':
+            self._image(payload).save(os.path.join(self.filename, "frame_{:06d}.png".format(self.frame_count)))
+        self._last = (payload, timestamp)
+        self.frame_count += 1
+
+    def _finish(self, payload, duration):
+        # Called once the duration of a frame is known, in milliseconds
+        if self.format == 'fia':
+            self._writer.add(payload, duration)
+        elif self.format == 'animated':
+            # Packed frames are an eighth of the size of the images
+            self._animated.append((payload, duration))
+
+    def close(self, timestamp = None):
+        if self._last is not None:
+            if timestamp is None:
+                timestamp = time.monotonic()
+            self._finish(self._last[0], (timestamp - self._last[1]) * 1000)
+            self._last = None
+        if self._writer is not None:
+            self._writer.close()
+        if self._animated:
+            images = [self._image(payload) for payload, duration in self._animated]
+            # GIF durations have a resolution of 10 ms
+            durations = [max(10, int(round(duration))) for payload, duration in self._animated]
+            images[0].save(self.filename, save_all=True, append_images=images[1:], duration=durations, loop=0)
+            self._animated = []
+        if self._timing_file is not None:
+            self._timing_file.close()
+            self._timing_file = None
+            self._timing = None
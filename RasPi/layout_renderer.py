@@ -2,8 +2,10 @@ import argparse
 import json
 import math
 import os
+import time
 
-from fia_control import FIA, FIAEmulator, FIAError
+from dirty_regions import DirtyRegionUpdater
+from fia_control import FIA, FIAEmulator, FIAError, FIAHeadless
 from PIL import Image, ImageOps, ImageDraw
 
 from local_settings import *
@@ -48,13 +50,8 @@ class ScrollBuffer:
         if w != self.int_w or h != self.int_h:
             raise FIAError("Scroll buffer image doesn't match allocated dimensions")
         
-        dest_buf = self.fia.get_destination_buffer()
-        try:
-            self.fia.set_destination_buffer(self.id)
+        with self.fia.destination(self.id):
             self.fia.send_image(img, auto_fit=False)
-        finally:
-            # Restore old destination buffer
-            self.fia.set_destination_buffer(dest_buf)
 
 
 class LayoutRenderer:
@@ -69,13 +66,19 @@ class LayoutRenderer:
         'both': FIA.SIDE_BOTH
     }
     
-    def __init__(self, font_dir, fia = None):
+    def __init__(self, font_dir, fia = None, dirty_regions = False):
+        # With dirty_regions, display() only sends the parts that changed
+        # (see dirty_regions.py). This needs the mask disabled, and
+        # forget_frame() has to be called before sending anything else.
         self.font_dir = font_dir
         self.fia = fia
+        self.dirty_regions = DirtyRegionUpdater(fia) if dirty_regions and fia is not None else None
         self.img_mode = 'L'
         self.img_bg = 255
         self.img_fg = 0
         self.scroll_buffers = []
+        # Instrumentation hooks, see metrics.FIAMetrics
+        self.metrics = None
     
     def get_font_dir(self, font, size):
         return os.path.join(self.font_dir, font, "size_{}".format(size))
@@ -299,9 +302,6 @@ class LayoutRenderer:
             break_words = placeholder.get('break_words', True)
             
             scroll = placeholder.get('scroll', False)
-            if isinstance(self.fia, FIAEmulator):
-                # Scroll texts are not yet supported in the emulator
-                scroll = False
             only_scroll_if_wider = placeholder.get('only_scroll_if_wider', False)
             if scroll:
                 int_w = placeholder.get('internal_width')
@@ -378,6 +378,7 @@ class LayoutRenderer:
             draw.rectangle((x, y, x+width-1, y+height-1), outline=self.img_fg)
     
     def render(self, layout, data, render_boxes = False, render_content = True):
+        start = time.perf_counter()
         img = Image.new(self.img_mode, (layout['width'], layout['height']), color=self.img_bg)
         side = self.SIDE_LUT.get(layout.get('side', 'both'), self.SIDE_LUT['both'])
         if render_content:
@@ -387,13 +388,25 @@ class LayoutRenderer:
         if render_boxes:
             for placeholder in layout['placeholders']:
                 self.render_placeholder(img, side, placeholder, value=None, render_boxes=True, render_content=False)
-        return ImageOps.invert(img)
+        img = ImageOps.invert(img)
+        if self.metrics is not None:
+            # Layouts can have a "name" to tell them apart in the metrics
+            self.metrics.observe_render(layout.get('name', "{}x{}".format(layout['width'], layout['height'])), time.perf_counter() - start)
+        return img
     
     def display(self, *args, **kwargs):
         if self.fia is None:
             raise ValueError("Can't display image without fia argument")
         img = self.render(*args, **kwargs)
-        self.fia.send_image(img)
+        if self.dirty_regions is not None:
+            self.dirty_regions.send_image(img)
+        else:
+            self.fia.send_image(img)
+    
+    def forget_frame(self):
+        # Something else is about to be sent to the display
+        if self.dirty_regions is not None:
+            self.dirty_regions.forget_frame()
     
     def free_scroll_buffers(self):
         for buf in self.scroll_buffers:
@@ -408,6 +421,9 @@ def main():
     parser.add_argument('--font-dir', '-fd', required=True, type=str)
     parser.add_argument('--data', '-d', action='append', nargs=2, metavar=("key", "value"))
     parser.add_argument('--emulate', '-e', action='store_true', help="Run in emulation mode")
+    parser.add_argument('--headless', action='store_true', help="Emulate without a window")
+    parser.add_argument('--record', required=False, type=str, help="Record the emulated display to a .fia file, animated image or directory")
+    parser.add_argument('--timing', required=False, type=str, help="Write the time of every emulated frame to this CSV file")
     parser.add_argument('--render-boxes', '-rb', action='store_true', help="Render the bounding boxes of the windows")
     parser.add_argument('--dont-render-content', '-drc', action='store_true', help="Don't render the content of the windows")
     args = parser.parse_args()
@@ -424,12 +440,17 @@ def main():
         img = renderer.render(layout, data, render_boxes=args.render_boxes, render_content=not args.dont_render_content)
         img.save(args.output)
     else:
-        if args.emulate:
-            fia = FIAEmulator(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT)
+        if args.headless:
+            fia = FIAHeadless(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, record=args.record, timing=args.timing)
+        elif args.emulate:
+            fia = FIAEmulator(width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT, record=args.record, timing=args.timing)
         else:
             fia = FIA("/dev/ttyAMA1", (3, 0), width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT)
         renderer = LayoutRenderer(args.font_dir, fia)
         renderer.display(layout, data, render_boxes=args.render_boxes, render_content=not args.dont_render_content)
+        if args.headless:
+            # Nothing left to show, finish the recording
+            fia.exit()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,191 @@
+import bisect
+import http.server
+import os
+import threading
+import time
+
+from uart_commands import COMMANDS_BY_CODE
+
+
+# Upper bounds of the latency histogram buckets in seconds
+UART_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+RENDER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Command names for the metric labels, e.g. 0x40 -> "get_temperatures"
+UART_COMMAND_NAMES = {code: command.name for code, command in COMMANDS_BY_CODE.items()}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    # Prometheus style histogram with one label, e.g. the command name
+
+    def __init__(self, name, help, buckets, label = None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._lock = threading.Lock()
+        # label value -> [bucket counts..., sum, count]
+        self._values = {}
+
+    def observe(self, value, label_value = None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_value)
+            if counts is None:
+                counts = self._values[label_value] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def collect(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        for label_value, counts in sorted(values.items(), key=lambda item: str(item[0])):
+            labels = [(self.label, label_value)] if self.label is not None else []
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(self.name, _format_labels(labels + [('le', _format_value(bound))]), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _format_labels(labels), repr(counts[-2])))
+            lines.append("{}_count{} {}".format(self.name, _format_labels(labels), counts[-1]))
+        return lines
+
+
+class Registry:
+    # Metrics to export. Besides histograms, collector functions are called
+    # on every scrape and return (name, type, help, samples) tuples with
+    # samples as a list of (labels, value), labels a list of (key, value).
+    # That way counters FIA keeps anyway cost nothing until they're read.
+
+    def __init__(self):
+        self.histograms = []
+        self.collectors = []
+
+    def histogram(self, name, help, buckets, label = None):
+        histogram = Histogram(name, help, buckets, label)
+        self.histograms.append(histogram)
+        return histogram
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        # All metrics in the Prometheus text exposition format
+        lines = []
+        for histogram in self.histograms:
+            lines += histogram.collect()
+        for collector in self.collectors:
+            for name, metric_type, help, samples in collector():
+                lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} {}".format(name, metric_type))
+                for labels, value in samples:
+                    lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, filename):
+        # For the node_exporter textfile collector, which needs the file
+        # to be replaced atomically
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_filename, filename)
+
+    def start_textfile_writer(self, filename, interval = 15):
+        def _run():
+            while True:
+                try:
+                    self.write_textfile(filename)
+                except OSError as e:
+                    print("Could not write metrics to {}: {}".format(filename, e))
+                time.sleep(interval)
+        thread = threading.Thread(target=_run, name="MetricsTextfileWriter", daemon=True)
+        thread.start()
+        return thread
+
+    def start_http_server(self, port, address = ""):
+        # Serve the metrics on http://address:port/metrics in a background thread
+        registry = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name="MetricsHTTPServer", daemon=True)
+        thread.start()
+        return server
+
+
+class FIAMetrics:
+    # Instrumentation for FIA and LayoutRenderer.
+    #
+    #   metrics = FIAMetrics()
+    #   metrics.attach_fia(fia)
+    #   metrics.attach_renderer(renderer)
+    #   metrics.registry.start_http_server(9110)
+    #
+    # Without attaching, fia.metrics and renderer.metrics stay None and
+    # the only cost is checking for that.
+
+    def __init__(self, registry = None):
+        self.registry = registry or Registry()
+        self.uart_command_seconds = self.registry.histogram("fia_uart_command_seconds", "Time from sending a UART command to receiving its response", UART_BUCKETS, 'command')
+        self.render_seconds = self.registry.histogram("fia_layout_render_seconds", "Time to render a layout", RENDER_BUCKETS, 'layout')
+        self.fias = []
+
+    def attach_fia(self, fia):
+        fia.metrics = self
+        if not self.fias:
+            self.registry.add_collector(self._collect_fia)
+        self.fias.append(fia)
+
+    def attach_renderer(self, renderer):
+        renderer.metrics = self
+
+    def observe_uart_command(self, command, seconds):
+        self.uart_command_seconds.observe(seconds, UART_COMMAND_NAMES.get(command, "0x{:02x}".format(command)))
+
+    def observe_render(self, layout, seconds):
+        self.render_seconds.observe(seconds, layout)
+
+    def _collect_fia(self):
+        def total(attr):
+            return sum(getattr(fia, attr, 0) for fia in self.fias)
+
+        writers = [fia.spi_writer for fia in self.fias if fia.spi_writer is not None]
+        return [
+            ("fia_uart_bytes_total", "counter", "Bytes sent and received over the UART", [([('direction', 'out')], total('uart_bytes_out')), ([('direction', 'in')], total('uart_bytes_in'))]),
+            ("fia_uart_checksum_errors_total", "counter", "UART responses with a wrong checksum", [([], total('uart_crc_errors'))]),
+            ("fia_uart_timeouts_total", "counter", "UART commands that got no response in time", [([], total('uart_timeouts'))]),
+            ("fia_uart_resyncs_total", "counter", "Times stray bytes were dropped from the UART input", [([], total('uart_resyncs'))]),
+            ("fia_spi_frames_total", "counter", "Bitmap frames sent or skipped as duplicates", [([('result', 'sent')], total('frames_sent')), ([('result', 'skipped')], total('frames_skipped'))]),
+            ("fia_spi_bytes_total", "counter", "Bitmap bytes sent or skipped as duplicates", [([('result', 'sent')], total('bytes_sent')), ([('result', 'skipped')], total('bytes_skipped'))]),
+            ("fia_spi_frames_dropped_total", "counter", "Frames the SPI writer replaced with newer ones before sending", [([], sum(writer.frames_dropped for writer in writers))]),
+            ("fia_state_cache_hits_total", "counter", "Getter calls answered from the state cache", [([], total('state_cache_hits'))]),
+            ("fia_scroll_buffers_allocated", "gauge", "Scroll buffers currently allocated on the controller", [([], sum(len(getattr(fia, 'scroll_buffer_ids', ())) for fia in self.fias))]),
+        ]
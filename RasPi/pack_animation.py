@@ -0,0 +1,78 @@
+import argparse
+import os
+import time
+
+from PIL import Image
+
+from animation import FILE_EXTENSION, AnimationWriter, MappedAnimation, iter_packed_frames
+
+from local_settings import *
+
+
+def pos_nonzero_int(value):
+    try:
+        ivalue = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} must be a positive non-zero integer".format(value))
+    if ivalue <= 0:
+        raise argparse.ArgumentTypeError("{} must be a positive non-zero integer".format(value))
+    return ivalue
+
+
+def list_inputs(paths):
+    # Image files in the given order, directories expanded to their files sorted by name
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path) if os.path.isfile(os.path.join(path, name)))
+        else:
+            files.append(path)
+    return files
+
+
+def pack_animation(inputs, output, width, height, interval = None, crop = None, digests = True):
+    # Convert a GIF or a sequence of images (or GIFs) into a .fia file.
+    # Frames are written as they're decoded, so memory use doesn't grow with the length.
+    with AnimationWriter(output, width, height, digests) as writer:
+        for filename in inputs:
+            with Image.open(filename) as img:
+                for frame in iter_packed_frames(img, width, height, interval, crop):
+                    writer.add(frame.payload, frame.duration)
+    return writer.frame_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a GIF or image sequence into a .fia file for instant, zero-copy playback with display_image.py", add_help=False)
+    parser.add_argument('--file', '-f', required=True, type=str, nargs='+', help="Input GIF, images or directories of images (played in name order)")
+    parser.add_argument('--output', '-o', required=False, default=None, type=str, help="Output file (defaults to the first input with the .fia extension)")
+    parser.add_argument('--width', '-w', required=False, default=None, type=pos_nonzero_int, help="Width to crop input to")
+    parser.add_argument('--height', '-h', required=False, default=None, type=pos_nonzero_int, help="Height to crop input to")
+    parser.add_argument('--interval', '-i', required=False, default=None, type=pos_nonzero_int, help="Interval between frames in ms (defaults to GIF's setting or one second)")
+    parser.add_argument('--no-digests', action='store_true', help="Don't store frame digests")
+    parser.add_argument('--verify', action='store_true', help="Read the file back and check all frames against their digests")
+    parser.add_argument('--help', action='help', help="Display this help message")
+    args = parser.parse_args()
+
+    inputs = list_inputs(args.file)
+    if not inputs:
+        print("No input files")
+        return 1
+    output = args.output or os.path.splitext(args.file[0].rstrip(os.sep))[0] + FILE_EXTENSION
+    crop = (args.width, args.height) if args.width and args.height else None
+
+    start = time.monotonic()
+    count = pack_animation(inputs, output, DISPLAY_WIDTH, DISPLAY_HEIGHT, interval=args.interval, crop=crop, digests=not args.no_digests)
+    print("Packed {} frames into {} ({} bytes) in {:.1f}s".format(count, output, os.path.getsize(output), time.monotonic() - start))
+
+    if args.verify:
+        with MappedAnimation(output) as animation:
+            bad = animation.verify()
+        if bad:
+            print("{} frames don't match their digests: {}".format(len(bad), bad))
+            return 1
+        print("All frames OK")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,291 @@
+import bisect
+import json
+import math
+import threading
+import time
+
+
+class PlaybackStats:
+    # Running timing statistics of a playback.
+    # Latency is how late a frame went out compared to its deadline,
+    # drift how far behind its timeline the whole playback ended.
+
+    # Upper bounds of the latency histogram buckets in ms
+    HISTOGRAM_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+    def __init__(self):
+        self.frames_shown = 0
+        self.frames_dropped = 0
+        self.start_time = None
+        self.end_time = None
+        self.mean_latency = 0.0
+        self.max_latency = 0.0
+        self._latency_m2 = 0.0
+        self.histogram = [0] * (len(self.HISTOGRAM_BOUNDS) + 1)
+        self.last_latency = 0.0
+        self.drift = 0.0
+
+    def start(self, now):
+        self.start_time = now
+
+    def finish(self, now, timeline_end = None):
+        # timeline_end is when the last frame's slot ends on the timeline
+        self.end_time = now
+        if timeline_end is not None:
+            self.drift = max(now - timeline_end, 0.0)
+
+    def record_frame(self, latency):
+        # Welford's algorithm, so long playbacks don't need a list of samples
+        self.frames_shown += 1
+        self.last_latency = latency
+        delta = latency - self.mean_latency
+        self.mean_latency += delta / self.frames_shown
+        self._latency_m2 += delta * (latency - self.mean_latency)
+        self.max_latency = max(self.max_latency, latency)
+        self.histogram[bisect.bisect_left(self.HISTOGRAM_BOUNDS, latency * 1000)] += 1
+
+    def record_drop(self, count = 1):
+        self.frames_dropped += count
+
+    @property
+    def elapsed(self):
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+    @property
+    def fps(self):
+        if self.elapsed <= 0:
+            return 0.0
+        return self.frames_shown / self.elapsed
+
+    @property
+    def jitter(self):
+        # Standard deviation of the frame latency
+        if self.frames_shown < 2:
+            return 0.0
+        return math.sqrt(self._latency_m2 / (self.frames_shown - 1))
+
+    def to_dict(self):
+        buckets = []
+        lower = 0
+        for upper, count in zip(self.HISTOGRAM_BOUNDS + (None,), self.histogram):
+            buckets.append({'min_ms': lower, 'max_ms': upper, 'count': count})
+            lower = upper
+        return {
+            'frames_shown': self.frames_shown,
+            'frames_dropped': self.frames_dropped,
+            'elapsed_s': self.elapsed,
+            'fps': self.fps,
+            'mean_latency_ms': self.mean_latency * 1000,
+            'max_latency_ms': self.max_latency * 1000,
+            'jitter_ms': self.jitter * 1000,
+            'drift_ms': self.drift * 1000,
+            'latency_histogram': buckets,
+        }
+
+    def write_report(self, filename, **extra):
+        # Machine-readable timing report, extra keyword arguments are added as-is
+        report = self.to_dict()
+        report.update(extra)
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    def __str__(self):
+        return "{shown} frames in {elapsed:.2f}s ({fps:.2f} fps), jitter {jitter:.1f} ms, mean latency {mean:.1f} ms, max latency {max:.1f} ms, dropped {dropped}".format(
+            shown=self.frames_shown, elapsed=self.elapsed, fps=self.fps, jitter=self.jitter * 1000,
+            mean=self.mean_latency * 1000, max=self.max_latency * 1000, dropped=self.frames_dropped)
+
+
+class FrameScheduler:
+    # Sends frames at their deadlines on the monotonic clock and sleeps in between.
+    # Frames whose whole display slot has already passed are dropped
+    # so playback catches up instead of running late forever.
+
+    def __init__(self, send, drop_late_frames = True, clock = time.monotonic, sleep = None):
+        self.send = send
+        self.drop_late_frames = drop_late_frames
+        self.clock = clock
+        self._stopped = False
+        # The default sleep ends early on stop()
+        self._stop_event = threading.Event()
+        self.sleep = sleep if sleep is not None else self._stop_event.wait
+
+    def stop(self):
+        # Ends play() without sending any more frames, may be called from
+        # other threads, also before play() started
+        self._stopped = True
+        self._stop_event.set()
+
+    def play(self, frames, num_loops = 1):
+        # frames is a sequence of PackedFrame, num_loops = -1 loops forever
+        stats = PlaybackStats()
+        deadline = self.clock()
+        stats.start(deadline)
+        cur_loop = 0
+        while (cur_loop < num_loops or num_loops == -1) and not self._stopped:
+            for frame in frames:
+                duration = frame.duration / 1000
+                now = self.clock()
+                if now < deadline:
+                    self.sleep(deadline - now)
+                    now = self.clock()
+                if self._stopped:
+                    break
+                elif self.drop_late_frames and now >= deadline + duration:
+                    stats.record_drop()
+                    deadline += duration
+                    continue
+                self.send(frame.payload)
+                stats.record_frame(now - deadline)
+                deadline += duration
+            cur_loop += 1
+        # The last frame stays on until its duration is over
+        now = self.clock()
+        if now < deadline and not self._stopped:
+            self.sleep(deadline - now)
+        stats.finish(self.clock(), deadline)
+        return stats
+
+
+class PlaybackEngine(FrameScheduler):
+    # Plays frames on a fixed timeline anchored to the monotonic clock.
+    # If playback falls behind, it skips straight to the frame that is
+    # due now, so it never drifts against external sources like audio.
+    # pause(), resume() and seek() may be called from other threads.
+
+    def __init__(self, send, clock = time.monotonic, on_frame = None):
+        super().__init__(send, drop_late_frames=True, clock=clock)
+        self.on_frame = on_frame
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._paused_at = None
+        self._pause_shift = 0.0
+        self._seek_index = None
+
+    def pause(self):
+        with self._lock:
+            if self._paused_at is None:
+                self._paused_at = self.clock()
+        self._wakeup.set()
+
+    def resume(self):
+        with self._lock:
+            if self._paused_at is not None:
+                # The timeline doesn't move while paused
+                self._pause_shift += self.clock() - self._paused_at
+                self._paused_at = None
+        self._wakeup.set()
+
+    @property
+    def paused(self):
+        return self._paused_at is not None
+
+    def seek(self, index):
+        # Continue playback at the given frame index right away
+        with self._lock:
+            self._seek_index = index
+        self._wakeup.set()
+
+    def stop(self):
+        # Also works before play(), which then returns right away
+        with self._lock:
+            self._stopped = True
+        self._wakeup.set()
+
+    def rearm(self):
+        # Allow playing again after stop()
+        with self._lock:
+            self._stopped = False
+
+    def _wait(self, timeout):
+        # Sleep that returns early on pause, seek or stop
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def play(self, frames, num_loops = 1, start_index = 0):
+        stats = PlaybackStats()
+        count = len(frames)
+        if count == 0:
+            now = self.clock()
+            stats.start(now)
+            stats.finish(now)
+            return stats
+        # Start offset of each frame within one loop. Animations know their
+        # durations up front, getting the frames could mean decoding them all.
+        durations = getattr(frames, 'durations', None)
+        if durations is None:
+            durations = [frame.duration for frame in frames]
+        offsets = [0.0]
+        for duration in durations:
+            offsets.append(offsets[-1] + duration / 1000)
+        loop_duration = offsets[-1]
+
+        now = self.clock()
+        with self._lock:
+            # The timeline only starts now, a pause from before play() counts from here
+            self._pause_shift = 0.0
+            if self._paused_at is not None:
+                self._paused_at = now
+        stats.start(now)
+        index = min(max(start_index, 0), count - 1)
+        anchor = now - offsets[index]
+        cur_loop = 0
+        while (cur_loop < num_loops or num_loops == -1) and not self._stopped:
+            with self._lock:
+                seek_index, self._seek_index = self._seek_index, None
+                paused = self._paused_at is not None
+                anchor += self._pause_shift
+                self._pause_shift = 0.0
+            if paused:
+                if seek_index is not None:
+                    # Keep the seek for when playback resumes
+                    with self._lock:
+                        if self._seek_index is None:
+                            self._seek_index = seek_index
+                self._wait(None)
+                continue
+            if seek_index is not None:
+                index = min(max(seek_index, 0), count - 1)
+                anchor = self.clock() - offsets[index]
+
+            deadline = anchor + offsets[index]
+            now = self.clock()
+            if now < deadline:
+                self._wait(deadline - now)
+                continue
+            if now >= anchor + offsets[index + 1]:
+                # Catch up: jump to the frame that should be showing by now
+                due = bisect.bisect_right(offsets, now - anchor) - 1
+                stats.record_drop(min(due, count) - index)
+                index = due
+                if index >= count:
+                    index = 0
+                    anchor += loop_duration
+                    cur_loop += 1
+                continue
+
+            self.send(frames[index].payload)
+            stats.record_frame(now - deadline)
+            if self.on_frame is not None:
+                self.on_frame(index, stats)
+            index += 1
+            if index >= count:
+                index = 0
+                anchor += loop_duration
+                cur_loop += 1
+
+        if not self._stopped:
+            # The last frame stays on until its duration is over
+            now = self.clock()
+            if now < anchor:
+                self._wait(anchor - now)
+        now = self.clock()
+        with self._lock:
+            # Time spent paused isn't drift
+            anchor += self._pause_shift
+            self._pause_shift = 0.0
+            if self._paused_at is not None:
+                anchor += now - self._paused_at
+        stats.finish(now, anchor + offsets[index])
+        return stats
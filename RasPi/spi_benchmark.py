@@ -0,0 +1,201 @@
+import argparse
+import datetime
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import fake_spidev
+from fia_control import FIA, FIAError, LINK_CONFIG_FILE
+
+from local_settings import *
+
+
+DEFAULT_CLOCKS = [1000000, 2000000, 4000000, 5000000, 8000000, 10000000, 16000000, 20000000, 25000000, 32000000]
+
+# Largest transfer spidev does in one go, larger ones are split up
+# and the controller restarts reception at every chip select
+SPIDEV_BUFSIZ_FILE = "/sys/module/spidev/parameters/bufsiz"
+
+
+def int_list(value):
+    try:
+        return [int(v) for v in value.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("{} must be a comma separated list of integers".format(value))
+
+
+def read_spidev_bufsiz():
+    try:
+        with open(SPIDEV_BUFSIZ_FILE, 'r') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def make_test_patterns(size, seed):
+    # Two different random payloads, so every transfer changes all bytes
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, size, dtype=np.uint8).tobytes() for i in range(2)]
+
+
+def make_check_image(width, height, clock):
+    # Checkerboard of 8x8 blocks, every flipped bit shows up as a stray pixel
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.where((x // 8 + y // 8) % 2, 255, 0).astype(np.uint8)
+    img = Image.fromarray(pixels)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, width - 1, 15), fill=0)
+    draw.text((2, 2), "SPI {} Hz".format(clock), fill=255)
+    return img
+
+
+def measure(spi, clock, size, transfers, received = None):
+    # Send transfers payloads of size bytes at the given clock.
+    # If received is a list the SPI device appends each transfer to,
+    # the data is compared with what was sent.
+    spi.max_speed_hz = clock
+    patterns = make_test_patterns(size, clock + size)
+    errors = 0 if received is not None else None
+    start = time.perf_counter()
+    for i in range(transfers):
+        data = patterns[i % 2]
+        spi.writebytes2(data)
+        if received is not None:
+            if not received or received[-1] != data:
+                errors += 1
+            received.clear()
+    elapsed = time.perf_counter() - start
+    return {
+        'clock': clock,
+        'size': size,
+        'transfers': transfers,
+        'ms_per_transfer': elapsed / transfers * 1000,
+        'throughput_kib_s': size * transfers / elapsed / 1024,
+        'errors': errors,
+    }
+
+
+def check_link(fia, width, height, clock, confirm):
+    # Without a way to read bitmap data back, check that the controller
+    # still responds and optionally let the user look at a test pattern
+    try:
+        fia.null_cmd()
+    except FIAError as e:
+        print("  Controller not responding: {}".format(e))
+        return False
+    fia.send_image(make_check_image(width, height, clock), force=True)
+    if confirm:
+        answer = input("  Is the checkerboard clean (no stray pixels)? [y/n] ")
+        return answer.strip().lower().startswith("y")
+    return True
+
+
+def choose_clock(results, passed, margin):
+    # Highest clock that passed, minus a number of steps for safety
+    clocks = sorted(set(r['clock'] for r in results))
+    good = [clock for clock in clocks if passed.get(clock)]
+    if not good:
+        return None
+    return good[max(0, len(good) - 1 - margin)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure SPI bitmap throughput at different clocks and pick the fastest reliable one", add_help=False)
+    parser.add_argument('--clocks', '-c', required=False, type=int_list, default=DEFAULT_CLOCKS, help="Comma separated SPI clocks in Hz")
+    parser.add_argument('--sizes', '-s', required=False, type=int_list, default=None, help="Comma separated transfer sizes in bytes (defaults to 1/8, 1/2 and a full frame)")
+    parser.add_argument('--transfers', '-t', required=False, type=int, default=20, help="Transfers per clock and size")
+    parser.add_argument('--margin', '-m', required=False, type=int, default=1, help="Number of clock steps to stay below the fastest passing clock")
+    parser.add_argument('--confirm', action='store_true', help="Show a test pattern after every clock and ask whether it looks right")
+    parser.add_argument('--write-config', '-w', action='store_true', help="Store the chosen clock for FIA, needs --confirm")
+    parser.add_argument('--config', required=False, type=str, default=LINK_CONFIG_FILE, help="Link config file to write")
+    parser.add_argument('--report', '-r', required=False, type=str, default=None, help="Write all results to this JSON file")
+    parser.add_argument('--emulate', '-e', action='store_true', help="Benchmark a fake SPI device instead of the hardware")
+    parser.add_argument('--emulate-limit', required=False, type=int, default=16000000, help="Clock above which the fake SPI device starts corrupting data")
+    parser.add_argument('--help', action='help', help="Display this help message")
+    args = parser.parse_args()
+
+    # Without --confirm a clock passes as long as the controller responds,
+    # corrupted bitmaps go unnoticed
+    if args.write_config and (args.emulate or not args.confirm):
+        parser.error("--write-config needs --confirm and can't be used with --emulate")
+
+    frame_size = DISPLAY_WIDTH * DISPLAY_HEIGHT // 8
+    sizes = args.sizes or [frame_size // 8, frame_size // 2, frame_size]
+
+    received = None
+    fia = None
+    if args.emulate:
+        received = []
+        spi = fake_spidev.SpiDev(0, 0, max_reliable_hz=args.emulate_limit, on_transfer=received.append)
+    else:
+        fia = FIA("/dev/ttyAMA1", (3, 0), width=DISPLAY_WIDTH, height=DISPLAY_HEIGHT)
+        spi = fia.spi
+        original_clock = spi.max_speed_hz
+        fia.set_destination_buffer(FIA.SIDE_BOTH)
+        bufsiz = read_spidev_bufsiz()
+        if bufsiz is not None and bufsiz < max(sizes):
+            print("Warning: spidev bufsiz is {}, larger transfers will be split and arrive incomplete".format(bufsiz))
+
+    results = []
+    passed = {}
+    try:
+        for clock in args.clocks:
+            print("{:>10} Hz".format(clock))
+            ok = True
+            for size in sizes:
+                result = measure(spi, clock, size, args.transfers, received)
+                results.append(result)
+                if result['errors']:
+                    ok = False
+                print("  {size:>6} bytes: {ms_per_transfer:8.2f} ms/transfer, {throughput_kib_s:8.1f} KiB/s, errors: {errors}".format(**result))
+            if fia is not None:
+                ok = check_link(fia, DISPLAY_WIDTH, DISPLAY_HEIGHT, clock, args.confirm) and ok
+            passed[clock] = ok
+    except KeyboardInterrupt:
+        print("")
+    finally:
+        if fia is not None:
+            spi.max_speed_hz = original_clock
+            fia.send_image(Image.new('L', (DISPLAY_WIDTH, DISPLAY_HEIGHT), 'black'), force=True)
+
+    # Full frame rate per clock, estimated from the throughput if no full frames were sent
+    max_fps = {}
+    for result in results:
+        fps = result['throughput_kib_s'] * 1024 / frame_size
+        if result['size'] == frame_size or result['clock'] not in max_fps:
+            max_fps[result['clock']] = fps
+    print("")
+    for clock in sorted(max_fps):
+        print("{:>10} Hz: {:6.1f} fps max, {}".format(clock, max_fps[clock], "OK" if passed.get(clock) else "FAILED"))
+
+    chosen = choose_clock(results, passed, args.margin)
+    if chosen is None:
+        print("No clock passed")
+        return 1
+    print("Chosen SPI clock: {} Hz ({:.1f} fps max)".format(chosen, max_fps[chosen]))
+    if fia is not None and not args.confirm:
+        print("Note: bitmap integrity can't be read back from the controller, use --confirm to check it visually")
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({'results': results, 'passed': passed, 'chosen': chosen}, f, indent=2)
+    if args.write_config:
+        os.makedirs(os.path.dirname(args.config) or ".", exist_ok=True)
+        config = {
+            'spi_clock': chosen,
+            'max_fps': max_fps[chosen],
+            'emulated': args.emulate,
+            'confirmed': args.confirm,
+            'measured': datetime.datetime.now().isoformat(timespec='seconds'),
+        }
+        with open(args.config, 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=2)
+        print("Written to {}".format(args.config))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -21,17 +21,18 @@ def main():
     
     while True:
         try:
-            temps = fia.get_temperatures()
-            humidity = fia.get_humidity()
-            backlight_state = fia.get_backlight_state()
-            bl_base_brightness_a, bl_base_brightness_b = fia.get_backlight_base_brightness()
-            bl_cur_brightness_a, bl_cur_brightness_b = fia.get_backlight_brightness()
-            env_brightness_a, env_brightness_b = fia.get_env_brightness()
-            door_states = fia.get_door_states()
-            heaters_state = fia.get_heaters_state()
-            circ_fans_state = fia.get_circulation_fans_state()
-            heat_exc_fan_state = fia.get_heat_exchanger_fan_state()
-            bl_ballast_fans_state = fia.get_backlight_ballast_fans_state()
+            status = fia.get_status()
+            temps = status.temperatures
+            humidity = status.humidity
+            backlight_state = status.backlight_state
+            bl_base_brightness_a, bl_base_brightness_b = status.backlight_base_brightness
+            bl_cur_brightness_a, bl_cur_brightness_b = status.backlight_brightness
+            env_brightness_a, env_brightness_b = status.env_brightness
+            door_states = status.door_states
+            heaters_state = status.heaters_state
+            circ_fans_state = status.circulation_fans_state
+            heat_exc_fan_state = status.heat_exchanger_fan_state
+            bl_ballast_fans_state = status.backlight_ballast_fans_state
             
             data = {'placeholders': {
                 'temp_ballasts': "{:.1f}".format(temps[0]),
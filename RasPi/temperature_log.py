@@ -22,9 +22,8 @@ def main():
     
     with open("temperatures.csv", 'a') as f:
         while True:
-            temps = list(fia.get_temperatures())
-            humidity = fia.get_humidity()
-            data = [time.time()] + temps + [humidity]
+            status = fia.get_status(('temperatures', 'humidity'))
+            data = [status.timestamp] + list(status.temperatures) + [status.humidity]
             print(data)
             f.write(",".join(map(str, data)) + "\n")
             time.sleep(5)
@@ -0,0 +1,46 @@
+import time
+
+import numpy as np
+
+from dirty_regions import DirtyRegionUpdater
+from fia_control import FIA, FIAHeadless
+
+
+def _frames(width, height, count):
+    # A random frame, then small changes to it and one large one
+    rng = np.random.default_rng(17)
+    h_bytes = (height + 7) // 8
+    frame = rng.integers(0, 256, width * h_bytes, dtype=np.uint8)
+    frames = [frame.copy()]
+    for i in range(count):
+        columns = frame.reshape((width, h_bytes))
+        if i == count // 2:
+            columns[:width // 2] ^= 0xFF
+        else:
+            x = int(rng.integers(0, width - 8))
+            row = int(rng.integers(0, h_bytes))
+            columns[x:x + 8, row] = rng.integers(0, 256, 8, dtype=np.uint8)
+        frames.append(frame.copy())
+    return [f.tobytes() for f in frames]
+
+
+def test_partial_updates_match_full_frames():
+    fia = FIAHeadless()
+    reference = FIAHeadless()
+    reference.set_destination_buffer(FIA.SIDE_BOTH)
+    updater = DirtyRegionUpdater(fia)
+    for frame in _frames(fia.width, fia.height, 8):
+        updater.send_array(frame)
+        reference.send_array(frame)
+        # Let the controller draw the windows
+        time.sleep(DirtyRegionUpdater.SETTLE_TIME * 2)
+        fia.null_cmd()
+        for side in (FIA.SIDE_A, FIA.SIDE_B):
+            assert fia.firmware.display_bitmap(side) == reference.firmware.display_bitmap(side)
+    assert updater.partial_frames > 0
+    assert updater.full_frames > 1
+    updater.close()
+    for side in (FIA.SIDE_A, FIA.SIDE_B):
+        assert fia.firmware.display_bitmap(side) == reference.firmware.display_bitmap(side)
+    fia.exit()
+    reference.exit()
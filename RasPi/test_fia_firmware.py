@@ -0,0 +1,45 @@
+import numpy as np
+from PIL import Image
+
+from bitmap import pack_bitmap
+from fia_firmware import DYN_BUFFER_ID_MASK, SIDE_A, SIDE_BOTH, FIAFirmware, load_splash
+from uart_commands import COMMANDS
+
+
+def test_reset_shows_splash():
+    fw = FIAFirmware(480, 128)
+    assert fw.display_bitmap(SIDE_A) == load_splash(480, 128)
+    # No splash screen for this size, all pixels on like FIA_Init()
+    fw = FIAFirmware(96, 64)
+    assert fw.display_pixels(SIDE_A).all()
+
+
+def test_mask_enabled_before_mask_upload():
+    # The mask starts out all set, so the dynamic layer is shown
+    fw = FIAFirmware(96, 64)
+    img = Image.new('L', (96, 64), 0)
+    img.paste(255, (10, 10, 30, 20))
+    fw.set_destination_buffer(SIDE_BOTH | DYN_BUFFER_ID_MASK)
+    fw.spi_transfer(pack_bitmap(img))
+    fw.process_command(COMMANDS['set_mask_enabled'].code, b"\x01")
+    fw.update_display()
+    assert fw.display_bitmap(SIDE_A) == pack_bitmap(img)
+
+
+def test_scroll_buffer_height_in_whole_bytes():
+    # FIA_RenderScrollBuffer() cuts int_h down to whole bytes for the column
+    # stride and the wrap, while the buffer is uploaded with int_h rounded up
+    fw = FIAFirmware(96, 64)
+    fw.static[0][:] = 0
+    buf_id = fw.create_scroll_buffer(SIDE_A, 0, 0, 8, 16, 8, 12, 0, 0, 0, 0, 0, 0)
+    fw.set_destination_buffer(buf_id)
+    pixels = np.zeros((12, 8), dtype=np.uint8)
+    pixels[0] = 255
+    fw.spi_transfer(pack_bitmap(Image.fromarray(pixels)))
+    fw.update_display()
+    shown = fw.display_pixels(SIDE_A)[:16, :8]
+    # Column 0 wraps after 8 rows
+    assert list(np.flatnonzero(shown[:, 0])) == [0, 8]
+    # Column 1 reads the second byte of column 0, which is empty
+    assert not shown[:, 1].any()
+    assert list(np.flatnonzero(shown[:, 2])) == [0, 8]
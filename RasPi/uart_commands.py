@@ -0,0 +1,136 @@
+import struct
+
+
+# UART protocol of the FIAControl firmware (uart_protocol.h, uart_commands.h).
+#
+# Command frame:  0xFF, length, command, parameters..., checksum
+# Response frame: 0xFF, length, payload..., checksum
+#
+# The length counts everything after it, the checksum is 0x7F XORed with
+# the command and parameters (or the response payload). All values are
+# big endian.
+
+START_BYTE = 0xFF
+CHECKSUM_START_VALUE = 0x7F
+MAX_PAYLOAD_LENGTH = 27
+
+# Start byte, length, command and checksum around the parameters
+FRAME_OVERHEAD = 4
+MAX_FRAME_LENGTH = MAX_PAYLOAD_LENGTH + 2
+
+
+def checksum(data, value = CHECKSUM_START_VALUE):
+    for byte in data:
+        value ^= byte
+    return value
+
+
+class UARTCommand:
+    # One command of the protocol. request and response are struct formats
+    # (without byte order) of the parameters and response payload, scale
+    # divides the decoded response values (fixed point readings).
+
+    def __init__(self, name, code, request = "", response = "", scale = None, expect_response = True):
+        self.name = name
+        self.code = code
+        self.request = struct.Struct(">" + request)
+        self.response = struct.Struct(">" + response)
+        self.scale = scale
+        self.expect_response = expect_response
+        self.frame_length = self.request.size + FRAME_OVERHEAD
+        # The fixed part of the frame, parameters and checksum are filled in per call
+        self._header = bytes([START_BYTE, self.request.size + 2, code])
+        self._checksum_start = CHECKSUM_START_VALUE ^ code
+        # Commands without parameters always have the same frame
+        self._frame = None
+        if not self.request.size:
+            self._frame = self.pack_frame()
+
+    def pack_frame_into(self, buf, offset, *args):
+        # Write the command frame for the given parameters into buf at offset,
+        # returns the offset after the frame
+        end = offset + self.frame_length
+        buf[offset:offset + 3] = self._header
+        try:
+            self.request.pack_into(buf, offset + 3, *args)
+        except struct.error as e:
+            raise ValueError("Invalid parameters for {}: {}".format(self.name, e))
+        buf[end - 1] = checksum(memoryview(buf)[offset + 3:end - 1], self._checksum_start)
+        return end
+
+    def pack_frame(self, *args):
+        # The command frame as a new bytes object
+        if self._frame is not None and not args:
+            return self._frame
+        buf = bytearray(self.frame_length)
+        self.pack_frame_into(buf, 0, *args)
+        return bytes(buf)
+
+    def decode(self, payload):
+        # Response payload to a value, a tuple if there is more than one.
+        # Set commands get an empty response and return None.
+        if not self.response.size:
+            return None
+        values = self.response.unpack_from(payload)
+        if self.scale is not None:
+            values = tuple(value / self.scale for value in values)
+        return values[0] if len(values) == 1 else values
+
+    # The other side of the link, for simulators
+
+    def unpack_request(self, params):
+        # Missing parameters read as zero, like the firmware's cleared payload array
+        if len(params) < self.request.size:
+            params = bytes(params) + bytes(self.request.size - len(params))
+        return self.request.unpack_from(params)
+
+    def pack_response(self, *values):
+        if self.scale is not None:
+            values = [int(value * self.scale) for value in values]
+        return self.response.pack(*values)
+
+
+_SCROLL_BUFFER_GEOMETRY = "HHHH"
+_SCROLL = "HHHHhh"
+
+COMMANDS = {command.name: command for command in (
+    UARTCommand('null', 0x00, response="B"),
+    UARTCommand('mcu_reset', 0x01, expect_response=False),
+
+    UARTCommand('set_backlight_state', 0x10, "B"),
+    UARTCommand('get_backlight_state', 0x11, response="B"),
+    UARTCommand('set_backlight_base_brightness', 0x12, "hh"),
+    UARTCommand('get_backlight_base_brightness', 0x13, response="hh"),
+    UARTCommand('get_backlight_brightness', 0x14, response="HH"),
+
+    UARTCommand('set_heaters_state', 0x20, "B"),
+    UARTCommand('get_heaters_state', 0x21, response="B"),
+    UARTCommand('set_circulation_fans_state', 0x22, "B"),
+    UARTCommand('get_circulation_fans_state', 0x23, response="B"),
+    UARTCommand('set_heat_exchanger_fan_state', 0x24, "B"),
+    UARTCommand('get_heat_exchanger_fan_state', 0x25, response="B"),
+    UARTCommand('set_backlight_ballast_fans_state', 0x26, "B"),
+    UARTCommand('get_backlight_ballast_fans_state', 0x27, response="B"),
+
+    UARTCommand('get_door_states', 0x30, response="B"),
+
+    # Hundredths of degrees Celsius and percent, signed on the controller
+    UARTCommand('get_temperatures', 0x40, response="hhhh", scale=100),
+    UARTCommand('get_humidity', 0x41, response="h", scale=100),
+    UARTCommand('get_env_brightness', 0x42, response="HH"),
+
+    UARTCommand('set_lcd_contrast', 0x50, "HH"),
+    UARTCommand('get_lcd_contrast', 0x51, response="HH"),
+
+    # side, display position and size, internal size, scroll offset, speed and step
+    UARTCommand('create_scroll_buffer', 0x60, "B" + _SCROLL_BUFFER_GEOMETRY + "HH" + _SCROLL, response="B"),
+    UARTCommand('delete_scroll_buffer', 0x61, "B", response="B"),
+    # buffer ID, then like create without the internal size, 0xFF(FF) / 0x7FFF keep a value
+    UARTCommand('update_scroll_buffer', 0x62, "BB" + _SCROLL_BUFFER_GEOMETRY + _SCROLL, response="B"),
+    UARTCommand('set_destination_buffer', 0x63, "B", response="B"),
+    UARTCommand('get_destination_buffer', 0x64, response="B"),
+    UARTCommand('set_mask_enabled', 0x65, "B"),
+    UARTCommand('get_mask_enabled', 0x66, response="B"),
+)}
+
+COMMANDS_BY_CODE = {command.code: command for command in COMMANDS.values()}
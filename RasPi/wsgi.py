@@ -1,14 +1,18 @@
+import base64
 import json
 import platform
+import threading
 import time
 
-from flask import Flask, request, render_template, redirect, send_from_directory
+from flask import Flask, Response, abort, request, render_template, redirect, send_from_directory, stream_with_context
 from flask_wtf import FlaskForm
 from wtforms import BooleanField, StringField, SubmitField, FormField, FieldList, IntegerField, SelectField
 from wtforms.widgets import TextArea
 from wtforms.widgets.html5 import NumberInput
 from wtforms.validators import NumberRange
 
+from frame_broadcaster import FORMATS, MAX_SCALE, FrameBroadcaster
+
 NODE_NAME = platform.node()
 
 app = Flask(__name__, template_folder="webserver/templates")
@@ -20,6 +24,10 @@ NUM_LINES = 10
 ALIGN_CHOICES = [('left', "Left"), ('center', "Center"), ('right', "Right")]
 FONT_CHOICES = [('7_DBLCD', "DBLCD 7px"), ('10S_DBLCD_custom', "DBLCD 10px"), ('10_DBLCD_custom', "DBLCD 10px bold"), ('12_DBLCD', "DBLCD 12px"), ('14S_DBLCD', "DBLCD 14px"), ('14_DBLCD', "DBLCD 14px bold")]
 
+# Frames for the live view. They only arrive if the app runs in the
+# process that drives the display, see serve_in_background().
+BROADCASTER = FrameBroadcaster()
+
 
 class TextPageForm(FlaskForm):
     duration = IntegerField("Duration", default=10,
@@ -77,3 +85,71 @@ def img(path):
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory('webserver/img', "favicon.ico")
+
+def _stream_args():
+    scale = min(max(request.args.get('scale', 1, type=int), 1), MAX_SCALE)
+    fps = request.args.get('fps', None, type=float)
+    return scale, fps if fps is None or fps > 0 else None
+
+@app.route("/live")
+def live():
+    return render_template("live.html", node_name=NODE_NAME)
+
+@app.route("/live/frame.<fmt>")
+def live_frame(fmt):
+    if fmt not in FORMATS:
+        abort(404)
+    scale = min(max(request.args.get('scale', 1, type=int), 1), MAX_SCALE)
+    data = BROADCASTER.latest(fmt, scale)
+    if data is None:
+        abort(503)
+    return Response(data, mimetype=FORMATS[fmt], headers={'Cache-Control': "no-cache"})
+
+@app.route("/live/stream.<fmt>")
+def live_stream(fmt):
+    # Multipart stream of images, like MJPEG cameras
+    if fmt not in FORMATS:
+        abort(404)
+    scale, fps = _stream_args()
+    
+    def _generate():
+        last = None
+        for seq, data in BROADCASTER.stream(fmt, scale, fps):
+            # Repeat the last frame to keep the connection alive
+            data = data or last
+            if data is None:
+                continue
+            last = data
+            yield b"--frame\r\nContent-Type: " + FORMATS[fmt].encode('ascii') + b"\r\nContent-Length: " + str(len(data)).encode('ascii') + b"\r\n\r\n" + data + b"\r\n"
+    
+    return Response(stream_with_context(_generate()), mimetype="multipart/x-mixed-replace; boundary=frame",
+                    headers={'Cache-Control': "no-cache", 'X-Accel-Buffering': "no"})
+
+@app.route("/live/events")
+def live_events():
+    # Server-sent events with the frames as base64 encoded images
+    fmt = request.args.get('format', 'png')
+    if fmt not in FORMATS:
+        abort(404)
+    scale, fps = _stream_args()
+    
+    def _generate():
+        for seq, data in BROADCASTER.stream(fmt, scale, fps):
+            if data is None:
+                yield ": keepalive\n\n"
+            else:
+                yield "id: {}\nevent: frame\ndata: data:{};base64,{}\n\n".format(seq, FORMATS[fmt], base64.b64encode(data).decode('ascii'))
+    
+    return Response(stream_with_context(_generate()), mimetype="text/event-stream",
+                    headers={'Cache-Control': "no-cache", 'X-Accel-Buffering': "no"})
+
+
+def serve_in_background(fia, port, host = "0.0.0.0"):
+    # Run the app in a thread next to whatever drives the display,
+    # with the live view showing the frames of fia
+    from werkzeug.serving import make_server
+    BROADCASTER.attach_fia(fia)
+    server = make_server(host, port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name="WebServer", daemon=True)
+    thread.start()
+    return server
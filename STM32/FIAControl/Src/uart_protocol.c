@@ -58,6 +58,13 @@ uint8_t UART_VerifyChecksum(uint8_t* data, uint8_t length) {
 }
 
 void UART_TransmitResponse(uint8_t* data, uint8_t length) {
+    // Wait for the previous response to finish before reusing the buffer.
+    // This happens when the host sends several commands back to back.
+    uint32_t start = HAL_GetTick();
+    while (CONTROL_UART.gState != HAL_UART_STATE_READY) {
+        if (HAL_GetTick() - start > UART_TX_TIMEOUT)
+            break;
+    }
     uartTxBuffer[0] = UART_START_BYTE;
     uartTxBuffer[1] = length + 1;
     memcpy(&uartTxBuffer[2], data, length);
@@ -91,7 +98,7 @@ void UART_HandleProtocol(void) {
     }
 
     // Cancel non-destructively if we haven't received the whole command yet
-    if (length > inWaiting)
+    if (length + 2 > inWaiting)
         return;
 
     // If we have already received the whole command,
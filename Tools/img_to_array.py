@@ -1,24 +1,16 @@
 import argparse
+import os
+import sys
 from PIL import Image
 
+# The bitmap packer lives with the rest of the display code
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "RasPi"))
+from bitmap import pack_bitmap
+
 
 def img_to_array(img):
-    pixels = img.load()
     width, height = img.size
-
-    output = []
-
-    for x in range(width):
-        for y_byte in range(0, height, 8):
-            byte = 0x00
-            for y_bit in range(8):
-                y = y_byte + y_bit
-                state = pixels[x, y] > 64
-                if state:
-                    byte |= (1 << y_bit)
-            output.append(byte)
-    
-    return output, width, height
+    return pack_bitmap(img), width, height
 
 
 def main():
@@ -1,8 +1,13 @@
 import math
+import os
 import random
+import sys
 
 from PIL import Image
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "RasPi"))
+from bitmap import pack_bitmap
+
 DEBUG = 0
 
 
@@ -12,19 +17,9 @@ def _print(*args, **kwargs):
 
 
 def img_to_array(img):
-    pixels = img.load()
+    # Mutable copy, the renderer below writes into it
     width, height = img.size
-    output = []
-    for x in range(width):
-        for yByte in range(0, height, 8):
-            byte = 0x00
-            for y_bit in range(8):
-                y = yByte + y_bit
-                state = pixels[x, y] > 64
-                if state:
-                    byte |= (1 << y_bit)
-            output.append(byte)
-    return output, width, height
+    return list(pack_bitmap(img)), width, height
 
 
 def render_frame(dispX, dispY, dispW, dispH, scrollOffsetX, scrollOffsetY):
@@ -9,14 +9,23 @@ from img_to_array import img_to_array
 
 def send_array(array, port):
     length = len(array)
-    array = [length >> 8, length & 0xFF] + array
-    port.write(bytearray(array))
+    port.write(bytes([length >> 8, length & 0xFF]) + bytes(array))
 
 def send_image(img, port):
     flattened = flatten_img(img)
     array, width, height = img_to_array(flattened)
     send_array(array, port)
 
+def iter_frames(img, width = None, height = None):
+    # Frames are converted one at a time while sending, not all up front
+    for frame in ImageSequence.Iterator(img):
+        if width and height:
+            temp = Image.new('L', (width, height))
+            temp.paste(frame, (0, 0))
+            yield temp
+        else:
+            yield frame.convert('L')
+
 
 def main():
     parser = argparse.ArgumentParser(add_help=False)
@@ -35,26 +44,14 @@ def main():
     else:
         duration = img.info.get('duration', 1000)
     
-    frames = []
-    if args.width and args.height:
-        for frame in ImageSequence.Iterator(img):
-            temp = Image.new('L', (args.width, args.height))
-            temp.paste(frame, (0, 0))
-            frames.append(temp)
-    else:
-        for frame in ImageSequence.Iterator(img):
-            frames.append(frame.convert('L'))
-    
     last_frame_time = 0
-    cur_frame = 0
     while True:
-        now = time.time()
-        if now - last_frame_time >= duration / 1000:
-            send_image(frames[cur_frame], port)
-            last_frame_time = now
-            cur_frame += 1
-        if cur_frame >= len(frames):
-            cur_frame = 0
+        for frame in iter_frames(img, args.width, args.height):
+            delay = last_frame_time + duration / 1000 - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            last_frame_time = time.time()
+            send_image(frame, port)
 
 
 if __name__ == "__main__":